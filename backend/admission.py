@@ -0,0 +1,151 @@
+"""Admission control: per-user and per-IP rate limits, in-flight cap.
+
+A plain ASGI middleware in front of the routers. A request is turned away
+before it reaches authentication or the database when:
+
+- the token bucket of its user (the "sub" of a valid bearer token) or of
+  its client address is empty -> 429 with Retry-After;
+- the worker already serves ADMISSION_MAX_INFLIGHT requests -> 503 with
+  Retry-After. The default is the size of the SQLAlchemy pool, so extra
+  requests are shed immediately instead of queueing for a connection.
+
+All limits are per worker process. The client address is scope["client"],
+which uvicorn takes from X-Forwarded-For for trusted proxies
+(FORWARDED_ALLOW_IPS). A limit of 0 turns that check off.
+"""
+import json
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from jose import JWTError, jwt
+
+from config import ALGORITHM, SECRET_KEY
+from database import DB_MAX_OVERFLOW, DB_POOL_SIZE
+from metrics import REGISTRY
+
+# Запросов в секунду и размер всплеска на пользователя и на адрес клиента
+RATE_LIMIT_USER_RPS = float(os.getenv("RATE_LIMIT_USER_RPS", "20"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "40"))
+RATE_LIMIT_IP_RPS = float(os.getenv("RATE_LIMIT_IP_RPS", "50"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "100"))
+# Одновременных запросов на воркер; больше пул всё равно не обслужит без ожидания
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+# Сколько корзин держать в памяти; при переполнении выбрасываются полные (неактивные)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Пробы и метрики не ограничиваются
+EXEMPT_PATHS = {"/health", "/ready", "/metrics"}
+# Долгие потоки без соединения с БД: ограничивается только частота подключений
+INFLIGHT_EXEMPT_PATHS = {"/api/events/stream"}
+
+REJECTED = REGISTRY.counter(
+    "admission_rejected_total", "Requests shed by admission control", ("reason",))
+REGISTRY.gauge(
+    "admission_limit", "Configured admission limits of this worker", ("name",),
+    callback=lambda: {
+        "user_rps": RATE_LIMIT_USER_RPS, "user_burst": RATE_LIMIT_USER_BURST,
+        "ip_rps": RATE_LIMIT_IP_RPS, "ip_burst": RATE_LIMIT_IP_BURST,
+        "max_inflight": ADMISSION_MAX_INFLIGHT,
+    })
+
+_inflight = 0
+REGISTRY.gauge("admission_inflight", "Requests in flight in this worker", callback=lambda: _inflight)
+
+
+class TokenBuckets:
+    """Token bucket per key: rate tokens per second, at most burst stored."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def take(self, key: str) -> float:
+        """Take a token; return 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            self._prune(now)
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    def _prune(self, now: float):
+        # Полная корзина ничем не отличается от отсутствующей
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * self.rate >= self.burst:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+
+def token_subject(authorization: Optional[str]) -> Optional[str]:
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    try:
+        # Подпись проверяется, иначе любой мог бы тратить чужую квоту
+        return jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+
+
+class AdmissionControl:
+    def __init__(self, app):
+        self.app = app
+        self.user_buckets = TokenBuckets(RATE_LIMIT_USER_RPS, RATE_LIMIT_USER_BURST) if RATE_LIMIT_USER_RPS > 0 else None
+        self.ip_buckets = TokenBuckets(RATE_LIMIT_IP_RPS, RATE_LIMIT_IP_BURST) if RATE_LIMIT_IP_RPS > 0 else None
+
+    async def __call__(self, scope, receive, send):
+        global _inflight
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in EXEMPT_PATHS or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        if self.ip_buckets is not None and scope.get("client"):
+            wait = self.ip_buckets.take(scope["client"][0])
+            if wait:
+                await self._reject(send, 429, "ip_rate", "Too many requests", wait)
+                return
+        if self.user_buckets is not None:
+            subject = None
+            for name, value in scope["headers"]:
+                if name == b"authorization":
+                    subject = token_subject(value.decode("latin-1"))
+                    break
+            wait = self.user_buckets.take(subject) if subject else 0.0
+            if wait:
+                await self._reject(send, 429, "user_rate", "Too many requests", wait)
+                return
+
+        if path in INFLIGHT_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        if 0 < ADMISSION_MAX_INFLIGHT <= _inflight:
+            await self._reject(send, 503, "inflight", "Server is busy, try again later", 1)
+            return
+        _inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _inflight -= 1
+
+    async def _reject(self, send, status: int, reason: str, detail: str, retry_after: float):
+        REJECTED.inc(reason)
+        body = json.dumps({"detail": detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,22 @@
+"""add change notification triggers for the push channel
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+
+import change_feed
+
+# revision identifiers, used by Alembic.
+revision = '009'
+down_revision = '008'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    change_feed.install(op.get_bind())
+
+def downgrade():
+    change_feed.uninstall(op.get_bind())
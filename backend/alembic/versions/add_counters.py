@@ -0,0 +1,33 @@
+"""add trigger-maintained counters
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import counters
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('chats', sa.Column('active_members', sa.Integer(), nullable=False, server_default='0'))
+    op.create_table(
+        'tenant_counters',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('name', sa.String(50), primary_key=True),
+        sa.Column('value', sa.BigInteger(), nullable=False, server_default='0')
+    )
+    # Функции, триггеры и пересчёт по текущим данным — в одной транзакции с блокировкой таблиц
+    counters.install(op.get_bind())
+
+def downgrade():
+    counters.uninstall(op.get_bind())
+    op.drop_table('tenant_counters')
+    op.drop_column('chats', 'active_members')
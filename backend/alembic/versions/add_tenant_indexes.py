@@ -0,0 +1,42 @@
+"""add indexes for tenant-scoped queries
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+# Same definitions as the Index entries in models.py
+INDEXES = [
+    # Списки чатов арендатора (ORDER BY chat_id) и загрузка арендатора в bot_service
+    ('ix_chats_user_id_chat_id', 'chats', '(user_id, chat_id)', None),
+    ('ix_chats_bot_id', 'chats', '(bot_id)', None),
+    ('ix_employees_user_id_employee_id', 'employees', '(user_id, employee_id)', None),
+    # bot_service и импорт ищут сотрудника по telegram_user_id / username внутри арендатора
+    ('ix_employees_user_id_telegram_user_id', 'employees', '(user_id, telegram_user_id)', 'telegram_user_id IS NOT NULL'),
+    ('ix_employees_user_id_username', 'employees', '(user_id, lower(telegram_username))', 'telegram_username IS NOT NULL'),
+    # PK (chat_id, employee_id) не помогает при поиске по employee_id
+    ('ix_chat_employees_employee_id', 'chat_employees', '(employee_id)', None),
+    ('ix_chat_employees_user_id', 'chat_employees', '(user_id)', None),
+    ('ix_bots_user_id', 'bots', '(user_id)', None),
+    ('ix_bots_active_user_id', 'bots', '(user_id)', 'is_active'),
+]
+
+def upgrade():
+    # CONCURRENTLY нельзя выполнять в транзакции; индексы строятся без блокировки записи
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            predicate = f' WHERE {where}' if where else ''
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {columns}{predicate}')
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
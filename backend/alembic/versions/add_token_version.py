@@ -0,0 +1,22 @@
+"""add users.token_version
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Version claim for issued JWTs; bumped when the password changes
+    op.add_column('users', sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+def downgrade():
+    op.drop_column('users', 'token_version')
@@ -0,0 +1,73 @@
+"""Change notifications for the push channel (events.py).
+
+Statement-level triggers on chats and chat_employees send one NOTIFY per
+tenant touched by the statement on the CHANNEL channel:
+
+    {"user_id": 1, "table": "chats", "op": "update", "chat_ids": [10, 11]}
+
+chat_ids is null when the statement touched more than MAX_CHAT_IDS chats
+(NOTIFY payloads are limited to 8000 bytes); the client then reloads
+everything. Notifications are delivered on commit, so rolled back writes
+are never announced. install() is run by migration 009 and by create_all
+(models.py).
+"""
+from sqlalchemy import text
+
+from counters import statement_triggers
+
+CHANNEL = "koin_changes"
+MAX_CHAT_IDS = 200
+
+# Строки таблицы -> (user_id, chat_id); %1$I — transition table
+CHAT_ROWS = "SELECT user_id, chat_id FROM %1$I"
+# У старых связей user_id может быть пустым — берём арендатора из чата
+LINK_ROWS = """
+    SELECT coalesce(l.user_id, c.user_id) AS user_id, l.chat_id
+    FROM %1$I l LEFT JOIN chats c ON c.chat_id = l.chat_id
+"""
+
+FUNCTIONS = [
+    f"""
+    CREATE OR REPLACE FUNCTION notify_changes_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        parts text[] := '{{}}';
+        r record;
+    BEGIN
+        IF TG_OP <> 'DELETE' THEN parts := parts || format(TG_ARGV[0], 'new_rows'); END IF;
+        IF TG_OP <> 'INSERT' THEN parts := parts || format(TG_ARGV[0], 'old_rows'); END IF;
+        FOR r IN EXECUTE 'SELECT user_id, array_agg(DISTINCT chat_id ORDER BY chat_id) AS chat_ids
+                          FROM (' || array_to_string(parts, ' UNION ALL ') || ') d
+                          WHERE user_id IS NOT NULL
+                          GROUP BY user_id'
+        LOOP
+            PERFORM pg_notify('{CHANNEL}', json_build_object(
+                'user_id', r.user_id,
+                'table', TG_TABLE_NAME,
+                'op', lower(TG_OP),
+                'chat_ids', CASE WHEN cardinality(r.chat_ids) <= {MAX_CHAT_IDS} THEN r.chat_ids END
+            )::text);
+        END LOOP;
+        RETURN NULL;
+    END $$
+    """,
+]
+
+TRIGGERS = [
+    *statement_triggers("chats", "notify_changes_trigger", CHAT_ROWS),
+    *statement_triggers("chat_employees", "notify_changes_trigger", LINK_ROWS),
+]
+
+DROP = [
+    *(statement for statement in TRIGGERS if statement.startswith("DROP")),
+    "DROP FUNCTION IF EXISTS notify_changes_trigger()",
+]
+
+
+def install(connection):
+    for statement in FUNCTIONS + TRIGGERS:
+        connection.execute(text(statement))
+
+
+def uninstall(connection):
+    for statement in DROP:
+        connection.execute(text(statement))
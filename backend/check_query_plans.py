@@ -0,0 +1,116 @@
+"""Query-plan regression check for tenant-scoped queries.
+
+Seeds synthetic tenants into the database at DATABASE_URL inside a
+transaction, runs EXPLAIN on the hot queries of the routers and bot_service
+and fails when one of them reads a large table with a sequential scan. The
+transaction is rolled back, so it can be pointed at a migrated dev database:
+
+    DATABASE_URL=postgresql://... python check_query_plans.py --scale 1
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from sqlalchemy import text
+
+import database
+
+# Таблицы, которые у крупного арендатора вырастают настолько, что Seq Scan по ним — регрессия
+LARGE_TABLES = {"chats", "employees", "chat_employees", "bots"}
+
+SEED = [
+    "INSERT INTO languages (code, name) VALUES ('en', 'English') ON CONFLICT DO NOTHING",
+    """INSERT INTO users (login, email, password_hash, first_name, last_name, language_code, is_active, is_admin, token_version)
+       SELECT 'plancheck_' || g, 'plancheck_' || g || '@example.com', 'x', 'Plan', 'Check', 'en', true, false, 0
+       FROM generate_series(1, :tenants) g""",
+    """INSERT INTO bots (user_id, bot_name, bot_token, is_active, created_at, updated_at)
+       SELECT u.user_id, 'bot ' || g, 'token-' || u.user_id || '-' || g, g % 4 <> 0, now(), now()
+       FROM users u CROSS JOIN generate_series(1, :bots) g WHERE u.login LIKE 'plancheck_%'""",
+    """INSERT INTO chats (bot_id, telegram_chat_id, type_id, status_id, title, user_num, unknown_user, user_id, created_at, updated_at)
+       SELECT b.bot_id, -1000000000000 - b.bot_id * 1000 - g, 1, 1 + g % 3, ARRAY['chat ' || g], g % 50, g % 5, b.user_id, now(), now()
+       FROM bots b JOIN users u ON u.user_id = b.user_id CROSS JOIN generate_series(1, :chats) g
+       WHERE u.login LIKE 'plancheck_%'""",
+    """INSERT INTO employees (full_name, telegram_username, telegram_user_id, is_active, is_external, is_bot, user_id, created_at, updated_at)
+       SELECT 'Employee ' || g, 'plan_user_' || u.user_id || '_' || g, u.user_id * 1000000 + g, true, g % 2 = 0, false, u.user_id, now(), now()
+       FROM users u CROSS JOIN generate_series(1, :employees) g WHERE u.login LIKE 'plancheck_%'""",
+    """INSERT INTO chat_employees (chat_id, employee_id, is_active, is_admin, user_id, created_at, updated_at)
+       SELECT c.chat_id, e.employee_id, true, false, c.user_id, now(), now()
+       FROM chats c JOIN employees e ON e.user_id = c.user_id AND e.employee_id % :chats = c.chat_id % :chats
+       WHERE c.user_id IN (SELECT user_id FROM users WHERE login LIKE 'plancheck_%')""",
+    "ANALYZE users, bots, chats, employees, chat_employees",
+]
+
+# Запросы роутеров и bot_service; :user_id, :chat_id, :employee_id — данные одного синтетического арендатора
+QUERIES = {
+    "chats list page": "SELECT * FROM chats WHERE user_id = :user_id ORDER BY chat_id LIMIT 50",
+    "chats keyset page": "SELECT * FROM chats WHERE user_id = :user_id AND chat_id > :chat_id ORDER BY chat_id LIMIT 50",
+    "chats etag fingerprint": "SELECT count(*), max(updated_at) FROM chats WHERE user_id = :user_id",
+    "chats of bot": "SELECT * FROM chats WHERE bot_id = :bot_id",
+    "employees list page": "SELECT * FROM employees WHERE user_id = :user_id ORDER BY employee_id LIMIT 50",
+    "employee by telegram_user_id": "SELECT * FROM employees WHERE telegram_user_id = :telegram_user_id AND user_id = :user_id",
+    "employee by username": "SELECT * FROM employees WHERE user_id = :user_id AND lower(telegram_username) = lower(:username)",
+    "chat participants": """SELECT * FROM chat_employees ce JOIN employees e ON e.employee_id = ce.employee_id
+                            WHERE ce.chat_id = :chat_id""",
+    "chats of employee": "SELECT * FROM chat_employees WHERE employee_id = :employee_id",
+    "bot_service tenant links": "SELECT * FROM chat_employees WHERE user_id = :user_id",
+    "bot_service tenant bots": "SELECT * FROM bots WHERE is_active = true AND user_id = :user_id",
+    "bots of user": "SELECT * FROM bots WHERE user_id = :user_id",
+}
+
+SAMPLE = text("""
+    SELECT u.user_id, c.chat_id, c.bot_id, e.employee_id, e.telegram_user_id, e.telegram_username AS username
+    FROM users u
+    JOIN chats c ON c.user_id = u.user_id
+    JOIN employees e ON e.user_id = u.user_id
+    WHERE u.login LIKE 'plancheck_%'
+    ORDER BY u.user_id, c.chat_id, e.employee_id
+    LIMIT 1
+""")
+
+
+def seq_scans(plan):
+    """Yield relation names read by Seq Scan anywhere in a JSON plan node."""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+async def check(scale):
+    sizes = {"tenants": 200 * scale, "bots": 5, "chats": 40, "employees": 500}
+    failures = []
+    async with database.engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            for statement in SEED:
+                await conn.execute(text(statement), sizes)
+            sample = (await conn.execute(SAMPLE)).mappings().one()
+            for name, query in QUERIES.items():
+                result = await conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), dict(sample))
+                plan = result.scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scanned = sorted({rel for rel in seq_scans(plan[0]["Plan"]) if rel in LARGE_TABLES})
+                status = "FAIL" if scanned else "ok"
+                print(f"{status:4}  {name}" + (f"  (Seq Scan on {', '.join(scanned)})" if scanned else ""))
+                if scanned:
+                    failures.append(name)
+        finally:
+            await transaction.rollback()
+    await database.engine.dispose()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1, help="Multiplier for the 200 synthetic tenants")
+    args = parser.parse_args()
+    failures = asyncio.run(check(args.scale))
+    if failures:
+        print(f"{len(failures)} queries fall back to a sequential scan")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,9 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")  # В продакшене использовать безопасный ключ
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+# Сколько секунд после ротации старый refresh-токен ещё обменивается (параллельные вкладки), а не считается кражей
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "30"))
 
 # Database settings
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database.db")
@@ -0,0 +1,132 @@
+"""Counters maintained by Postgres triggers.
+
+- chats.active_members: active chat_employees links of the chat;
+- tenant_counters: per-tenant totals, one row per (user_id, name):
+  chats, chats_status:<status_id>, chats_unknown (unknown_user > 0),
+  employees_active, employees_inactive.
+
+The triggers are statement-level with transition tables, so a bulk import
+or batch update adjusts each counter once per statement rather than once
+per row. install() is run by migration 008 and by create_all (models.py).
+"""
+from sqlalchemy import text
+
+# Строки одной таблицы -> (user_id, name, delta); %1$I — transition table, %2$s — знак (+1/-1)
+CHAT_ROWS = """
+    SELECT user_id, unnest(ARRAY['chats', 'chats_status:' || status_id]
+           || CASE WHEN unknown_user > 0 THEN ARRAY['chats_unknown'] ELSE ARRAY[]::text[] END) AS name,
+           %2$s AS delta
+    FROM %1$I
+"""
+EMPLOYEE_ROWS = """
+    SELECT user_id, CASE WHEN is_active THEN 'employees_active' ELSE 'employees_inactive' END AS name,
+           %2$s AS delta
+    FROM %1$I
+"""
+
+# ORDER BY в upsert — счётчики блокируются в одном порядке во всех транзакциях, без взаимных блокировок
+FUNCTIONS = [
+    """
+    CREATE OR REPLACE FUNCTION tenant_counters_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        parts text[] := '{}';
+    BEGIN
+        IF TG_OP <> 'DELETE' THEN parts := parts || format(TG_ARGV[0], 'new_rows', 1); END IF;
+        IF TG_OP <> 'INSERT' THEN parts := parts || format(TG_ARGV[0], 'old_rows', -1); END IF;
+        EXECUTE 'INSERT INTO tenant_counters AS t (user_id, name, value)
+                 SELECT user_id, name, sum(delta) FROM (' || array_to_string(parts, ' UNION ALL ') || ') d
+                 WHERE user_id IS NOT NULL
+                 GROUP BY user_id, name HAVING sum(delta) <> 0
+                 ORDER BY user_id, name
+                 ON CONFLICT (user_id, name) DO UPDATE SET value = t.value + EXCLUDED.value';
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION chat_active_members_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        parts text[] := '{}';
+    BEGIN
+        IF TG_OP <> 'DELETE' THEN parts := parts || 'SELECT chat_id, 1 AS delta FROM new_rows WHERE is_active'::text; END IF;
+        IF TG_OP <> 'INSERT' THEN parts := parts || 'SELECT chat_id, -1 AS delta FROM old_rows WHERE is_active'::text; END IF;
+        EXECUTE 'UPDATE chats c SET active_members = c.active_members + d.delta
+                 FROM (SELECT chat_id, sum(delta) AS delta FROM (' || array_to_string(parts, ' UNION ALL ') || ') x
+                       GROUP BY chat_id HAVING sum(delta) <> 0) d
+                 WHERE c.chat_id = d.chat_id';
+        RETURN NULL;
+    END $$
+    """,
+    # Пересчёт с нуля: backfill при установке и починка, если счётчики разошлись с данными
+    """
+    CREATE OR REPLACE FUNCTION recount_counters() RETURNS void LANGUAGE sql AS $$
+        UPDATE chats c SET active_members = n.active
+        FROM (
+            SELECT c2.chat_id, count(ce.chat_id) AS active
+            FROM chats c2 LEFT JOIN chat_employees ce ON ce.chat_id = c2.chat_id AND ce.is_active
+            GROUP BY c2.chat_id
+        ) n
+        WHERE c.chat_id = n.chat_id AND c.active_members IS DISTINCT FROM n.active;
+        DELETE FROM tenant_counters;
+        INSERT INTO tenant_counters (user_id, name, value)
+        SELECT user_id, name, sum(delta) FROM (
+            SELECT user_id, unnest(ARRAY['chats', 'chats_status:' || status_id]
+                   || CASE WHEN unknown_user > 0 THEN ARRAY['chats_unknown'] ELSE ARRAY[]::text[] END) AS name, 1 AS delta
+            FROM chats
+            UNION ALL
+            SELECT user_id, CASE WHEN is_active THEN 'employees_active' ELSE 'employees_inactive' END, 1
+            FROM employees
+        ) d
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, name;
+    $$
+    """,
+]
+
+
+def _literal(sql: str) -> str:
+    return "'" + sql.replace("'", "''") + "'"
+
+
+def statement_triggers(table: str, function: str, argument: str = ""):
+    args = _literal(argument) if argument else ""
+    events = [
+        ("ins", "INSERT", "REFERENCING NEW TABLE AS new_rows"),
+        ("upd", "UPDATE", "REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows"),
+        ("del", "DELETE", "REFERENCING OLD TABLE AS old_rows"),
+    ]
+    for suffix, event, referencing in events:
+        name = f"{table}_{function.replace('_trigger', '')}_{suffix}"
+        yield f"DROP TRIGGER IF EXISTS {name} ON {table}"
+        yield (f"CREATE TRIGGER {name} AFTER {event} ON {table} {referencing} "
+               f"FOR EACH STATEMENT EXECUTE FUNCTION {function}({args})")
+
+
+TRIGGERS = [
+    *statement_triggers("chats", "tenant_counters_trigger", CHAT_ROWS),
+    *statement_triggers("employees", "tenant_counters_trigger", EMPLOYEE_ROWS),
+    *statement_triggers("chat_employees", "chat_active_members_trigger"),
+]
+
+DROP = [
+    *(statement for statement in TRIGGERS if statement.startswith("DROP")),
+    "DROP FUNCTION IF EXISTS tenant_counters_trigger()",
+    "DROP FUNCTION IF EXISTS chat_active_members_trigger()",
+    "DROP FUNCTION IF EXISTS recount_counters()",
+]
+
+
+def install(connection):
+    """Create the trigger functions and triggers, then recount from the data.
+
+    Takes a lock on the counted tables so no write slips in between the
+    recount and the triggers; run inside the caller's transaction.
+    """
+    connection.execute(text("LOCK TABLE chats, employees, chat_employees IN SHARE ROW EXCLUSIVE MODE"))
+    for statement in FUNCTIONS + TRIGGERS:
+        connection.execute(text(statement))
+    connection.execute(text("SELECT recount_counters()"))
+
+
+def uninstall(connection):
+    for statement in DROP:
+        connection.execute(text(statement))
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from fastapi import Depends, Request
+from sqlalchemy import text
+
+import database
+from metrics import REGISTRY
+from routers.auth import get_current_user
+from schemas import Principal
+
+logger = logging.getLogger(__name__)
+
+# Отставание реплики, при котором чтение уходит на мастер
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+# Как часто перепроверять отставание (результат кэшируется на это время)
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "2"))
+# Сколько секунд после записи пользователь читает с мастера (read-your-writes)
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "10"))
+READ_YOUR_WRITES_COOKIE = "koin_rw"
+# Тот же срок заголовком: фронтенд ходит на API с другого origin без cookie и возвращает его сам.
+# Так признак виден любому воркеру и любой реплике backend, а не только процессу, принявшему запись
+READ_YOUR_WRITES_HEADER = "X-Read-Primary-Until"
+
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+READ_SESSIONS = REGISTRY.counter(
+    "db_read_sessions_total", "Read-only sessions by the database they were routed to", ("target", "reason"))
+
+
+class ReplicaMonitor:
+    """Cached replica lag; unreachable replica counts as infinitely behind."""
+
+    def __init__(self, max_lag: float = REPLICA_MAX_LAG, check_interval: float = REPLICA_LAG_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def current_lag(self) -> float:
+        if time.monotonic() - self._checked_at < self.check_interval and self.lag is not None:
+            return self.lag
+        async with self._lock:
+            # Пока ждали блокировку, значение мог обновить другой запрос
+            if time.monotonic() - self._checked_at < self.check_interval and self.lag is not None:
+                return self.lag
+            try:
+                async with database.read_engine.connect() as conn:
+                    result = await conn.execute(REPLICA_LAG_QUERY)
+                    self.lag = float(result.scalar())
+            except Exception as e:
+                logger.warning(f"Replica lag check failed: {e}")
+                self.lag = float("inf")
+            self._checked_at = time.monotonic()
+            return self.lag
+
+    async def usable(self) -> bool:
+        return await self.current_lag() <= self.max_lag
+
+
+replica_monitor = ReplicaMonitor()
+
+REGISTRY.gauge(
+    "db_replica_lag_seconds", "Last measured replication lag of the read replica (+Inf when unreachable)",
+    callback=lambda: replica_monitor.lag if replica_monitor.lag is not None else float("nan"))
+
+# user_id -> время последней записи в этом процессе; дополняет cookie для клиентов без cookie
+_recent_writers: Dict[int, float] = {}
+
+
+def record_write(request: Request, response):
+    """Called by the middleware after a successful non-GET request."""
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is None:
+        # Неаутентифицированные запросы (логин) данных пользователя не меняют
+        return
+    now = time.monotonic()
+    _recent_writers[user_id] = now
+    if len(_recent_writers) > 10000:
+        for key, ts in list(_recent_writers.items()):
+            if now - ts > READ_YOUR_WRITES_WINDOW:
+                del _recent_writers[key]
+    until = str(int(time.time() + READ_YOUR_WRITES_WINDOW))
+    response.set_cookie(
+        READ_YOUR_WRITES_COOKIE, until,
+        max_age=int(READ_YOUR_WRITES_WINDOW) + 1, httponly=True, samesite="lax")
+    response.headers[READ_YOUR_WRITES_HEADER] = until
+
+
+def _until_valid(value: Optional[str]) -> bool:
+    # Срок дальше окна — подделка или старые часы; мастер навсегда так не закрепить
+    if not value or not value.isdigit():
+        return False
+    now = time.time()
+    return now < int(value) <= now + READ_YOUR_WRITES_WINDOW + 1
+
+
+def wrote_recently(request: Request, user_id: Optional[int]) -> bool:
+    if (_until_valid(request.headers.get(READ_YOUR_WRITES_HEADER))
+            or _until_valid(request.cookies.get(READ_YOUR_WRITES_COOKIE))):
+        return True
+    written_at = _recent_writers.get(user_id) if user_id is not None else None
+    return written_at is not None and time.monotonic() - written_at < READ_YOUR_WRITES_WINDOW
+
+
+async def read_session(request: Request, user_id: Optional[int]):
+    if database.ReadSessionLocal is None:
+        target, reason = "primary", "no_replica"
+    elif wrote_recently(request, user_id):
+        target, reason = "primary", "read_your_writes"
+    elif not await replica_monitor.usable():
+        target, reason = "primary", "lag"
+    else:
+        target, reason = "replica", "ok"
+    READ_SESSIONS.inc(target, reason)
+    factory = database.ReadSessionLocal if target == "replica" else database.SessionLocal
+    async with factory() as db:
+        yield db
+
+
+async def get_read_db(request: Request, current_user: Principal = Depends(get_current_user)):
+    """Session for GET handlers of user data: replica unless the user has just written."""
+    async for db in read_session(request, current_user.user_id):
+        yield db
+
+
+async def get_reference_db(request: Request):
+    """Session for unauthenticated reads of reference tables."""
+    async for db in read_session(request, None):
+        yield db
@@ -0,0 +1,48 @@
+import hashlib
+from typing import Optional
+
+from fastapi import Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Ответ всегда перепроверяется, но при совпадении ETag приходит пустой 304
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Сравнение слабое: W/"x" и "x" совпадают
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+async def check_etag(request: Request, response: Response, db: AsyncSession, fingerprint, *scope) -> Optional[Response]:
+    """Compute the ETag of a scope from a one-row fingerprint query.
+
+    fingerprint is a select returning a single row of aggregates (row count,
+    max(updated_at), ...) over the rows the endpoint would return. Returns a
+    304 response when the client's copy is current, otherwise sets ETag on
+    response and returns None.
+    """
+    result = await db.execute(fingerprint)
+    row = result.one()
+    query = sorted(request.query_params.multi_items())
+    etag = make_etag(request.url.path, query, *scope, *row)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
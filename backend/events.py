@@ -0,0 +1,188 @@
+"""Fan-out of database change notifications to the push channel.
+
+Each backend process keeps one LISTEN connection (outside the SQLAlchemy
+pool) on change_feed.CHANNEL and hands every notification to the
+subscriptions of its tenant. A subscription is a bounded queue per open
+stream: when a client reads slower than changes arrive, its queue is
+dropped and replaced by a single "resync" event, so a stuck connection
+costs at most EVENTS_QUEUE_SIZE events of memory and never slows down
+the listener or other clients.
+
+Other modules can receive their own channels over the same connection
+(EventHub.listen), e.g. principal cache invalidations.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import asyncpg
+
+from change_feed import CHANNEL
+from database import DATABASE_URL, DB_CONNECT_BACKOFF, DB_CONNECT_BACKOFF_MAX, DB_READY_TIMEOUT, async_url
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Сколько событий может ждать в очереди одного соединения, прежде чем оно получит resync
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+# Открытых потоков на пользователя в одном процессе (вкладки браузера)
+EVENTS_MAX_PER_USER = int(os.getenv("EVENTS_MAX_PER_USER", "10"))
+# Период проверки LISTEN-соединения и комментариев-пингов в потоке
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+
+RESYNC = {"type": "resync"}
+
+NOTIFICATIONS = REGISTRY.counter("events_notifications_total", "Change notifications received from the database")
+DELIVERED = REGISTRY.counter("events_delivered_total", "Events queued to subscribers")
+OVERFLOWS = REGISTRY.counter("events_overflows_total", "Subscriber queues dropped because the client fell behind")
+RECONNECTS = REGISTRY.counter("events_listener_reconnects_total", "LISTEN connection losses")
+
+
+def listen_dsn(url: str = DATABASE_URL) -> str:
+    # asyncpg.connect понимает только postgresql://
+    return "postgresql://" + async_url(url)[len("postgresql+asyncpg://"):]
+
+
+class Subscription:
+    def __init__(self, user_id: int, size: int = EVENTS_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.overflowed = False
+
+    def offer(self, event: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Клиент не успевает: вместо хвоста изменений он перечитает всё по одному resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            self.overflowed = True
+            OVERFLOWS.inc()
+            return
+        DELIVERED.inc()
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """Next event, or None when nothing arrived within timeout."""
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event is RESYNC:
+            self.overflowed = False
+        return event
+
+
+class EventHub:
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn
+        self.subscribers: Dict[int, Set[Subscription]] = {}
+        self.connected = False
+        self._task: Optional[asyncio.Task] = None
+        # Дополнительные каналы: channel -> (обработчик payload, вызов после каждого подключения)
+        self.channels: Dict[str, Tuple[Callable[[str], None], Optional[Callable[[], None]]]] = {}
+
+    def count(self, user_id: int) -> int:
+        return len(self.subscribers.get(user_id, ()))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+
+    def listen(self, channel: str, callback: Callable[[str], None], on_connect: Optional[Callable[[], None]] = None):
+        """Deliver the payloads of another channel to callback and keep the connection open.
+
+        on_connect is called every time the connection is (re)established,
+        since notifications sent while it was down are lost.
+        """
+        self.channels[channel] = (callback, on_connect)
+        self.start()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        # LISTEN-соединение открывается с первым подписчиком процесса (или с listen)
+        self.start()
+        subscription = Subscription(user_id)
+        self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscribers.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscribers[subscription.user_id]
+
+    def publish(self, user_id: int, event: dict):
+        for subscription in list(self.subscribers.get(user_id, ())):
+            subscription.offer(event)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        NOTIFICATIONS.inc()
+        try:
+            event = json.loads(payload)
+            user_id = event.pop("user_id")
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Malformed change notification {payload!r}: {e}")
+            return
+        self.publish(user_id, {"type": "change", **event})
+
+    @staticmethod
+    def _channel_listener(callback):
+        def on_notify(connection, pid, channel, payload):
+            callback(payload)
+        return on_notify
+
+    async def _listen(self):
+        delay = DB_CONNECT_BACKOFF
+        reconnect = False
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn or listen_dsn(), timeout=DB_READY_TIMEOUT)
+                await connection.add_listener(CHANNEL, self._on_notify)
+                for channel, (callback, _) in self.channels.items():
+                    await connection.add_listener(channel, self._channel_listener(callback))
+                self.connected = True
+                delay = DB_CONNECT_BACKOFF
+                if reconnect:
+                    # Пока соединения не было, уведомления терялись
+                    for user_id in list(self.subscribers):
+                        self.publish(user_id, RESYNC)
+                for _, on_connect in self.channels.values():
+                    if on_connect is not None:
+                        on_connect()
+                # Обрыв соединения без трафика сам не проявится — проверяем его
+                while True:
+                    await asyncio.sleep(EVENTS_HEARTBEAT)
+                    await connection.fetchval("SELECT 1", timeout=DB_READY_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                RECONNECTS.inc()
+                logger.warning(f"Change listener connection lost ({e!r}). Reconnecting in {delay:.1f} seconds...")
+            finally:
+                self.connected = False
+                if connection is not None:
+                    connection.terminate()
+            reconnect = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_BACKOFF_MAX)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+hub = EventHub()
+
+REGISTRY.gauge(
+    "events_subscribers", "Open change streams in this process",
+    callback=lambda: sum(len(subscriptions) for subscriptions in hub.subscribers.values()))
+REGISTRY.gauge("events_listener_connected", "1 while the LISTEN connection is up", callback=lambda: int(hub.connected))
@@ -0,0 +1,91 @@
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Optional
+
+from fastapi import Query, Request
+from fastapi.responses import StreamingResponse
+
+from db_routing import read_session
+
+# Сколько строк забирать с серверного курсора за раз и сколько копить в один кусок ответа
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class ExportParams:
+    def __init__(
+        self,
+        fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+        gzip: bool = Query(False, description="Return a .gz file"),
+    ):
+        self.fmt = fmt
+        self.gzip = gzip
+
+
+def _csv_value(value):
+    if isinstance(value, list):
+        return "; ".join(str(v) for v in value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _render(rows, columns, fmt, header=False) -> str:
+    out = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(columns)
+        writer.writerows([_csv_value(v) for v in row] for row in rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), default=_json_default, ensure_ascii=False))
+            out.write("\n")
+    return out.getvalue()
+
+
+async def stream_rows(request: Request, user_id: Optional[int], stmt, columns, fmt: str, compress: bool):
+    """Yield the export body chunk by chunk.
+
+    The statement runs on its own session (replica when possible) through a
+    server-side cursor, so at most EXPORT_FETCH_SIZE rows are held in memory.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31 — формат gzip
+
+    def encode(text: str) -> bytes:
+        data = text.encode("utf-8")
+        return compressor.compress(data) if compressor else data
+
+    if fmt == "csv":
+        yield encode(_render([], columns, fmt, header=True))
+    async for db in read_session(request, user_id):
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_FETCH_SIZE))
+        async for partition in result.partitions():
+            chunk = encode(_render(partition, columns, fmt))
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def export_response(request: Request, user_id: Optional[int], stmt, params: ExportParams, name: str) -> StreamingResponse:
+    columns = [column.key for column in stmt.selected_columns]
+    filename = f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{params.fmt}"
+    media_type = MEDIA_TYPES[params.fmt]
+    if params.gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        stream_rows(request, user_id, stmt, columns, params.fmt, params.gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
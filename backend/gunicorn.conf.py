@@ -0,0 +1,78 @@
+"""Gunicorn settings for the production server mode.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Runs WEB_CONCURRENCY uvicorn workers (uvloop + httptools when installed).
+Each worker has its own SQLAlchemy pools and a LISTEN connection, so the
+per-worker pool size is derived from DB_CONNECTION_BUDGET unless DB_POOL_SIZE
+is set explicitly; the worker count is reduced when the budget cannot give
+every worker a minimal pool, and an explicit pool that does not fit fails
+the start.
+"""
+import multiprocessing
+import os
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Перезапуск воркера после max_requests (± jitter, чтобы не все сразу) — защита от утечек памяти
+max_requests = int(os.getenv("MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+# Сколько ждать завершения текущих запросов при перезапуске/остановке воркера
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+# Лимит соединений одного контейнера к мастеру; делится между воркерами.
+# Сумма по всем репликам backend и bot_service должна оставаться ниже max_connections Postgres.
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "40"))
+# Кроме пула каждый воркер держит к мастеру LISTEN-соединение (events.py).
+# Пул реплики того же размера идёт к другому серверу и в этот бюджет не входит, но укладывается в такой же
+LISTEN_CONNECTIONS = 1
+MIN_POOL_PER_WORKER = 2
+
+budget_note = None
+if "DB_POOL_SIZE" not in os.environ:
+    # Больше воркеров, чем бюджет позволяет дать каждому минимальный пул, не запускаем
+    max_workers = DB_CONNECTION_BUDGET // (MIN_POOL_PER_WORKER + LISTEN_CONNECTIONS)
+    if max_workers < 1:
+        raise RuntimeError(
+            f"DB_CONNECTION_BUDGET={DB_CONNECTION_BUDGET} is too small for one worker "
+            f"({MIN_POOL_PER_WORKER} pooled + {LISTEN_CONNECTIONS} LISTEN connections)")
+    if workers > max_workers:
+        budget_note = f"WEB_CONCURRENCY={workers} reduced to {max_workers} to fit DB_CONNECTION_BUDGET={DB_CONNECTION_BUDGET}"
+        workers = max_workers
+    per_worker = DB_CONNECTION_BUDGET // workers - LISTEN_CONNECTIONS
+    # Воркеры наследуют окружение мастера, database.py прочитает эти значения
+    os.environ["DB_POOL_SIZE"] = str(max(1, per_worker * 2 // 3))
+    os.environ["DB_MAX_OVERFLOW"] = str(per_worker - int(os.environ["DB_POOL_SIZE"]))
+else:
+    # Пул задан явно — проверяем, что он укладывается в бюджет, а не молча превышаем его
+    per_worker = int(os.environ["DB_POOL_SIZE"]) + int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    if workers * (per_worker + LISTEN_CONNECTIONS) > DB_CONNECTION_BUDGET:
+        raise RuntimeError(
+            f"{workers} workers x ({per_worker} pooled + {LISTEN_CONNECTIONS} LISTEN) connections "
+            f"exceed DB_CONNECTION_BUDGET={DB_CONNECTION_BUDGET}; lower WEB_CONCURRENCY or the pool size")
+
+# Каталог снимков метрик: /metrics любого воркера отдаёт сумму по всем (metrics.render_all)
+METRICS_DIR = os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "koin-metrics"))
+
+
+def on_starting(server):
+    # Импорт после установки METRICS_DIR: воркеры унаследуют уже загруженный модуль
+    import metrics
+    metrics.reset_directory(METRICS_DIR)
+    if budget_note:
+        server.log.warning(budget_note)
+    server.log.info(
+        f"{workers} workers, DB pool per worker: "
+        f"{os.environ['DB_POOL_SIZE']} + {os.environ.get('DB_MAX_OVERFLOW', '10')} overflow + {LISTEN_CONNECTIONS} LISTEN"
+    )
+
+
+def child_exit(server, worker):
+    # Счётчики завершённого воркера остаются в сумме, его gauge пропадают
+    import metrics
+    metrics.retire_worker(worker.pid, METRICS_DIR)
@@ -1,19 +1,82 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import asyncio
+import os
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from routers import auth as auth_router, admin as admin_router, bots as bots_router
 from routers.chats import router as chats_router
 from routers.chat_types import router as chat_types_router
 from routers.chat_statuses import router as chat_statuses_router
 from routers.employees import router as employees_router
+from routers.dashboard import router as dashboard_router
+from routers.events import router as events_router
 import models
 import database
+from events import hub as event_hub
+from principal_cache import INVALIDATION_CHANNEL, PRINCIPAL_CACHE_TTL, on_invalidation, principal_cache
+from db_routing import record_write
+from admission import AdmissionControl
+from timing import RequestTiming, instrument_routes
+import metrics as metrics_registry
 import logging
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="KoinSera Backend API")
+# Создавать таблицы из моделей при старте — только для локальной разработки;
+# в docker-compose схему готовит сервис backend-migrate (migrate.py / alembic)
+DB_CREATE_ALL = os.getenv("DB_CREATE_ALL", "0") == "1"
+
+async def flush_metrics():
+    # Снимок метрик воркера для /metrics остальных воркеров (metrics.render_all)
+    while True:
+        try:
+            metrics_registry.REGISTRY.write_snapshot()
+        except OSError as e:
+            logger.warning(f"Failed to write metrics snapshot: {e}")
+        await asyncio.sleep(metrics_registry.METRICS_FLUSH_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Не ждём базу до начала обслуживания: соединение прогревается в фоне, /ready покажет готовность
+    warmup = None
+    if DB_CREATE_ALL:
+        await database.wait_for_db()
+        async with database.engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+    else:
+        warmup = asyncio.create_task(database.wait_for_db())
+    flush = asyncio.create_task(flush_metrics()) if metrics_registry.METRICS_DIR else None
+    if PRINCIPAL_CACHE_TTL > 0:
+        # Изменения пользователей из других процессов; пропущенные за время обрыва — сбросом всего кэша
+        event_hub.listen(INVALIDATION_CHANNEL, on_invalidation, on_connect=principal_cache.clear)
+    yield
+    if warmup is not None:
+        warmup.cancel()
+    if flush is not None:
+        flush.cancel()
+        # Последние значения воркера достанутся мастеру gunicorn (retire_worker)
+        metrics_registry.REGISTRY.write_snapshot()
+    await event_hub.stop()
+    await database.dispose_engines()
+
+app = FastAPI(title="KoinSera Backend API", lifespan=lifespan)
+
+@app.exception_handler(database.PoolTimeoutError)
+@app.exception_handler(database.OperationalError)
+async def database_unavailable(request: Request, exc: Exception):
+    # Все соединения пула заняты дольше DB_POOL_TIMEOUT или база недоступна: отвечаем сразу, клиент может повторить
+    logger.warning(f"Database unavailable on {request.method} {request.url.path}: {exc.__class__.__name__}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Database is busy, try again later"},
+        headers={"Retry-After": "1"},
+    )
+
+# Ограничение частоты и числа одновременных запросов; добавлен раньше CORS, чтобы 429/503 шли с CORS-заголовками
+app.add_middleware(AdmissionControl)
 
 # CORS middleware configuration
 app.add_middleware(
@@ -25,8 +88,16 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
-# Create database tables
-models.Base.metadata.create_all(bind=database.engine)
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+    # После успешной записи пользователь какое-то время читает с мастера
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        record_write(request, response)
+    return response
+
+# Самый внешний слой: Server-Timing и гистограммы по маршрутам учитывают все остальные middleware
+app.add_middleware(RequestTiming)
 
 app.include_router(auth_router.router, prefix="/api")
 app.include_router(admin_router.router, prefix="/api")
@@ -35,8 +106,26 @@ app.include_router(chats_router, prefix="/api")
 app.include_router(chat_types_router, prefix="/api")
 app.include_router(chat_statuses_router, prefix="/api")
 app.include_router(employees_router, prefix="/api")
+app.include_router(dashboard_router, prefix="/api")
+app.include_router(events_router, prefix="/api")
+instrument_routes(app)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(metrics_registry.render_all())
 
 @app.get("/health")
 def health_check():
-    """Проверка работоспособности сервера"""
-    return {"status": "healthy"} 
+    """Проверка работоспособности сервера (liveness): база не опрашивается"""
+    return {"status": "healthy"}
+
+@app.get("/ready")
+async def readiness_check():
+    """Готовность принимать трафик (readiness): мастер отвечает на SELECT 1"""
+    try:
+        await database.ping()
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {e!r}")
+        return JSONResponse(status_code=503, content={"status": "unavailable", "database": "unreachable"})
+    return {"status": "ready"}
+
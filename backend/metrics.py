@@ -0,0 +1,308 @@
+"""Prometheus text-format metrics without external dependencies.
+
+Under gunicorn every worker has its own REGISTRY. With METRICS_DIR set each
+worker writes a snapshot of it to METRICS_DIR/<pid>.json (every
+METRICS_FLUSH_INTERVAL seconds and before rendering), and /metrics of any
+worker renders all snapshots merged: counters and histograms are summed,
+gauges keep one series per worker with a "worker" label. The gunicorn master
+folds the counters of an exited worker into a retired file, so totals do
+not drop when workers are recycled.
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Общий каталог снимков воркеров gunicorn; без него /metrics показывает только свой процесс
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+RETIRED_SNAPSHOT = "retired.json"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {labels}")
+        return tuple(str(v) for v in labels)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [('', key, (), value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Gauge set explicitly, or computed at scrape time by callback.
+
+    The callback returns a number for an unlabelled gauge, or a dict mapping
+    label tuples to numbers.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.callback = callback
+
+    def set(self, value, *labels):
+        self.values[self._key(labels)] = value
+
+    def current(self):
+        if self.callback is None:
+            return self.values
+        try:
+            result = self.callback()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} callback failed: {e}")
+            return {}
+        if isinstance(result, dict):
+            return {self._key(k if isinstance(k, tuple) else (k,)): v for k, v in result.items()}
+        return {(): result}
+
+    def samples(self):
+        return [('', key, (), value) for key, value in self.current().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        result = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                result.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            result.append(('_bucket', key, (('le', '+Inf'),), state[-1]))
+            result.append(('_sum', key, (), state[-2]))
+            result.append(('_count', key, (), state[-1]))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    @classmethod
+    def _of(cls, metrics):
+        registry = cls()
+        registry.metrics = metrics
+        return registry
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+    def snapshot(self):
+        result = {}
+        for metric in self.metrics.values():
+            values = metric.current() if isinstance(metric, Gauge) else metric.values
+            result[metric.name] = {
+                'kind': metric.kind,
+                'documentation': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'values': [[list(key), value] for key, value in values.items()],
+            }
+        return result
+
+    def write_snapshot(self, directory=None):
+        directory = directory or METRICS_DIR
+        if directory:
+            _write_json(os.path.join(directory, f"{os.getpid()}.json"), self.snapshot())
+
+
+def _write_json(path, data):
+    # Через rename: читающий воркер не увидит наполовину записанный файл
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Skipping unreadable metrics snapshot {path}: {e}")
+        return None
+
+
+def _merge(merged, snapshot, worker=None):
+    """Add a snapshot into a name -> Metric dict; gauges get a worker label."""
+    for name, data in snapshot.items():
+        gauge = data['kind'] == 'gauge'
+        if gauge and worker is None:
+            continue
+        metric = merged.get(name)
+        if metric is None:
+            labelnames = data['labelnames'] + (['worker'] if gauge else [])
+            if data['kind'] == 'histogram':
+                metric = Histogram(name, data['documentation'], labelnames, data['buckets'])
+            elif data['kind'] == 'counter':
+                metric = Counter(name, data['documentation'], labelnames)
+            else:
+                metric = Gauge(name, data['documentation'], labelnames)
+            merged[name] = metric
+        for labels, value in data['values']:
+            key = tuple(labels) + ((worker,) if gauge else ())
+            if gauge:
+                metric.values[key] = value
+            elif isinstance(metric, Histogram):
+                state = metric.values.get(key)
+                if state is None:
+                    metric.values[key] = list(value)
+                elif len(state) == len(value):
+                    metric.values[key] = [a + b for a, b in zip(state, value)]
+            else:
+                metric.values[key] = metric.values.get(key, 0) + value
+    return merged
+
+
+def render_all(directory=None):
+    """Render the merged snapshots of all workers sharing the directory."""
+    directory = directory or METRICS_DIR
+    if not directory:
+        return REGISTRY.render()
+    REGISTRY.write_snapshot(directory)
+    merged = {}
+    # Сначала итог завершённых воркеров, потом файлы живых: уже учтённый файл пропускается
+    retired = _read_json(os.path.join(directory, RETIRED_SNAPSHOT)) or {'folded': [], 'metrics': {}}
+    _merge(merged, retired['metrics'])
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        pid = os.path.basename(path)[:-len('.json')]
+        if pid.isdigit() and int(pid) not in retired['folded']:
+            snapshot = _read_json(path)
+            if snapshot:
+                _merge(merged, snapshot, worker=pid)
+    return '\n'.join(metric.render() for metric in merged.values()) + '\n'
+
+
+def retire_worker(pid, directory=None):
+    """Fold counters and histograms of an exited worker into the retired snapshot.
+
+    Called by the gunicorn master only, so the retired file has one writer.
+    The worker's own file is removed on the next call, so a concurrent
+    render_all sees it either in the retired snapshot or on its own.
+    """
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+    retired = _read_json(retired_path) or {'folded': [], 'metrics': {}}
+    for folded in retired['folded']:
+        try:
+            os.remove(os.path.join(directory, f"{folded}.json"))
+        except FileNotFoundError:
+            pass
+    merged = _merge({}, retired['metrics'])
+    snapshot = _read_json(os.path.join(directory, f"{pid}.json"))
+    if snapshot:
+        _merge(merged, snapshot)
+    _write_json(retired_path, {'folded': [pid], 'metrics': Registry._of(merged).snapshot()})
+
+
+def reset_directory(directory=None):
+    """Start with an empty snapshot directory (gunicorn master on start)."""
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')) + glob.glob(os.path.join(directory, '*.tmp')):
+        os.remove(path)
+
+
+REGISTRY = Registry()
@@ -0,0 +1,50 @@
+"""Bring the database schema up to date before the API workers start.
+
+Run once per deploy (the backend-migrate service in docker-compose):
+
+    DATABASE_URL=postgresql://... python migrate.py
+
+The early Alembic revisions predate most tables, which used to be created by
+create_all on every backend start. So:
+- empty database: create the current schema from the models and stamp head;
+- database created by create_all (no alembic_version table): stamp 004,
+  the last revision such databases match, then upgrade;
+- otherwise: alembic upgrade head.
+"""
+import logging
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect
+
+import models
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("migrate")
+
+LEGACY_REVISION = "004"
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    config = Config(os.path.join(here, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(here, "alembic"))
+    engine = create_engine(os.environ["DATABASE_URL"])
+    try:
+        tables = set(inspect(engine).get_table_names())
+        if "alembic_version" not in tables:
+            if "users" not in tables:
+                logger.info("Empty database: creating schema from models")
+                models.Base.metadata.create_all(engine)
+                command.stamp(config, "head")
+                return
+            logger.info(f"Database without migration history: stamping {LEGACY_REVISION}")
+            command.stamp(config, LEGACY_REVISION)
+        command.upgrade(config, "head")
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, func
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index, func, text, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from security import get_password_hash, verify_password
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy import BigInteger
+import counters
+import change_feed
 
 Base = declarative_base()
 
@@ -26,6 +28,8 @@ class User(Base):
     last_login = Column(DateTime)
     failed_login_attempts = Column(Integer, default=0)
     locked_until = Column(DateTime)
+    # Увеличивается при смене пароля; токены со старой версией больше не принимаются
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
 
     bots = relationship("Bot", back_populates="user")
 
@@ -51,6 +55,19 @@ class User(Base):
             return True
         return False
 
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    token_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False, index=True)
+    # sha256 от самого токена; сам токен в базе не хранится
+    token_hash = Column(String(64), unique=True, nullable=False, index=True)
+    # Все токены, полученные ротацией от одного входа; при повторном использовании отзываются разом
+    family_id = Column(String(32), nullable=False, index=True)
+    created_at = Column(DateTime, default=func.now())
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime)
+
 class Language(Base):
     __tablename__ = "languages"
 
@@ -73,6 +90,12 @@ class Bot(Base):
 
     user = relationship("User", back_populates="bots")
 
+    # Индексы совпадают с миграцией 007
+    __table_args__ = (
+        Index('ix_bots_user_id', 'user_id'),
+        Index('ix_bots_active_user_id', 'user_id', postgresql_where=text('is_active')),
+    )
+
 class Chat(Base):
     __tablename__ = "chats"
 
@@ -87,10 +110,17 @@ class Chat(Base):
     user_num = Column(Integer, default=0)
     unknown_user = Column(Integer, default=0)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=True)
+    # Число активных связей chat_employees; ведётся триггером (counters.py), из приложения не пишется
+    active_members = Column(Integer, nullable=False, server_default='0')
 
     bot = relationship("Bot")
     user = relationship("User")
 
+    __table_args__ = (
+        Index('ix_chats_user_id_chat_id', 'user_id', 'chat_id'),
+        Index('ix_chats_bot_id', 'bot_id'),
+    )
+
 class ChatType(Base):
     __tablename__ = "chat_types"
     type_id = Column(Integer, primary_key=True, index=True)
@@ -114,6 +144,14 @@ class Employee(Base):
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=True)
     is_bot = Column(Boolean, default=False)
 
+    __table_args__ = (
+        Index('ix_employees_user_id_employee_id', 'user_id', 'employee_id'),
+        Index('ix_employees_user_id_telegram_user_id', 'user_id', 'telegram_user_id',
+              postgresql_where=text('telegram_user_id IS NOT NULL')),
+        Index('ix_employees_user_id_username', 'user_id', text('lower(telegram_username)'),
+              postgresql_where=text('telegram_username IS NOT NULL')),
+    )
+
 class ChatEmployee(Base):
     __tablename__ = "chat_employees"
     chat_id = Column(BigInteger, ForeignKey('chats.chat_id'), primary_key=True)
@@ -127,3 +165,23 @@ class ChatEmployee(Base):
     # Relationships (optional, for easier joins)
     employee = relationship("Employee")
     chat = relationship("Chat")
+
+    __table_args__ = (
+        Index('ix_chat_employees_employee_id', 'employee_id'),
+        Index('ix_chat_employees_user_id', 'user_id'),
+    )
+
+class TenantCounter(Base):
+    """Per-tenant totals maintained by triggers, see counters.py."""
+    __tablename__ = "tenant_counters"
+    user_id = Column(Integer, ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    name = Column(String(50), primary_key=True)
+    value = Column(BigInteger, nullable=False, server_default='0')
+
+@event.listens_for(Base.metadata, "after_create")
+def install_triggers(target, connection, tables=(), **kw):
+    # create_all не создаёт триггеры; при миграциях это делают ревизии 008 и 009
+    if TenantCounter.__table__ in tables:
+        counters.install(connection)
+    if Chat.__table__ in tables:
+        change_feed.install(connection)
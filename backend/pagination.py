@@ -0,0 +1,142 @@
+import base64
+import json
+from datetime import datetime
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Query, Response
+from sqlalchemy import and_, func, literal, or_, select, text, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+MAX_PAGE_SIZE = 500
+# Ниже этой оценки планировщика считаем точный count(*) — на малых выборках это дёшево,
+# а оценка по статистике там самая неточная
+EXACT_COUNT_BELOW = 10000
+
+
+class PageParams:
+    """Common query parameters of list endpoints.
+
+    Without limit the whole (filtered, sorted) list is returned as before; with
+    limit the next page is requested by passing X-Next-Cursor back as cursor.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = Query(None),
+        sort: Optional[str] = Query(None, description="Sort field, '-' prefix for descending"),
+        with_total: bool = Query(False, description="Return an estimated row count in X-Total-Count"),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.sort = sort
+        self.with_total = with_total
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def encode_cursor(sort: str, values: list) -> str:
+    raw = json.dumps([sort, values], default=lambda v: v.isoformat(), separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, keys: list) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, values = json.loads(raw)
+        if cursor_sort != sort or len(values) != len(keys):
+            raise ValueError("cursor does not match sort")
+        result = []
+        for key, value in zip(keys, values):
+            python_type = key.type.python_type
+            if value is None and key.nullable:
+                result.append(None)
+            else:
+                result.append(datetime.fromisoformat(value) if python_type is datetime else python_type(value))
+        return result
+    except (ValueError, TypeError, json.JSONDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def parse_sort(sort: str, fields: Dict[str, object]):
+    desc = sort.startswith("-")
+    name = sort.lstrip("-+")
+    if name not in fields:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by '{name}', allowed: {', '.join(fields)}")
+    return name, desc
+
+
+async def estimate_count(db: AsyncSession, stmt) -> int:
+    # Оценка из EXPLAIN вместо count(*) по всей выборке
+    compiled = stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    result = await db.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]["Plan"]["Plan Rows"])
+    if estimate < EXACT_COUNT_BELOW:
+        result = await db.execute(select(func.count()).select_from(stmt.order_by(None).subquery()))
+        return result.scalar()
+    return estimate
+
+
+def keyset_after(keys: list, values: list, desc: bool):
+    """Condition for rows after the cursor values in (sort column, pk) order."""
+    def after(ks, vs):
+        bound = tuple_(*(literal(v, k.type) for k, v in zip(ks, vs)))
+        return tuple_(*ks) < bound if desc else tuple_(*ks) > bound
+
+    if len(keys) == 1 or not keys[0].nullable:
+        return after(keys, values)
+    # Сравнение кортежей с NULL даёт NULL — группу NULL (в конце по возрастанию, в начале по убыванию) разбираем отдельно
+    column, pk = keys
+    if values[0] is None:
+        within_nulls = and_(column.is_(None), after([pk], values[1:]))
+        return or_(within_nulls, column.is_not(None)) if desc else within_nulls
+    if desc:
+        return and_(column.is_not(None), after(keys, values))
+    return or_(column.is_(None), after(keys, values))
+
+
+async def paginate(
+    db: AsyncSession,
+    stmt,
+    response: Response,
+    params: PageParams,
+    sort_fields: Dict[str, object],
+    pk,
+    default_sort: str,
+):
+    """Apply keyset ordering/cursor/limit to a select of one entity and run it.
+
+    Rows are ordered by (sort column, primary key), so pages stay stable while
+    rows are inserted or deleted. NULLs of a nullable sort column go last
+    ascending and first descending, as Postgres orders them by default.
+    """
+    sort = params.sort or default_sort
+    name, desc = parse_sort(sort, sort_fields)
+    column = sort_fields[name]
+    keys = [pk] if column is pk else [column, pk]
+
+    if params.with_total:
+        response.headers["X-Total-Count"] = str(await estimate_count(db, stmt))
+
+    if params.cursor:
+        values = decode_cursor(params.cursor, sort, keys)
+        stmt = stmt.where(keyset_after(keys, values, desc))
+    if len(keys) > 1 and column.nullable:
+        stmt = stmt.order_by(column.desc().nulls_first() if desc else column.asc().nulls_last(), pk.desc() if desc else pk.asc())
+    else:
+        stmt = stmt.order_by(*(k.desc() if desc else k.asc() for k in keys))
+    if params.limit:
+        stmt = stmt.limit(params.limit + 1)
+
+    result = await db.execute(stmt)
+    rows = result.scalars().all()
+    if params.limit and len(rows) > params.limit:
+        rows = rows[:params.limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(sort, [getattr(rows[-1], k.key) for k in keys])
+    return rows
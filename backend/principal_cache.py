@@ -0,0 +1,87 @@
+import os
+import time
+import threading
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import Principal
+
+# Сколько секунд можно доверять закэшированному пользователю без похода в БД.
+# Другие процессы узнают об изменении is_active/is_admin через NOTIFY (broadcast_invalidation);
+# TTL ограничивает устаревание, пока LISTEN-соединение процесса недоступно.
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+class PrincipalCache:
+    """In-process cache of authenticated users keyed by token subject.
+
+    An entry is only returned for the token version it was stored with and
+    never outlives the token that produced it.
+    """
+
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL, max_size: int = PRINCIPAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: Dict[str, Tuple[int, float, Principal]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, login: str, version: int) -> Optional[Principal]:
+        entry = self._entries.get(login)
+        if entry is None:
+            return None
+        entry_version, expires_at, principal = entry
+        if entry_version != version or expires_at <= time.monotonic():
+            return None
+        return principal
+
+    def put(self, principal: Principal, token_exp: Optional[float] = None):
+        if self.ttl <= 0:
+            return
+        ttl = self.ttl
+        if token_exp is not None:
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_size and principal.login not in self._entries:
+                self._evict()
+            self._entries[principal.login] = (principal.token_version, time.monotonic() + ttl, principal)
+
+    def invalidate(self, login: str):
+        with self._lock:
+            self._entries.pop(login, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [login for login, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        for login in expired:
+            del self._entries[login]
+        if len(self._entries) >= self.max_size:
+            # Всё живое — выкидываем самую старую запись (dict хранит порядок вставки)
+            del self._entries[next(iter(self._entries))]
+
+
+principal_cache = PrincipalCache()
+
+# Канал NOTIFY с логином изменённого пользователя; слушает EventHub каждого процесса (main.py)
+INVALIDATION_CHANNEL = "koin_principals"
+
+
+async def broadcast_invalidation(db: AsyncSession, login: str):
+    """Tell every backend process to drop the cached user.
+
+    Call before db.commit(): Postgres delivers the notification on commit,
+    so it is never seen before the change and is dropped with a rollback.
+    """
+    await db.execute(text("SELECT pg_notify(:channel, :login)"), {"channel": INVALIDATION_CHANNEL, "login": login})
+
+
+def on_invalidation(login: str):
+    principal_cache.invalidate(login)
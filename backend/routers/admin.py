@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 import logging
 from database import get_db
-from models import User
+from db_routing import get_read_db
+from models import User, RefreshToken
 from schemas import UserResponse
-from routers.auth import get_current_user
-from security import get_password_hash
+from routers.auth import get_current_user, issue_refresh_token, revoke_refresh_tokens, token_response
+from security import hash_password
+from principal_cache import broadcast_invalidation, principal_cache
+from pagination import PageParams, paginate
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -46,36 +50,39 @@ class UserUpdate(BaseModel):
     language_code: Optional[str] = None
 
 async def get_admin_user(current_user: User = Depends(get_current_user)):
-    logger.info(f"Checking admin access for user: {current_user.login}")
     if not current_user.is_admin:
         logger.warning(f"User {current_user.login} is not an admin")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not enough permissions"
         )
-    logger.info(f"Admin access granted for user: {current_user.login}")
     return current_user
 
+USER_SORT_FIELDS = {
+    "user_id": User.user_id,
+    "login": User.login,
+    "created_at": User.created_at,
+}
+
 @router.get("/users", response_model=List[UserResponse])
 async def get_users(
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(get_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     Получить список всех пользователей.
     Требуются права администратора.
     """
-    logger.info(f"Admin {current_user.login} requested users list")
-    users = db.query(User).all()
-    logger.info(f"Found {len(users)} users")
-    return users
+    return await paginate(db, select(User), response, page, USER_SORT_FIELDS, User.user_id, "user_id")
 
 @router.put("/users/{user_id}")
 async def update_user(
     user_id: int,
     user_data: UserUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_admin:
         raise HTTPException(
@@ -83,7 +90,8 @@ async def update_user(
             detail="Not enough permissions"
         )
     
-    user = db.query(User).filter(User.user_id == user_id).first()
+    result = await db.execute(select(User).where(User.user_id == user_id))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -92,7 +100,10 @@ async def update_user(
     
     # Обновляем пароль, если он предоставлен
     if user_data.password is not None:
-        user.password_hash = get_password_hash(user_data.password)
+        user.password_hash = await hash_password(user_data.password)
+        # Ранее выданные токены пользователя перестают приниматься
+        user.token_version = (user.token_version or 0) + 1
+        await revoke_refresh_tokens(db, RefreshToken.user_id == user.user_id)
     
     # Обновляем статус администратора, если он предоставлен
     if user_data.is_admin is not None:
@@ -102,16 +113,19 @@ async def update_user(
     if user_data.is_active is not None:
         user.is_active = user_data.is_active
     
-    db.commit()
+    await broadcast_invalidation(db, user.login)
+    await db.commit()
+    principal_cache.invalidate(user.login)
     return {"message": "User updated successfully"}
 
 @router.put("/me")
 async def update_me(
     user_data: UserUpdate = Body(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.user_id == current_user.user_id).first()
+    result = await db.execute(select(User).where(User.user_id == current_user.user_id))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -120,7 +134,10 @@ async def update_me(
         pwd = user_data.password
         if len(pwd) < 8 or not any(c.isalpha() for c in pwd) or not any(c.isdigit() for c in pwd):
             raise HTTPException(status_code=400, detail="Password must be at least 8 characters and contain both letters and numbers.")
-        user.password_hash = get_password_hash(pwd)
+        user.password_hash = await hash_password(pwd)
+        user.token_version = (user.token_version or 0) + 1
+        await revoke_refresh_tokens(db, RefreshToken.user_id == user.user_id)
+        refresh_token = issue_refresh_token(db, user.user_id)
 
     if user_data.email is not None:
         user.email = user_data.email
@@ -133,6 +150,11 @@ async def update_me(
     if user_data.language_code is not None:
         user.language_code = user_data.language_code
 
-    db.commit()
-    db.refresh(user)
+    await broadcast_invalidation(db, user.login)
+    await db.commit()
+    await db.refresh(user)
+    principal_cache.invalidate(user.login)
+    if user_data.password is not None:
+        # Текущий токен стал недействительным вместе с остальными — выдаём новую пару
+        return {"message": "Profile updated successfully", **token_response(user.login, user.token_version, refresh_token)}
     return {"message": "Profile updated successfully"} 
\ No newline at end of file
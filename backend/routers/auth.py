@@ -1,16 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update, delete, exists
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from typing import Optional
+from pydantic import ValidationError
+import hashlib
 import logging
+import secrets
 
 from database import get_db
-from models import User
-from schemas import UserResponse
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from models import User, RefreshToken
+from schemas import UserResponse, Principal, RefreshRequest
+from principal_cache import principal_cache
+from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, REFRESH_REUSE_GRACE_SECONDS
+from security import check_password, BCRYPT_ROUNDS
+from timing import timed
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -21,15 +27,8 @@ router = APIRouter(
     tags=["auth"]
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/token", auto_error=False)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -40,7 +39,48 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(request: Request, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_refresh_token(db: AsyncSession, user_id: int, family_id: Optional[str] = None) -> str:
+    """Add a new refresh token to the session (caller commits) and return it.
+
+    Only its sha256 is stored, so a database leak does not leak sessions.
+    """
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user_id,
+        token_hash=hash_refresh_token(token),
+        family_id=family_id or secrets.token_hex(16),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return token
+
+async def revoke_refresh_tokens(db: AsyncSession, *conditions):
+    await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.revoked_at.is_(None), *conditions)
+        .values(revoked_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+def token_response(login: str, token_version: int, refresh_token: str) -> dict:
+    access_token = create_access_token(
+        data={"sub": login, "ver": token_version},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+async def load_principal(db: AsyncSession, login: str) -> Optional[Principal]:
+    result = await db.execute(select(User).where(User.login == login))
+    user = result.scalars().first()
+    principal = Principal.model_validate(user) if user is not None else None
+    # Снимок готов — возвращаем соединение в пул, чтобы запрос не держал второе, пока читает с get_read_db
+    await db.rollback()
+    return principal
+
+@timed("auth")
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -51,56 +91,64 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
         logger.warning("No token provided")
         raise credentials_exception
     
+    # Убираем префикс "Bearer " если он есть
+    if token.startswith("Bearer "):
+        token = token[7:]
+
     try:
-        # Убираем префикс "Bearer " если он есть
-        if token.startswith("Bearer "):
-            token = token[7:]
-            logger.info("Removed 'Bearer ' prefix from token")
-            
-        logger.info(f"Decoding token with SECRET_KEY: {SECRET_KEY[:10]}...")
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError as e:
+        logger.warning(f"JWT decode error: {str(e)}")
+        raise credentials_exception
+
+    username: str = payload.get("sub")
+    if username is None:
+        logger.warning("No username in token payload")
+        raise credentials_exception
+    # Токены, выданные до появления версии, считаются версией 0
+    version = payload.get("ver", 0)
+
+    user = principal_cache.get(username, version)
+    if user is None:
+        logger.debug("Principal cache miss for %s", username)
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            logger.info(f"Token payload: {payload}")
-        except JWTError as e:
-            logger.error(f"JWT decode error: {str(e)}")
-            raise credentials_exception
-            
-        username: str = payload.get("sub")
-        if username is None:
-            logger.warning("No username in token payload")
+            user = await load_principal(db, username)
+        except ValidationError as e:
+            # Ошибки базы (пул исчерпан, мастер недоступен) не ловим: это 503, а не 401 —
+            # иначе фронтенд сочтёт токен негодным и выкинет пользователя на страницу входа
+            logger.error(f"Invalid user record in get_current_user: {str(e)}")
             raise credentials_exception
-            
-        logger.info(f"Looking for user with login: {username}")
-        user = db.query(User).filter(User.login == username).first()
         if user is None:
             logger.warning(f"User not found: {username}")
             raise credentials_exception
-            
-        if not user.is_active:
-            logger.warning(f"Inactive user attempted to access: {username}")
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Account is inactive",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-            
-        logger.info(f"User found: {user.login}, is_admin: {user.is_admin}")
-        return user
-        
-    except Exception as e:
-        logger.error(f"Unexpected error in get_current_user: {str(e)}")
-        raise credentials_exception
+        if user.token_version != version:
+            logger.warning(f"Stale token version for user: {username}")
+            raise credentials_exception
+        principal_cache.put(user, payload.get("exp"))
+
+    if not user.is_active:
+        logger.warning(f"Inactive user attempted to access: {username}")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Account is inactive",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    # Нужен middleware read-your-writes, чтобы запомнить, кто писал
+    request.state.user_id = user.user_id
+    return user
 
 @router.get("/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_user)):
-    logger.info(f"GET /me request from user: {current_user.login}")
+async def read_users_me(current_user: Principal = Depends(get_current_user)):
     return current_user
 
 @router.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     logger.info(f"Login attempt for user: {form_data.username}")
-    user = db.query(User).filter(User.login == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+    result = await db.execute(select(User).where(User.login == form_data.username))
+    user = result.scalars().first()
+    valid, new_hash = await check_password(form_data.password, user.password_hash) if user else (False, None)
+    if not valid:
         logger.warning(f"Login failed for user: {form_data.username}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -116,9 +164,90 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.login}, expires_delta=access_token_expires
-    )
+    if new_hash:
+        # Хэш с прежней стоимостью bcrypt — сохраняем пересчитанный
+        user.password_hash = new_hash
+        await db.commit()
+        logger.info(f"Password hash of {user.login} upgraded to {BCRYPT_ROUNDS} rounds")
+
+    # Заодно убираем истёкшие токены пользователя
+    await db.execute(delete(RefreshToken).where(RefreshToken.user_id == user.user_id, RefreshToken.expires_at < datetime.utcnow()))
+    refresh_token = issue_refresh_token(db, user.user_id)
+    await db.commit()
     logger.info(f"Login successful for user: {user.login}")
-    return {"access_token": access_token, "token_type": "bearer"} 
\ No newline at end of file
+    return token_response(user.login, user.token_version, refresh_token)
+
+@router.post("/refresh")
+async def refresh(data: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """Exchange a refresh token for a new access/refresh pair.
+
+    The presented token is consumed: a second use of it means it was stolen,
+    and the whole family (every token rotated from the same login) is revoked.
+    Within REFRESH_REUSE_GRACE_SECONDS of its rotation the token may be used
+    again while its family is alive (tabs refreshing at the same moment);
+    that use gets a new token of the same family.
+    """
+    refresh_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token_hash = hash_refresh_token(data.refresh_token)
+    # Один индексированный UPDATE ... FROM users: погасить токен и получить пользователя.
+    # Через Table, а не модели: ORM не отдаёт в RETURNING колонки второй таблицы
+    tokens, users = RefreshToken.__table__, User.__table__
+    result = await db.execute(
+        update(tokens)
+        .where(
+            tokens.c.token_hash == token_hash,
+            tokens.c.revoked_at.is_(None),
+            tokens.c.expires_at > datetime.utcnow(),
+            tokens.c.user_id == users.c.user_id,
+        )
+        .values(revoked_at=datetime.utcnow())
+        .returning(tokens.c.family_id, tokens.c.user_id, users.c.login, users.c.is_active, users.c.token_version)
+    )
+    row = result.first()
+    if row is None:
+        result = await db.execute(
+            select(RefreshToken.family_id, RefreshToken.revoked_at, RefreshToken.user_id,
+                   User.login, User.is_active, User.token_version)
+            .join(User, User.user_id == RefreshToken.user_id)
+            .where(RefreshToken.token_hash == token_hash)
+        )
+        used = result.first()
+        if used is None or used.revoked_at is None:
+            raise refresh_exception
+        # Выход и отзыв семьи гасят все её токены; живой токен в семье значит, что старый просто ротирован
+        family_alive = await db.scalar(select(exists().where(
+            RefreshToken.family_id == used.family_id,
+            RefreshToken.revoked_at.is_(None),
+            RefreshToken.expires_at > datetime.utcnow(),
+        )))
+        if family_alive and used.revoked_at > datetime.utcnow() - timedelta(seconds=REFRESH_REUSE_GRACE_SECONDS):
+            row = used
+        else:
+            logger.warning(f"Revoked refresh token presented (possible reuse), revoking family {used.family_id}")
+            await revoke_refresh_tokens(db, RefreshToken.family_id == used.family_id)
+            await db.commit()
+            raise refresh_exception
+
+    if not row.is_active:
+        await revoke_refresh_tokens(db, RefreshToken.family_id == row.family_id)
+        await db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Account is inactive",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    refresh_token = issue_refresh_token(db, row.user_id, row.family_id)
+    await db.commit()
+    return token_response(row.login, row.token_version, refresh_token)
+
+@router.post("/logout")
+async def logout(data: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    family = select(RefreshToken.family_id).where(RefreshToken.token_hash == hash_refresh_token(data.refresh_token)).scalar_subquery()
+    await revoke_refresh_tokens(db, RefreshToken.family_id == family)
+    await db.commit()
+    return {"ok": True} 
\ No newline at end of file
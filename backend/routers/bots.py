@@ -1,32 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from datetime import datetime
 
 from database import get_db
+from db_routing import get_read_db
 from models import Bot, User
 from routers.auth import get_current_user
 from schemas import BotCreate, BotUpdate, BotResponse
+from pagination import PageParams, paginate
+from etag import check_etag
 
 router = APIRouter(
     prefix="/bots",
     tags=["bots"]
 )
 
+BOT_SORT_FIELDS = {
+    "bot_id": Bot.bot_id,
+    "bot_name": Bot.bot_name,
+    "created_at": Bot.created_at,
+}
+
 @router.get("/", response_model=List[BotResponse])
 async def get_bots(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    if current_user.is_admin:
-        return db.query(Bot).all()
-    return db.query(Bot).filter(Bot.user_id == current_user.user_id).all()
+    stmt = select(Bot)
+    if not current_user.is_admin:
+        stmt = stmt.where(Bot.user_id == current_user.user_id)
+    fingerprint = stmt.with_only_columns(func.count(), func.max(Bot.updated_at), maintain_column_froms=True)
+    not_modified = await check_etag(request, response, db, fingerprint, current_user.user_id)
+    if not_modified:
+        return not_modified
+    return await paginate(db, stmt, response, page, BOT_SORT_FIELDS, Bot.bot_id, "bot_id")
 
 @router.post("/", response_model=BotResponse)
 async def create_bot(
     bot_data: BotCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     bot = Bot(
         user_id=current_user.user_id,
@@ -35,8 +53,8 @@ async def create_bot(
         is_active=bot_data.is_active
     )
     db.add(bot)
-    db.commit()
-    db.refresh(bot)
+    await db.commit()
+    await db.refresh(bot)
     return bot
 
 @router.put("/{bot_id}", response_model=BotResponse)
@@ -44,9 +62,10 @@ async def update_bot(
     bot_id: int,
     bot_data: BotUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    bot = db.query(Bot).filter(Bot.bot_id == bot_id).first()
+    result = await db.execute(select(Bot).where(Bot.bot_id == bot_id))
+    bot = result.scalars().first()
     if not bot:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -67,17 +86,18 @@ async def update_bot(
         bot.is_active = bot_data.is_active
     
     bot.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(bot)
+    await db.commit()
+    await db.refresh(bot)
     return bot
 
 @router.delete("/{bot_id}")
 async def delete_bot(
     bot_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    bot = db.query(Bot).filter(Bot.bot_id == bot_id).first()
+    result = await db.execute(select(Bot).where(Bot.bot_id == bot_id))
+    bot = result.scalars().first()
     if not bot:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -90,6 +110,6 @@ async def delete_bot(
             detail="Not enough permissions"
         )
     
-    db.delete(bot)
-    db.commit()
+    await db.delete(bot)
+    await db.commit()
     return {"message": "Bot deleted successfully"} 
\ No newline at end of file
@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from database import get_db
+from db_routing import get_reference_db
 from models import ChatStatus
 from schemas import ChatStatusResponse
 
 router = APIRouter(prefix="/chat_statuses", tags=["chat_statuses"])
 
 @router.get("/", response_model=List[ChatStatusResponse])
-async def get_chat_statuses(db: Session = Depends(get_db)):
-    return db.query(ChatStatus).all() 
\ No newline at end of file
+async def get_chat_statuses(db: AsyncSession = Depends(get_reference_db)):
+    result = await db.execute(select(ChatStatus))
+    return result.scalars().all() 
\ No newline at end of file
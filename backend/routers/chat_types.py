@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from database import get_db
+from db_routing import get_reference_db
 from models import ChatType
 from schemas import ChatTypeResponse
 
 router = APIRouter(prefix="/chat_types", tags=["chat_types"])
 
 @router.get("/", response_model=List[ChatTypeResponse])
-async def get_chat_types(db: Session = Depends(get_db)):
-    return db.query(ChatType).all() 
\ No newline at end of file
+async def get_chat_types(db: AsyncSession = Depends(get_reference_db)):
+    result = await db.execute(select(ChatType))
+    return result.scalars().all() 
\ No newline at end of file
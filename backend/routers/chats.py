@@ -1,46 +1,242 @@
-from fastapi import APIRouter, Depends, HTTPException, Body
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request, Response
+from sqlalchemy import select, func, text, any_, bindparam, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
-from typing import List
+from typing import List, Optional
+import os
 from database import get_db
-from models import Chat, User, ChatEmployee, Employee
+from db_routing import get_read_db
+from models import Chat, User, ChatEmployee, Employee, Bot
 from routers.auth import get_current_user
-from schemas import ChatResponse, ChatCreate, ChatUpdate
+from schemas import ChatResponse, ChatCreate, ChatUpdate, ChatParticipants, ParticipantBatch, ParticipantResult
+from pagination import PageParams, paginate, escape_like
+from export import ExportParams, export_response
+from etag import check_etag
+from singleflight import coalesce
 
 router = APIRouter(
     prefix="/chats",
     tags=["chats"]
 )
 
+CHAT_SORT_FIELDS = {
+    "chat_id": Chat.chat_id,
+    "created_at": Chat.created_at,
+    "updated_at": Chat.updated_at,
+    "user_num": Chat.user_num,
+    "unknown_user": Chat.unknown_user,
+}
+
+class ChatFilters:
+    """Filters shared by the chat list and the chat export."""
+
+    def __init__(
+        self,
+        status_id: Optional[int] = None,
+        type_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+        q: Optional[str] = Query(None, description="Search in chat title"),
+        has_unknown: Optional[bool] = Query(None, description="Only chats with (or without) unknown users"),
+    ):
+        self.status_id = status_id
+        self.type_id = type_id
+        self.bot_id = bot_id
+        self.q = q
+        self.has_unknown = has_unknown
+
+    def apply(self, stmt):
+        if self.status_id is not None:
+            stmt = stmt.where(Chat.status_id == self.status_id)
+        if self.type_id is not None:
+            stmt = stmt.where(Chat.type_id == self.type_id)
+        if self.bot_id is not None:
+            stmt = stmt.where(Chat.bot_id == self.bot_id)
+        if self.q:
+            stmt = stmt.where(func.array_to_string(Chat.title, " ").ilike(f"%{escape_like(self.q)}%", escape="\\"))
+        if self.has_unknown is not None:
+            stmt = stmt.where(Chat.unknown_user > 0 if self.has_unknown else Chat.unknown_user == 0)
+        return stmt
+
+# Сколько чатов можно запросить за раз в GET /chats/participants
+PARTICIPANTS_MAX_CHATS = int(os.getenv("PARTICIPANTS_MAX_CHATS", "500"))
+
+def chat_id_in(column, chat_ids):
+    # Один параметр bigint[] вместо IN ($1, ..., $n): asyncpg не принимает больше 32767 параметров
+    return column == any_(bindparam(None, list(chat_ids), type_=ARRAY(BigInteger)))
+
+def participant_dict(ce: ChatEmployee, emp: Employee) -> dict:
+    return {
+        "employee_id": emp.employee_id,
+        "full_name": emp.full_name,
+        "telegram_username": emp.telegram_username,
+        "created_at": emp.created_at,
+        "updated_at": emp.updated_at,
+        "is_active": emp.is_active,
+        "is_external": emp.is_external,
+        # из chat_employees
+        "is_admin": ce.is_admin,
+        "ce_is_active": ce.is_active,
+        "ce_updated_at": ce.updated_at,
+    }
+
+async def load_participants(db: AsyncSession, chat_ids) -> dict:
+    """Participants of many chats in one query, grouped by chat_id.
+
+    chat_ids must already be limited to the current user's chats.
+    """
+    participants = {chat_id: [] for chat_id in chat_ids}
+    if not participants:
+        return participants
+    result = await db.execute(
+        select(ChatEmployee, Employee)
+        .join(Employee, ChatEmployee.employee_id == Employee.employee_id)
+        .where(chat_id_in(ChatEmployee.chat_id, participants))
+        .order_by(ChatEmployee.chat_id, ChatEmployee.employee_id)
+    )
+    for ce, emp in result:
+        participants[ce.chat_id].append(participant_dict(ce, emp))
+    return participants
+
+def participants_fingerprint(user_id: int):
+    # Агрегаты по всем связям арендатора: меняются при добавлении, удалении и правке участников
+    return (
+        select(func.count(), func.max(ChatEmployee.updated_at), func.max(Employee.updated_at))
+        .select_from(ChatEmployee)
+        .join(Chat, Chat.chat_id == ChatEmployee.chat_id)
+        .join(Employee, ChatEmployee.employee_id == Employee.employee_id)
+        .where(Chat.user_id == user_id)
+    )
+
+def chat_title(chat: Chat) -> Optional[str]:
+    return chat.title[0] if chat.title and isinstance(chat.title, list) else chat.title
+
 @router.get("/", response_model=List[ChatResponse])
 async def get_chats(
+    request: Request,
+    filters: ChatFilters = Depends(),
+    page: PageParams = Depends(),
+    include: Optional[str] = Query(None, pattern="^participants$", description="Embed chat participants"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    chats = db.query(Chat).options(joinedload(Chat.bot)).filter(Chat.user_id == current_user.user_id).all()
-    result = []
-    for chat in chats:
-        result.append(ChatResponse(
-            chat_id=chat.chat_id,
-            bot_id=chat.bot_id,
-            bot_name=chat.bot.bot_name if chat.bot else None,
-            user_id=chat.user_id,
-            telegram_chat_id=chat.telegram_chat_id,
-            title=chat.title,
-            type_id=chat.type_id,
-            status_id=chat.status_id,
-            user_num=chat.user_num,
-            unknown_user=chat.unknown_user,
-            created_at=chat.created_at,
-            updated_at=chat.updated_at,
-        ))
-    return result
+    # Одинаковые одновременные запросы (вкладки, несколько админов) выполняются один раз
+    async def build(response: Response):
+        stmt = filters.apply(select(Chat).where(Chat.user_id == current_user.user_id))
+        # bot_name берётся из ботов, поэтому их изменения тоже меняют ETag
+        bots_updated = select(func.max(Bot.updated_at)).where(Bot.user_id == current_user.user_id).scalar_subquery()
+        # active_members меняет триггер без updated_at, поэтому его сумма тоже входит в ETag
+        fingerprint = stmt.with_only_columns(
+            func.count(), func.max(Chat.updated_at), func.sum(Chat.active_members), bots_updated, maintain_column_froms=True)
+        scope = [current_user.user_id]
+        if include:
+            scope.extend((await db.execute(participants_fingerprint(current_user.user_id))).one())
+        not_modified = await check_etag(request, response, db, fingerprint, *scope)
+        if not_modified:
+            return not_modified
+        chats = await paginate(db, stmt.options(joinedload(Chat.bot)), response, page, CHAT_SORT_FIELDS, Chat.chat_id, "chat_id")
+        participants = await load_participants(db, [chat.chat_id for chat in chats]) if include else {}
+        result = []
+        for chat in chats:
+            result.append(ChatResponse(
+                chat_id=chat.chat_id,
+                bot_id=chat.bot_id,
+                bot_name=chat.bot.bot_name if chat.bot else None,
+                user_id=chat.user_id,
+                telegram_chat_id=chat.telegram_chat_id,
+                title=chat.title,
+                type_id=chat.type_id,
+                status_id=chat.status_id,
+                user_num=chat.user_num,
+                unknown_user=chat.unknown_user,
+                created_at=chat.created_at,
+                updated_at=chat.updated_at,
+                active_members=chat.active_members,
+                participants=participants.get(chat.chat_id),
+            ))
+        return result
+    return await coalesce(request, current_user.user_id, List[ChatResponse], build)
+
+@router.get("/participants", response_model=List[ChatParticipants])
+async def get_participants_of_chats(
+    request: Request,
+    response: Response,
+    chat_id: List[int] = Query(..., description="Repeat for each chat"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Участники нескольких чатов за один запрос: GET /chats/participants?chat_id=1&chat_id=2.
+    Чужие и несуществующие чаты в ответ не попадают.
+    """
+    if len(chat_id) > PARTICIPANTS_MAX_CHATS:
+        raise HTTPException(status_code=413, detail=f"At most {PARTICIPANTS_MAX_CHATS} chats per request")
+    owned = select(Chat.chat_id).where(chat_id_in(Chat.chat_id, chat_id), Chat.user_id == current_user.user_id)
+    fingerprint = (
+        select(func.count(), func.max(ChatEmployee.updated_at), func.max(Employee.updated_at),
+               select(func.max(Chat.updated_at)).where(Chat.chat_id.in_(owned)).scalar_subquery())
+        .select_from(ChatEmployee)
+        .join(Employee, ChatEmployee.employee_id == Employee.employee_id)
+        .where(ChatEmployee.chat_id.in_(owned))
+    )
+    not_modified = await check_etag(request, response, db, fingerprint, current_user.user_id)
+    if not_modified:
+        return not_modified
+    result = await db.execute(
+        select(Chat).where(chat_id_in(Chat.chat_id, chat_id), Chat.user_id == current_user.user_id).order_by(Chat.chat_id)
+    )
+    chats = result.scalars().all()
+    participants = await load_participants(db, [chat.chat_id for chat in chats])
+    return [
+        ChatParticipants(chat_id=chat.chat_id, chat_title=chat_title(chat), participants=participants[chat.chat_id])
+        for chat in chats
+    ]
+
+@router.get("/export")
+async def export_chats(
+    request: Request,
+    filters: ChatFilters = Depends(),
+    params: ExportParams = Depends(),
+    current_user: User = Depends(get_current_user)
+):
+    stmt = filters.apply(
+        select(
+            Chat.chat_id, Chat.bot_id, Bot.bot_name, Chat.telegram_chat_id, Chat.title, Chat.type_id,
+            Chat.status_id, Chat.user_num, Chat.unknown_user, Chat.active_members, Chat.created_at, Chat.updated_at,
+        )
+        .outerjoin(Bot, Bot.bot_id == Chat.bot_id)
+        .where(Chat.user_id == current_user.user_id)
+        .order_by(Chat.chat_id)
+    )
+    return export_response(request, current_user.user_id, stmt, params, "chats")
+
+@router.get("/participants/export")
+async def export_participants(
+    request: Request,
+    chat_id: Optional[int] = None,
+    params: ExportParams = Depends(),
+    current_user: User = Depends(get_current_user)
+):
+    stmt = (
+        select(
+            ChatEmployee.chat_id, Employee.employee_id, Employee.full_name, Employee.telegram_username,
+            Employee.telegram_user_id, Employee.is_active, Employee.is_external,
+            ChatEmployee.is_admin, ChatEmployee.is_active.label("ce_is_active"), ChatEmployee.updated_at.label("ce_updated_at"),
+        )
+        .join(Chat, Chat.chat_id == ChatEmployee.chat_id)
+        .join(Employee, Employee.employee_id == ChatEmployee.employee_id)
+        .where(Chat.user_id == current_user.user_id)
+        .order_by(ChatEmployee.chat_id, ChatEmployee.employee_id)
+    )
+    if chat_id is not None:
+        stmt = stmt.where(ChatEmployee.chat_id == chat_id)
+    return export_response(request, current_user.user_id, stmt, params, "participants")
 
 @router.post("/", response_model=ChatResponse)
 async def create_chat(
     chat: ChatCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     new_chat = Chat(
         bot_id=chat.bot_id,
@@ -53,8 +249,8 @@ async def create_chat(
         user_id=current_user.user_id
     )
     db.add(new_chat)
-    db.commit()
-    db.refresh(new_chat)
+    await db.commit()
+    await db.refresh(new_chat)
     return new_chat
 
 @router.put("/{chat_id}", response_model=ChatResponse)
@@ -62,85 +258,169 @@ async def update_chat(
     chat_id: int,
     chat: ChatUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    db_chat = db.query(Chat).filter(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id).first()
+    result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id))
+    db_chat = result.scalars().first()
     if not db_chat:
         return {"error": "Chat not found"}
     for field, value in chat.dict(exclude_unset=True).items():
         setattr(db_chat, field, value)
-    db.commit()
-    db.refresh(db_chat)
+    await db.commit()
+    await db.refresh(db_chat)
     return db_chat
 
 @router.delete("/{chat_id}")
 async def delete_chat(
     chat_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    db_chat = db.query(Chat).filter(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id).first()
+    result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id))
+    db_chat = result.scalars().first()
     if not db_chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    db.delete(db_chat)
-    db.commit()
+    await db.delete(db_chat)
+    await db.commit()
     return {"ok": True}
 
 @router.get("/{chat_id}/participants")
 async def get_chat_participants(
     chat_id: int,
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     # Проверяем, что чат принадлежит пользователю
-    chat = db.query(Chat).filter(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id).first()
+    result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id))
+    chat = result.scalars().first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    # Получаем участников через join
-    participants = (
-        db.query(ChatEmployee, Employee)
+    fingerprint = (
+        select(func.count(), func.max(ChatEmployee.updated_at), func.max(Employee.updated_at))
+        .select_from(ChatEmployee)
         .join(Employee, ChatEmployee.employee_id == Employee.employee_id)
-        .filter(ChatEmployee.chat_id == chat_id)
-        .all()
+        .where(ChatEmployee.chat_id == chat_id)
     )
-    # Формируем ответ
-    result = []
-    for ce, emp in participants:
-        result.append({
-            "employee_id": emp.employee_id,
-            "full_name": emp.full_name,
-            "telegram_username": emp.telegram_username,
-            "created_at": emp.created_at,
-            "updated_at": emp.updated_at,
-            "is_active": emp.is_active,
-            "is_external": emp.is_external,
-            # из chat_employees
-            "is_admin": ce.is_admin,
-            "ce_is_active": ce.is_active,
-            "ce_updated_at": ce.updated_at,
-        })
+    not_modified = await check_etag(request, response, db, fingerprint, current_user.user_id, chat.updated_at)
+    if not_modified:
+        return not_modified
+    participants = await load_participants(db, [chat_id])
     return {
         "chat_id": chat.chat_id,
-        "chat_title": chat.title[0] if chat.title and isinstance(chat.title, list) else chat.title,
-        "participants": result
+        "chat_title": chat_title(chat),
+        "participants": participants[chat_id]
     }
 
+PARTICIPANT_BATCH_MAX = int(os.getenv("PARTICIPANT_BATCH_MAX", "10000"))
+
+# Пакетные операции по unnest(...) массивов; чужие чаты отсекаются join с chats по user_id
+PARTICIPANTS_UPDATE_LINKS = text("""
+    UPDATE chat_employees ce SET
+        is_admin = COALESCE(v.is_admin, ce.is_admin),
+        is_active = COALESCE(v.is_active, ce.is_active),
+        updated_at = NOW()
+    FROM unnest(CAST(:chat_ids AS bigint[]), CAST(:employee_ids AS bigint[]),
+                CAST(:is_admin AS boolean[]), CAST(:ce_is_active AS boolean[]))
+            AS v(chat_id, employee_id, is_admin, is_active),
+         chats c
+    WHERE ce.chat_id = v.chat_id AND ce.employee_id = v.employee_id
+      AND c.chat_id = ce.chat_id AND c.user_id = :user_id
+    RETURNING ce.chat_id, ce.employee_id
+""")
+PARTICIPANTS_UPDATE_EMPLOYEES = text("""
+    UPDATE employees e SET
+        is_active = COALESCE(v.is_active, e.is_active),
+        is_external = COALESCE(v.is_external, e.is_external),
+        updated_at = NOW()
+    FROM (
+        SELECT DISTINCT ON (employee_id) employee_id, is_active, is_external
+        FROM unnest(CAST(:chat_ids AS bigint[]), CAST(:employee_ids AS bigint[]),
+                    CAST(:is_active AS boolean[]), CAST(:is_external AS boolean[]))
+            WITH ORDINALITY AS u(chat_id, employee_id, is_active, is_external, n)
+        WHERE (is_active IS NOT NULL OR is_external IS NOT NULL)
+          AND (chat_id, employee_id) IN (SELECT * FROM unnest(CAST(:found_chat_ids AS bigint[]), CAST(:found_employee_ids AS bigint[])))
+        ORDER BY employee_id, n DESC
+    ) v
+    WHERE e.employee_id = v.employee_id
+""")
+PARTICIPANTS_DELETE = text("""
+    DELETE FROM chat_employees ce
+    USING unnest(CAST(:chat_ids AS bigint[]), CAST(:employee_ids AS bigint[])) AS v(chat_id, employee_id), chats c
+    WHERE ce.chat_id = v.chat_id AND ce.employee_id = v.employee_id
+      AND c.chat_id = ce.chat_id AND c.user_id = :user_id
+    RETURNING ce.chat_id, ce.employee_id
+""")
+
+@router.post("/participants/batch", response_model=List[ParticipantResult])
+async def batch_chat_participants(
+    batch: ParticipantBatch,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Пакетное изменение и удаление участников в нескольких чатах одной транзакцией.
+    Поля как у PUT /{chat_id}/participants/{employee_id}; null — не менять.
+    """
+    if len(batch.update) + len(batch.delete) > PARTICIPANT_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {PARTICIPANT_BATCH_MAX} operations per batch")
+    results = []
+    if batch.update:
+        items = batch.update
+        params = {
+            "user_id": current_user.user_id,
+            "chat_ids": [i.chat_id for i in items],
+            "employee_ids": [i.employee_id for i in items],
+            "is_admin": [i.is_admin for i in items],
+            "ce_is_active": [i.ce_is_active for i in items],
+            "is_active": [i.is_active for i in items],
+            "is_external": [i.is_external for i in items],
+        }
+        found = {tuple(row) for row in await db.execute(PARTICIPANTS_UPDATE_LINKS, params)}
+        # Поля сотрудника меняем только для связей, которые нашлись в чатах пользователя
+        params["found_chat_ids"] = [chat_id for chat_id, _ in found]
+        params["found_employee_ids"] = [employee_id for _, employee_id in found]
+        await db.execute(PARTICIPANTS_UPDATE_EMPLOYEES, params)
+        results.extend(
+            ParticipantResult(chat_id=i.chat_id, employee_id=i.employee_id, op="update",
+                              status="updated" if (i.chat_id, i.employee_id) in found else "not_found")
+            for i in items
+        )
+    if batch.delete:
+        items = batch.delete
+        params = {
+            "user_id": current_user.user_id,
+            "chat_ids": [i.chat_id for i in items],
+            "employee_ids": [i.employee_id for i in items],
+        }
+        deleted = {tuple(row) for row in await db.execute(PARTICIPANTS_DELETE, params)}
+        results.extend(
+            ParticipantResult(chat_id=i.chat_id, employee_id=i.employee_id, op="delete",
+                              status="deleted" if (i.chat_id, i.employee_id) in deleted else "not_found")
+            for i in items
+        )
+    await db.commit()
+    return results
+
 @router.delete("/{chat_id}/participants/{employee_id}")
 async def delete_chat_participant(
     chat_id: int,
     employee_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Проверяем, что чат принадлежит пользователю
-    chat = db.query(Chat).filter(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id).first()
+    result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id))
+    chat = result.scalars().first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    ce = db.query(ChatEmployee).filter(ChatEmployee.chat_id == chat_id, ChatEmployee.employee_id == employee_id).first()
+    result = await db.execute(select(ChatEmployee).where(ChatEmployee.chat_id == chat_id, ChatEmployee.employee_id == employee_id))
+    ce = result.scalars().first()
     if not ce:
         raise HTTPException(status_code=404, detail="Link not found")
-    db.delete(ce)
-    db.commit()
+    await db.delete(ce)
+    await db.commit()
     return {"ok": True}
 
 @router.put("/{chat_id}/participants/{employee_id}")
@@ -149,14 +429,17 @@ async def update_chat_participant(
     employee_id: int,
     data: dict = Body(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Проверяем, что чат принадлежит пользователю
-    chat = db.query(Chat).filter(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id).first()
+    result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.user_id == current_user.user_id))
+    chat = result.scalars().first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    ce = db.query(ChatEmployee).filter(ChatEmployee.chat_id == chat_id, ChatEmployee.employee_id == employee_id).first()
-    emp = db.query(Employee).filter(Employee.employee_id == employee_id).first()
+    result = await db.execute(select(ChatEmployee).where(ChatEmployee.chat_id == chat_id, ChatEmployee.employee_id == employee_id))
+    ce = result.scalars().first()
+    result = await db.execute(select(Employee).where(Employee.employee_id == employee_id))
+    emp = result.scalars().first()
     if not ce or not emp:
         raise HTTPException(status_code=404, detail="Link or employee not found")
     # Обновляем поля связи
@@ -169,5 +452,5 @@ async def update_chat_participant(
         emp.is_active = data['is_active']
     if 'is_external' in data:
         emp.is_external = data['is_external']
-    db.commit()
+    await db.commit()
     return {"ok": True} 
\ No newline at end of file
@@ -0,0 +1,34 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db_routing import get_read_db
+from models import TenantCounter, User
+from routers.auth import get_current_user
+from schemas import DashboardSummary
+
+router = APIRouter(prefix="/dashboard", tags=["dashboard"])
+
+STATUS_PREFIX = "chats_status:"
+
+@router.get("/summary", response_model=DashboardSummary)
+async def get_summary(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Итоги арендатора из tenant_counters (ведутся триггерами): чтение нескольких строк
+    по первичному ключу, без подсчёта по chats/employees/chat_employees.
+    """
+    result = await db.execute(
+        select(TenantCounter.name, TenantCounter.value).where(TenantCounter.user_id == current_user.user_id)
+    )
+    summary = DashboardSummary()
+    for name, value in result:
+        if name.startswith(STATUS_PREFIX):
+            if value:
+                summary.chats_by_status[int(name[len(STATUS_PREFIX):])] = value
+        elif name == "chats_unknown":
+            summary.chats_with_unknown = value
+        elif name in DashboardSummary.model_fields:
+            setattr(summary, name, value)
+    return summary
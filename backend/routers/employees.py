@@ -1,26 +1,246 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, Request, Response, Query
+from sqlalchemy import select, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+import csv
+import io
+import json
+import os
 from database import get_db
+from db_routing import get_read_db
 from models import Employee, User
 from routers.auth import get_current_user
-from schemas import EmployeeResponse, EmployeeCreate, EmployeeUpdate
+from schemas import EmployeeResponse, EmployeeCreate, EmployeeUpdate, ImportResult, ImportRowResult
+from pagination import PageParams, paginate
+from export import ExportParams, export_response
+from etag import check_etag
+from singleflight import coalesce
 from fastapi import HTTPException
 
 router = APIRouter(prefix="/employees", tags=["employees"])
 
+EMPLOYEE_SORT_FIELDS = {
+    "employee_id": Employee.employee_id,
+    "full_name": Employee.full_name,
+    "created_at": Employee.created_at,
+    "updated_at": Employee.updated_at,
+}
+
+class EmployeeFilters:
+    """Filters shared by the employee list and the employee export."""
+
+    def __init__(self, is_active: Optional[bool] = None, is_external: Optional[bool] = None):
+        self.is_active = is_active
+        self.is_external = is_external
+
+    def apply(self, stmt):
+        if self.is_active is not None:
+            stmt = stmt.where(Employee.is_active == self.is_active)
+        if self.is_external is not None:
+            stmt = stmt.where(Employee.is_external == self.is_external)
+        return stmt
+
 @router.get("/", response_model=List[EmployeeResponse])
 async def get_employees(
+    request: Request,
+    filters: EmployeeFilters = Depends(),
+    page: PageParams = Depends(),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    stmt = filters.apply(select(Employee).where(Employee.user_id == current_user.user_id))
+    fingerprint = stmt.with_only_columns(func.count(), func.max(Employee.updated_at), maintain_column_froms=True)
+
+    async def build(response: Response):
+        not_modified = await check_etag(request, response, db, fingerprint, current_user.user_id)
+        if not_modified:
+            return not_modified
+        return await paginate(db, stmt, response, page, EMPLOYEE_SORT_FIELDS, Employee.employee_id, "employee_id")
+    return await coalesce(request, current_user.user_id, List[EmployeeResponse], build)
+
+@router.get("/export")
+async def export_employees(
+    request: Request,
+    filters: EmployeeFilters = Depends(),
+    params: ExportParams = Depends(),
+    current_user: User = Depends(get_current_user)
+):
+    stmt = filters.apply(
+        select(
+            Employee.employee_id, Employee.full_name, Employee.telegram_username, Employee.telegram_user_id,
+            Employee.is_active, Employee.is_external, Employee.is_bot, Employee.created_at, Employee.updated_at,
+        )
+        .where(Employee.user_id == current_user.user_id)
+        .order_by(Employee.employee_id)
+    )
+    return export_response(request, current_user.user_id, stmt, params, "employees")
+
+IMPORT_MAX_ROWS = int(os.getenv("EMPLOYEE_IMPORT_MAX_ROWS", "50000"))
+IMPORT_COLUMNS = ("row_no", "full_name", "telegram_username", "telegram_user_id", "is_active", "is_external", "is_bot")
+TRUE_VALUES = {"1", "true", "t", "yes", "y"}
+FALSE_VALUES = {"0", "false", "f", "no", "n"}
+
+def parse_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value == "":
+        return None
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f"invalid boolean '{value}'")
+
+def parse_import_rows(body: str, fmt: str):
+    """Yield (row_no, dict) from a CSV (with header) or NDJSON body."""
+    if fmt == "csv":
+        for row_no, row in enumerate(csv.DictReader(io.StringIO(body)), start=1):
+            yield row_no, row
+    else:
+        for row_no, line in enumerate(body.splitlines(), start=1):
+            if line.strip():
+                yield row_no, json.loads(line)
+
+def import_record(row_no: int, row: dict):
+    full_name = (row.get("full_name") or "").strip()
+    if not full_name:
+        raise ValueError("full_name is required")
+    username = (row.get("telegram_username") or "").strip().lstrip("@") or None
+    user_id = row.get("telegram_user_id")
+    user_id = int(user_id) if user_id not in (None, "") else None
+    if username is None and user_id is None:
+        raise ValueError("telegram_user_id or telegram_username is required")
+    return (row_no, full_name, username, user_id,
+            parse_bool(row.get("is_active")), parse_bool(row.get("is_external")), parse_bool(row.get("is_bot")))
+
+# Слияние staging-таблицы с employees арендатора: сопоставление по telegram_user_id,
+# затем по username (как делает bot_service), обновление, вставка с заранее выданными id
+IMPORT_MATCH_BY_ID = text("""
+    UPDATE employee_import s SET employee_id = e.employee_id
+    FROM employees e
+    WHERE e.user_id = :user_id AND s.telegram_user_id IS NOT NULL AND e.telegram_user_id = s.telegram_user_id
+""")
+IMPORT_MATCH_BY_USERNAME = text("""
+    UPDATE employee_import s SET employee_id = e.employee_id
+    FROM employees e
+    WHERE s.employee_id IS NULL AND s.telegram_username IS NOT NULL
+      AND e.user_id = :user_id AND lower(e.telegram_username) = lower(s.telegram_username)
+""")
+# Строки с разными ключами (id и username) могут найти одного сотрудника: побеждает последняя, как при разборе файла
+IMPORT_SUPERSEDED = text("""
+    UPDATE employee_import s SET status = 'duplicate', superseded_by = last.row_no
+    FROM (
+        SELECT employee_id, max(row_no) AS row_no FROM employee_import
+        WHERE employee_id IS NOT NULL GROUP BY employee_id
+    ) last
+    WHERE s.employee_id = last.employee_id AND s.row_no < last.row_no
+""")
+IMPORT_UPDATE = text("""
+    WITH changed AS (
+        UPDATE employees e SET
+            full_name = s.full_name,
+            telegram_username = COALESCE(s.telegram_username, e.telegram_username),
+            telegram_user_id = COALESCE(s.telegram_user_id, e.telegram_user_id),
+            is_active = COALESCE(s.is_active, e.is_active),
+            is_external = COALESCE(s.is_external, e.is_external),
+            is_bot = COALESCE(s.is_bot, e.is_bot),
+            updated_at = NOW()
+        FROM employee_import s
+        WHERE e.employee_id = s.employee_id AND s.status <> 'duplicate'
+          AND (e.full_name, e.telegram_username, e.telegram_user_id, e.is_active, e.is_external, e.is_bot)
+              IS DISTINCT FROM (s.full_name, COALESCE(s.telegram_username, e.telegram_username),
+                                COALESCE(s.telegram_user_id, e.telegram_user_id), COALESCE(s.is_active, e.is_active),
+                                COALESCE(s.is_external, e.is_external), COALESCE(s.is_bot, e.is_bot))
+        RETURNING s.row_no
+    )
+    UPDATE employee_import s SET status = 'updated' FROM changed WHERE s.row_no = changed.row_no
+""")
+IMPORT_ASSIGN_IDS = text("""
+    UPDATE employee_import
+    SET employee_id = nextval(pg_get_serial_sequence('employees', 'employee_id')), status = 'created'
+    WHERE employee_id IS NULL
+""")
+IMPORT_INSERT = text("""
+    INSERT INTO employees (employee_id, full_name, telegram_username, telegram_user_id,
+                           is_active, is_external, is_bot, user_id, created_at, updated_at)
+    SELECT employee_id, full_name, telegram_username, telegram_user_id,
+           COALESCE(is_active, true), COALESCE(is_external, true), COALESCE(is_bot, false), :user_id, NOW(), NOW()
+    FROM employee_import WHERE status = 'created'
+""")
+
+@router.post("/import", response_model=ImportResult)
+async def import_employees(
+    request: Request,
+    fmt: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$", description="Defaults from Content-Type"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    return db.query(Employee).filter(Employee.user_id == current_user.user_id).all()
+    """
+    Массовый импорт сотрудников из CSV (с заголовком) или NDJSON в теле запроса.
+    Существующие сотрудники ищутся по telegram_user_id, затем по telegram_username.
+    """
+    fmt = fmt or ("ndjson" if "json" in request.headers.get("content-type", "") else "csv")
+    body = (await request.body()).decode("utf-8-sig")
+
+    results = {}
+    records = {}  # ключ сотрудника -> запись; в файле побеждает последняя строка
+    try:
+        for row_no, row in parse_import_rows(body, fmt):
+            if row_no > IMPORT_MAX_ROWS:
+                raise HTTPException(status_code=413, detail=f"At most {IMPORT_MAX_ROWS} rows per import")
+            try:
+                record = import_record(row_no, row)
+            except (ValueError, TypeError, AttributeError) as e:
+                results[row_no] = ImportRowResult(row=row_no, status="error", error=str(e))
+                continue
+            key = ("id", record[3]) if record[3] is not None else ("username", record[2].lower())
+            previous = records.get(key)
+            if previous is not None:
+                results[previous[0]] = ImportRowResult(row=previous[0], status="duplicate", error=f"superseded by row {row_no}")
+            records[key] = record
+    except (csv.Error, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Cannot parse {fmt}: {e}")
+
+    if records:
+        await db.execute(text("""
+            CREATE TEMP TABLE employee_import (
+                row_no integer PRIMARY KEY, full_name text, telegram_username text, telegram_user_id bigint,
+                is_active boolean, is_external boolean, is_bot boolean,
+                employee_id bigint, status text NOT NULL DEFAULT 'unchanged', superseded_by integer
+            ) ON COMMIT DROP
+        """))
+        # COPY в той же транзакции, через соединение asyncpg под сессией
+        connection = await db.connection()
+        raw = await connection.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "employee_import", records=list(records.values()), columns=list(IMPORT_COLUMNS))
+        await db.execute(text("ANALYZE employee_import"))
+        params = {"user_id": current_user.user_id}
+        await db.execute(IMPORT_MATCH_BY_ID, params)
+        await db.execute(IMPORT_MATCH_BY_USERNAME, params)
+        await db.execute(IMPORT_SUPERSEDED)
+        await db.execute(IMPORT_UPDATE)
+        await db.execute(IMPORT_ASSIGN_IDS)
+        await db.execute(IMPORT_INSERT, params)
+        rows = await db.execute(text("SELECT row_no, employee_id, status, superseded_by FROM employee_import"))
+        for row_no, employee_id, status, superseded_by in rows:
+            if status == "duplicate":
+                results[row_no] = ImportRowResult(row=row_no, status=status, error=f"superseded by row {superseded_by}")
+            else:
+                results[row_no] = ImportRowResult(row=row_no, status=status, employee_id=employee_id)
+        await db.commit()
+
+    summary = ImportResult(rows=[results[row_no] for row_no in sorted(results)])
+    for row in summary.rows:
+        setattr(summary, row.status, getattr(summary, row.status) + 1)
+    return summary
 
 @router.post("/", response_model=EmployeeResponse)
 async def create_employee(
     employee: EmployeeCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     new_employee = Employee(
         full_name=employee.full_name,
@@ -32,8 +252,8 @@ async def create_employee(
         user_id=current_user.user_id
     )
     db.add(new_employee)
-    db.commit()
-    db.refresh(new_employee)
+    await db.commit()
+    await db.refresh(new_employee)
     return new_employee
 
 @router.put("/{employee_id}", response_model=EmployeeResponse)
@@ -41,26 +261,28 @@ async def update_employee(
     employee_id: int,
     employee: EmployeeUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    db_employee = db.query(Employee).filter(Employee.employee_id == employee_id, Employee.user_id == current_user.user_id).first()
+    result = await db.execute(select(Employee).where(Employee.employee_id == employee_id, Employee.user_id == current_user.user_id))
+    db_employee = result.scalars().first()
     if not db_employee:
         return {"error": "Employee not found"}
     for field, value in employee.dict(exclude_unset=True).items():
         setattr(db_employee, field, value)
-    db.commit()
-    db.refresh(db_employee)
+    await db.commit()
+    await db.refresh(db_employee)
     return db_employee
 
 @router.delete("/{employee_id}")
 async def delete_employee(
     employee_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    db_employee = db.query(Employee).filter(Employee.employee_id == employee_id, Employee.user_id == current_user.user_id).first()
+    result = await db.execute(select(Employee).where(Employee.employee_id == employee_id, Employee.user_id == current_user.user_id))
+    db_employee = result.scalars().first()
     if not db_employee:
         raise HTTPException(status_code=404, detail="Employee not found")
-    db.delete(db_employee)
-    db.commit()
+    await db.delete(db_employee)
+    await db.commit()
     return {"detail": "Employee deleted"} 
\ No newline at end of file
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from jose import jwt
+
+from database import SessionLocal
+from events import EVENTS_HEARTBEAT, EVENTS_MAX_PER_USER, hub
+from routers.auth import get_current_user, oauth2_scheme
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+# Пауза перед переподключением, которую клиент получает в поле retry
+EVENTS_RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", "2000"))
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def event_stream(user_id: int, expires_at: float):
+    subscription = hub.subscribe(user_id)
+    try:
+        yield f"retry: {EVENTS_RETRY_MS}\n\n"
+        yield sse("ready", {})
+        while True:
+            timeout = min(EVENTS_HEARTBEAT, expires_at - time.time())
+            if timeout <= 0:
+                # Токен истёк: клиент обновит его и переподключится
+                yield sse("expired", {})
+                return
+            event = await subscription.get(timeout)
+            if event is None:
+                yield ": ping\n\n"
+                continue
+            event = dict(event)
+            yield sse(event.pop("type"), event)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+@router.get("/stream")
+async def stream_events(request: Request, token: Optional[str] = Depends(oauth2_scheme)):
+    """
+    Поток изменений арендатора (text/event-stream) вместо опроса REST:
+    change — {"table": "chats" | "chat_employees", "op", "chat_ids" (null — неизвестно какие)},
+    resync — изменения пропущены, перечитать всё; expired — токен истёк.
+    Токен только в заголовке Authorization: в строке запроса он попал бы в логи прокси.
+    """
+    # Сессия только на проверку токена: поток живёт часами и не должен держать соединение пула
+    async with SessionLocal() as db:
+        current_user = await get_current_user(request, token, db)
+    if hub.count(current_user.user_id) >= EVENTS_MAX_PER_USER:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many open event streams",
+            headers={"Retry-After": str(EVENTS_RETRY_MS // 1000 or 1)},
+        )
+    expires_at = jwt.get_unverified_claims(token).get("exp") or time.time() + 3600
+    return StreamingResponse(
+        event_stream(current_user.user_id, expires_at),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # nginx не должен буферизовать поток
+            "X-Accel-Buffering": "no",
+        },
+    )
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Dict, Optional, List
 from datetime import datetime
 
 class UserResponse(BaseModel):
@@ -18,6 +18,17 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class Principal(UserResponse):
+    """Snapshot of the authenticated user returned by get_current_user."""
+    token_version: int = 0
+
+    class Config:
+        from_attributes = True
+        frozen = True
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class BotBase(BaseModel):
     bot_name: str
     bot_token: str
@@ -40,6 +51,24 @@ class BotResponse(BotBase):
     class Config:
         from_attributes = True
 
+class ChatParticipant(BaseModel):
+    employee_id: int
+    full_name: str
+    telegram_username: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    is_active: Optional[bool] = None
+    is_external: Optional[bool] = None
+    # из chat_employees
+    is_admin: Optional[bool] = None
+    ce_is_active: Optional[bool] = None
+    ce_updated_at: Optional[datetime] = None
+
+class ChatParticipants(BaseModel):
+    chat_id: int
+    chat_title: Optional[str] = None
+    participants: List[ChatParticipant] = []
+
 class ChatResponse(BaseModel):
     chat_id: int
     bot_id: int
@@ -53,10 +82,19 @@ class ChatResponse(BaseModel):
     unknown_user: int
     created_at: datetime
     updated_at: datetime
+    active_members: int = 0
+    participants: Optional[List[ChatParticipant]] = None  # только с include=participants
 
     class Config:
         from_attributes = True
 
+class DashboardSummary(BaseModel):
+    chats: int = 0
+    chats_by_status: Dict[int, int] = {}
+    chats_with_unknown: int = 0
+    employees_active: int = 0
+    employees_inactive: int = 0
+
 class ChatTypeResponse(BaseModel):
     type_id: int
     type_name: str
@@ -100,6 +138,38 @@ class EmployeeUpdate(BaseModel):
     is_external: Optional[bool] = None
     is_bot: Optional[bool] = None
 
+class ImportRowResult(BaseModel):
+    row: int
+    status: str  # created / updated / unchanged / duplicate / error
+    employee_id: Optional[int] = None
+    error: Optional[str] = None
+
+class ImportResult(BaseModel):
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    duplicate: int = 0
+    error: int = 0
+    rows: List[ImportRowResult] = []
+
+class ParticipantRef(BaseModel):
+    chat_id: int
+    employee_id: int
+
+class ParticipantChange(ParticipantRef):
+    is_admin: Optional[bool] = None
+    ce_is_active: Optional[bool] = None
+    is_active: Optional[bool] = None
+    is_external: Optional[bool] = None
+
+class ParticipantBatch(BaseModel):
+    update: List[ParticipantChange] = []
+    delete: List[ParticipantRef] = []
+
+class ParticipantResult(ParticipantRef):
+    op: str
+    status: str  # updated / deleted / not_found
+
 class ChatCreate(BaseModel):
     bot_id: int
     telegram_chat_id: int
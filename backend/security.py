@@ -1,9 +1,77 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from metrics import REGISTRY
+
+# Стоимость bcrypt; хэши с другой стоимостью пересчитываются при следующем входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Сколько хэшей считается одновременно (потоков пула); bcrypt отпускает GIL
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Сколько операций может ждать пула, прежде чем отвечать 503
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = ThreadPoolExecutor(max_workers=max(1, PASSWORD_HASH_WORKERS), thread_name_prefix="password-hash")
+_slots = asyncio.Semaphore(max(1, PASSWORD_HASH_WORKERS))
+_waiting = 0
+
+HASH_QUEUE_SECONDS = REGISTRY.histogram(
+    "password_hash_queue_seconds", "Time a password operation waited for a hashing thread", ("op",))
+HASH_SECONDS = REGISTRY.histogram(
+    "password_hash_seconds", "Time spent hashing/verifying a password", ("op",))
+HASH_REJECTED = REGISTRY.counter(
+    "password_hash_rejected_total", "Password operations rejected because the queue was full", ("op",))
+REGISTRY.gauge("password_hash_waiting", "Password operations waiting for a hashing thread", callback=lambda: _waiting)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password) 
\ No newline at end of file
+    return pwd_context.hash(password)
+
+async def _run(op: str, func, *args):
+    # Не держим event loop на bcrypt: считаем в пуле, очередь к пулу ограничена
+    global _waiting
+    if _waiting >= PASSWORD_HASH_MAX_QUEUE:
+        HASH_REJECTED.inc(op)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent password operations, try again later",
+            headers={"Retry-After": "1"},
+        )
+    queued_at = time.perf_counter()
+    _waiting += 1
+    try:
+        await _slots.acquire()
+    finally:
+        _waiting -= 1
+    try:
+        HASH_QUEUE_SECONDS.observe(time.perf_counter() - queued_at, op)
+        with HASH_SECONDS.time(op):
+            return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _slots.release()
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", pwd_context.hash, password)
+
+async def check_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password off the event loop.
+
+    Returns (valid, new_hash); new_hash is set when the stored hash uses a
+    different bcrypt cost than BCRYPT_ROUNDS and should be saved.
+    """
+    return await _run("verify", pwd_context.verify_and_update, password, hashed_password)
@@ -0,0 +1,145 @@
+"""Request coalescing for identical concurrent reads.
+
+While one request runs a list query, identical requests arriving in the
+meantime (same tenant, route, query string and If-None-Match) wait for it
+and get a copy of its response instead of running the query and the
+serialization again. With SINGLEFLIGHT_TTL > 0 the finished response is
+also reused for that many seconds, which absorbs a burst of reconnecting
+clients after a deploy at the price of that much staleness.
+
+Coalescing is per process; a user who has just written is never coalesced,
+so read-your-writes (db_routing.py) still holds.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+from db_routing import wrote_recently
+from metrics import REGISTRY
+from timing import record_phase
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") == "1"
+# Сколько секунд отдавать готовый ответ повторно; 0 — только объединение одновременных запросов
+SINGLEFLIGHT_TTL = float(os.getenv("SINGLEFLIGHT_TTL", "0"))
+SINGLEFLIGHT_MAX_ENTRIES = int(os.getenv("SINGLEFLIGHT_MAX_ENTRIES", "1000"))
+
+COALESCED = REGISTRY.counter(
+    "singleflight_requests_total", "Coalescable reads by outcome (leader, shared, cached, bypass)", ("route", "outcome"))
+
+
+class SingleFlight:
+    """Runs one call per key at a time and hands its result to every waiter."""
+
+    def __init__(self, ttl: float = SINGLEFLIGHT_TTL, max_entries: int = SINGLEFLIGHT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def _cached(self, key):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._results[key]
+            return None
+        return entry
+
+    def _store(self, key, result):
+        now = time.monotonic()
+        if len(self._results) >= self.max_entries:
+            for stale in [k for k, (expires_at, _) in self._results.items() if expires_at <= now]:
+                del self._results[stale]
+            if len(self._results) >= self.max_entries:
+                self._results.pop(next(iter(self._results)))
+        self._results[key] = (now + self.ttl, result)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, str]:
+        """Return (result, outcome), outcome being "leader", "shared" or "cached"."""
+        while True:
+            if self.ttl > 0:
+                entry = self._cached(key)
+                if entry is not None:
+                    return entry[1], "cached"
+            call = self._calls.get(key)
+            if call is None:
+                return await self._lead(key, fn), "leader"
+            try:
+                return await asyncio.shield(call), "shared"
+            except asyncio.CancelledError:
+                # Отменили ведущий запрос (клиент ушёл), а не нас — выполняем сами
+                if call.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+    async def _lead(self, key, fn):
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # Ждущих может не быть — помечаем исключение полученным, чтобы asyncio не ругался в лог
+            call.exception()
+            raise
+        finally:
+            self._calls.pop(key, None)
+        call.set_result(result)
+        if self.ttl > 0:
+            self._store(key, result)
+        return result
+
+
+reads = SingleFlight()
+
+_adapters: Dict[Any, TypeAdapter] = {}
+
+
+def _adapter(response_model) -> TypeAdapter:
+    if response_model not in _adapters:
+        _adapters[response_model] = TypeAdapter(response_model)
+    return _adapters[response_model]
+
+
+async def coalesce(request: Request, user_id: int, response_model, build: Callable[[Response], Awaitable[Any]]) -> Response:
+    """Run build(response) once for identical concurrent requests of a tenant.
+
+    build is the body of a GET handler: it may set headers on the response it
+    receives (ETag, pagination) and returns either a Response (e.g. the 304 of
+    check_etag) or data of response_model. The serialized body and headers
+    are shared, every caller gets its own Response.
+    """
+    route = request.scope["route"].path
+
+    async def run():
+        scratch = Response()
+        result = await build(scratch)
+        if isinstance(result, Response):
+            status_code, body = result.status_code, result.body
+            scratch.headers.update(result.headers)
+        else:
+            adapter = _adapter(response_model)
+            started = time.perf_counter()
+            status_code, body = 200, adapter.dump_json(adapter.validate_python(result, from_attributes=True))
+            record_phase("serialize", time.perf_counter() - started)
+        # content-length посчитает Response каждого запроса
+        headers = {k: v for k, v in scratch.headers.items() if k != "content-length"}
+        return status_code, headers, body
+
+    if not SINGLEFLIGHT_ENABLED or wrote_recently(request, user_id):
+        (status_code, headers, body), outcome = await run(), "bypass"
+    else:
+        key = (user_id, request.url.path, tuple(sorted(request.query_params.multi_items())),
+               request.headers.get("if-none-match"))
+        (status_code, headers, body), outcome = await reads.do(key, run)
+    COALESCED.inc(route, outcome)
+    if status_code == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, status_code=status_code, headers=headers, media_type="application/json")
@@ -0,0 +1,240 @@
+"""Per-request timing: Server-Timing header, slow statements, N+1 detection.
+
+RequestTiming (outermost ASGI middleware) keeps a RequestTimings in a
+context variable for the duration of the request; the phases are filled in
+as the request goes:
+
+- auth: get_current_user (decorated with timed("auth"));
+- db: every statement, via SQLAlchemy cursor events on all engines;
+- handler: the endpoint function (instrument_routes wraps every route);
+- serialize: from the end of the endpoint to the response start, i.e.
+  response_model validation and JSON rendering;
+- total: until the response start.
+
+They are returned in Server-Timing and observed into per-route histograms.
+A statement slower than SLOW_QUERY_MS is logged with the types of its
+parameters (never their values). A request that runs the same statement
+N_PLUS_ONE_THRESHOLD times or more is logged as a probable N+1.
+"""
+import asyncio
+import functools
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Сколько одинаковых запросов за один HTTP-запрос считать признаком N+1; 0 — не проверять
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time to response start by route", ("method", "route", "status"))
+PHASE_SECONDS = REGISTRY.histogram(
+    "http_request_phase_seconds", "Time spent per request phase (auth, db, handler, serialize)", ("route", "phase"))
+DB_STATEMENTS = REGISTRY.histogram(
+    "http_request_db_statements", "SQL statements per request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+SLOW_STATEMENTS = REGISTRY.counter("db_slow_statements_total", "Statements slower than SLOW_QUERY_MS", ("route",))
+N_PLUS_ONE = REGISTRY.counter(
+    "db_n_plus_one_total", "Requests that repeated one statement N_PLUS_ONE_THRESHOLD times or more", ("route",))
+
+PHASES = ("auth", "db", "handler", "serialize")
+
+# $1, $2, ... (и списки IN ($1, $2)) — к одному виду, чтобы одинаковые запросы с разными параметрами совпадали
+_PLACEHOLDERS = re.compile(r"\$\d+(?:\s*,\s*\$\d+)*")
+
+
+def route_of(scope) -> str:
+    route = scope.get("route")
+    # Несовпавшие пути не пишем в метки как есть — их число не ограничено
+    return getattr(route, "path", None) or "unmatched"
+
+
+class RequestTimings:
+    def __init__(self, scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.statements: Counter = Counter()
+        self.handler_end: Optional[float] = None
+        self.response_start: Optional[float] = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def mark_response_start(self):
+        self.response_start = time.perf_counter()
+        if self.handler_end is not None:
+            self.add("serialize", self.response_start - self.handler_end)
+
+    @property
+    def total(self) -> float:
+        return (self.response_start or time.perf_counter()) - self.started
+
+    def header(self) -> str:
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items() if name != "db"]
+        parts.insert(1, f'db;dur={self.phases["db"] * 1000:.1f};desc="{sum(self.statements.values())} queries"')
+        parts.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def record_phase(phase: str, seconds: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+def timed(phase: str):
+    """Decorator adding the duration of a coroutine function to a phase."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            timings = _current.get()
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                if timings is not None:
+                    timings.add(phase, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def _timed_endpoint(fn):
+    def record(timings, started):
+        if timings is not None:
+            timings.handler_end = time.perf_counter()
+            timings.add("handler", timings.handler_end - started)
+
+    # Синхронные обработчики FastAPI выполняет в пуле потоков — обёртка должна остаться синхронной
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            timings, started = _current.get(), time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                record(timings, started)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings, started = _current.get(), time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(timings, started)
+    return wrapper
+
+
+def instrument_routes(app):
+    """Time the endpoint function of every API route; call after include_router."""
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not getattr(route.dependant.call, "_timed", False):
+            route.dependant.call = _timed_endpoint(route.dependant.call)
+            route.dependant.call._timed = True
+
+
+def bind_shape(parameters):
+    """Types of statement parameters, without their values."""
+    if isinstance(parameters, list) and parameters and isinstance(parameters[0], (tuple, dict)):
+        return f"{len(parameters)} x {bind_shape(parameters[0])}"  # executemany
+    if isinstance(parameters, dict):
+        return {key: bind_shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, tuple):
+        shapes = [bind_shape(value) for value in parameters]
+        if len(shapes) > 10:
+            # Длинный IN (...) — только сколько значений какого типа
+            return ", ".join(f"{count} x {shape}" for shape, count in Counter(map(str, shapes)).items())
+        return shapes
+    if isinstance(parameters, (list, set)):
+        return f"{type(parameters).__name__}[{len(parameters)}]"
+    return type(parameters).__name__
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    timings = _current.get()
+    route = route_of(timings.scope) if timings is not None else "-"
+    if timings is not None:
+        timings.add("db", elapsed)
+        timings.statements[_PLACEHOLDERS.sub("?", statement)] += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_STATEMENTS.inc(route)
+        logger.warning(
+            f"Slow statement {elapsed * 1000:.0f} ms on {route}: {' '.join(statement.split())[:500]} "
+            f"params={bind_shape(parameters)}")
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute не вызывается при ошибке — снимаем время начала сами
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+class RequestTiming:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings(scope)
+        token = _current.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings.mark_response_start()
+                if SERVER_TIMING_ENABLED:
+                    message = {**message, "headers": [
+                        *message.get("headers", []),
+                        (b"server-timing", timings.header().encode()),
+                        # Без этого браузер не покажет Server-Timing ответа с другого origin
+                        (b"timing-allow-origin", b"*"),
+                    ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            self.finish(scope, timings, status)
+
+    def finish(self, scope, timings: RequestTimings, status: int):
+        route = route_of(scope)
+        REQUEST_SECONDS.observe(timings.total, scope["method"], route, str(status))
+        for name, seconds in timings.phases.items():
+            PHASE_SECONDS.observe(seconds, route, name)
+        DB_STATEMENTS.observe(sum(timings.statements.values()), route)
+        if N_PLUS_ONE_THRESHOLD > 0 and timings.statements:
+            statement, count = timings.statements.most_common(1)[0]
+            if count >= N_PLUS_ONE_THRESHOLD:
+                N_PLUS_ONE.inc(route)
+                logger.warning(
+                    f"Probable N+1 on {scope['method']} {route}: {count} x {' '.join(statement.split())[:300]}")
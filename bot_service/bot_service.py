@@ -2,37 +2,160 @@ import os
 import logging
 import time
 import asyncio
+import functools
+import re
+import signal
 from datetime import datetime
 import aiohttp
 import asyncpg
 from dotenv import load_dotenv
+from scheduler import TenantScheduler, parse_weights
+from write_buffer import ChatWriteBuffer
+from db_pool import InstrumentedPool
+from metrics import REGISTRY, start_http_server
+from diagnostics import Diagnostics, LoopWatchdog
+from log_setup import bot_logger, configure_logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+CYCLE_SECONDS = REGISTRY.histogram('bot_service_cycle_seconds', 'Duration of a full processing cycle')
+CYCLE_OVERRUNS = REGISTRY.counter('bot_service_cycle_overruns_total', 'Cycles that took longer than SERVICE_INTERVAL')
+TELEGRAM_SECONDS = REGISTRY.histogram('telegram_request_seconds', 'Telegram Bot API latency until response headers', ('method', 'bot'))
+TELEGRAM_REQUESTS = REGISTRY.counter('telegram_requests_total', 'Telegram Bot API requests by HTTP status', ('method', 'bot', 'status'))
+TELEGRAM_RATE_LIMITED = REGISTRY.counter('telegram_rate_limited_total', 'Telegram Bot API 429 responses', ('method', 'bot'))
+DB_STATEMENT_SECONDS = REGISTRY.histogram('db_statement_seconds', 'Database statement latency', ('statement',))
+DB_STATEMENT_ERRORS = REGISTRY.counter('db_statement_errors_total', 'Database statements that raised', ('statement',))
+UPDATES_BATCH = REGISTRY.gauge('telegram_updates_batch_size', 'Updates returned by the last getUpdates call', ('bot',))
+UPDATE_OFFSET = REGISTRY.gauge('telegram_update_offset', 'Current getUpdates offset', ('bot',))
+
+_TABLE_RE = re.compile(r'\b(?:from|into|update)\s+(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def statement_label(query):
+    # "UPDATE chats AS c SET ..." -> "UPDATE chats": глагол и первая таблица, чтобы метка не зависела от параметров
+    words = query.split(None, 1)
+    verb = words[0].upper() if words else ''
+    match = _TABLE_RE.search(query)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
 class BotService:
     def __init__(self):
         self.db_url = os.getenv('DATABASE_URL', '')
         self.interval = int(os.getenv('SERVICE_INTERVAL', '30'))
         self.pool = None
+        # Лимиты пула asyncpg; acquire дольше таймаута — ошибка, а не бесконечное ожидание
+        self.pool_min_size = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+        self.pool_max_size = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+        self.pool_acquire_timeout = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+        self.pool_max_idle = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '300'))
         self.bots = []
         self.chats = []
         self.employees = []
         self.chat_employees = []
+        self.member_counts = {}  # chat_id -> активные связи (chats.active_members с поправками этого цикла)
         self.offsets = {}  # offset для каждого бота
+        # all — грузим все таблицы целиком, stream — по одному арендатору (user_id) за раз
+        self.load_mode = os.getenv('LOAD_MODE', 'all')
+        # Справедливое распределение работы между арендаторами: TENANT_WEIGHTS="12:3,45:2"
+        self.tenant_weights = parse_weights(os.getenv('TENANT_WEIGHTS', ''))
+        self.scheduler_concurrency = int(os.getenv('SCHEDULER_CONCURRENCY', '4'))
+        # В режиме stream столько арендаторов загружается и планируется вместе: больше — планировщику есть
+        # кого чередовать, но в памяти данные всех арендаторов пачки
+        self.stream_tenant_batch = max(1, int(os.getenv('STREAM_TENANT_BATCH', '1')))
+        self.scheduler = None
+        # Результаты аудита чатов пишутся пачками, а не отдельным UPDATE на каждый чат
+        self.write_buffer_interval = float(os.getenv('WRITE_BUFFER_INTERVAL', '1.0'))
+        self.write_buffer_max = int(os.getenv('WRITE_BUFFER_MAX', '500'))
+        self.chat_writes = None
+        self.metrics_host = os.getenv('METRICS_HOST', '0.0.0.0')
+        self.metrics_port = int(os.getenv('METRICS_PORT', '9100'))
+        # Диагностика: локальный admin endpoint, сигналы SIGUSR1/SIGUSR2 и сторож блокировок event loop
+        self.diag_host = os.getenv('DIAG_HOST', '127.0.0.1')
+        self.diag_port = int(os.getenv('DIAG_PORT', '9101'))
+        self.diag_profile_seconds = float(os.getenv('DIAG_SIGNAL_PROFILE_SECONDS', '30'))
+        self.loop_block_threshold = float(os.getenv('LOOP_BLOCK_THRESHOLD', '0.5'))
+        self.diagnostics = Diagnostics(os.getenv('DIAG_DIR', '/tmp/bot_service_diag'))
+        self.bot_labels = {}  # bot_token -> bot_id для меток метрик Telegram
+        self.telegram_trace = self.build_telegram_trace()
+
+    def register_metrics(self):
+        REGISTRY.gauge('bot_service_cache_rows', 'Rows held in memory for the current cycle', ('table',), lambda: {
+            'bots': len(self.bots),
+            'chats': len(self.chats),
+            'employees': len(self.employees),
+            'chat_employees': len(self.chat_employees),
+        })
+        REGISTRY.gauge('db_pool_connections', 'asyncpg pool connections by state', ('state',), lambda: {
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+            'in_use': self.pool.get_size() - self.pool.get_idle_size(),
+            'max': self.pool.get_max_size(),
+        } if self.pool else {})
+        REGISTRY.gauge('chat_write_buffer_pending', 'Chats with buffered, unflushed updates',
+                       callback=lambda: len(self.chat_writes.pending) if self.chat_writes else 0)
+        REGISTRY.gauge('scheduler_queue_depth', 'Jobs waiting in the current cycle per tenant', ('tenant',),
+                       lambda: self.scheduler.queue_depths() if self.scheduler else {})
+
+    def build_telegram_trace(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = time.perf_counter()
+
+        async def on_request_end(session, ctx, params):
+            self.observe_telegram(params.url, params.response.status, ctx.start)
+
+        async def on_request_exception(session, ctx, params):
+            self.observe_telegram(params.url, 'error', ctx.start)
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+    def observe_telegram(self, url, status, start):
+        # Путь вида /bot<token>/<method>
+        parts = url.path.split('/')
+        if len(parts) < 3 or not parts[1].startswith('bot'):
+            return
+        method = parts[2]
+        bot = self.bot_labels.get(parts[1][3:], 'unknown')
+        TELEGRAM_SECONDS.observe(time.perf_counter() - start, method, bot)
+        TELEGRAM_REQUESTS.inc(method, bot, status)
+        if status == 429:
+            TELEGRAM_RATE_LIMITED.inc(method, bot)
+
+    def http_session(self):
+        return aiohttp.ClientSession(trace_configs=[self.telegram_trace])
+
+    @staticmethod
+    def observe_query(record):
+        label = statement_label(record.query)
+        DB_STATEMENT_SECONDS.observe(record.elapsed, label)
+        if record.exception is not None:
+            DB_STATEMENT_ERRORS.inc(label)
+
+    async def init_connection(self, conn):
+        conn.add_query_logger(self.observe_query)
 
     async def init_db(self):
         try:
-            self.pool = await asyncpg.create_pool(self.db_url)
+            pool = await asyncpg.create_pool(
+                self.db_url,
+                init=self.init_connection,
+                min_size=min(self.pool_min_size, self.pool_max_size),
+                max_size=self.pool_max_size,
+                max_inactive_connection_lifetime=self.pool_max_idle,
+            )
+            self.pool = InstrumentedPool(pool, self.pool_acquire_timeout)
+            self.chat_writes = ChatWriteBuffer(self.pool, self.write_buffer_interval, self.write_buffer_max)
         except Exception as e:
-            logger.error(f"Failed to initialize DB: {e}")
+            logger.error("Failed to initialize DB: %s", e)
             raise
 
     async def load_all_data(self):
@@ -42,24 +165,68 @@ class BotService:
                 self.chats = await conn.fetch("SELECT * FROM chats")
                 self.employees = await conn.fetch("SELECT * FROM employees")
                 self.chat_employees = await conn.fetch("SELECT * FROM chat_employees")
-            logger.info(f"Loaded {len(self.bots)} bots, {len(self.chats)} chats, {len(self.employees)} employees, {len(self.chat_employees)} chat_employees")
+            self.load_member_counts()
+            logger.info("Loaded %s bots, %s chats, %s employees, %s chat_employees", len(self.bots), len(self.chats), len(self.employees), len(self.chat_employees))
         except Exception as e:
-            logger.error(f"Failed to load data: {e}")
+            logger.error("Failed to load data: %s", e)
+
+    async def load_tenant_ids(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT DISTINCT user_id FROM bots WHERE is_active = true ORDER BY user_id")
+        return [r['user_id'] for r in rows]
+
+    async def load_tenant_data(self, user_ids):
+        async with self.pool.acquire() as conn:
+            self.bots = await conn.fetch("SELECT * FROM bots WHERE is_active = true AND user_id = ANY($1::int[])", user_ids)
+            self.chats = await conn.fetch("SELECT * FROM chats WHERE user_id = ANY($1::int[])", user_ids)
+            self.employees = await conn.fetch("SELECT * FROM employees WHERE user_id = ANY($1::int[])", user_ids)
+            self.chat_employees = await conn.fetch("SELECT * FROM chat_employees WHERE user_id = ANY($1::int[])", user_ids)
+        self.load_member_counts()
+        logger.info("Tenants %s: loaded %s bots, %s chats, %s employees, %s chat_employees", user_ids, len(self.bots), len(self.chats), len(self.employees), len(self.chat_employees))
+
+    def load_member_counts(self):
+        # Активные связи чата считает триггер (chats.active_members) — берём из загруженных строк,
+        # а изменения этого цикла (кик, вход, выход) учитываем сами, без запроса на каждый чат
+        self.member_counts = {c['chat_id']: c['active_members'] or 0 for c in self.chats}
+
+    def active_members(self, chat_id):
+        return self.member_counts.get(chat_id, 0)
+
+    def adjust_members(self, chat_id, delta):
+        self.member_counts[chat_id] = self.member_counts.get(chat_id, 0) + delta
+
+    def set_link_active(self, link, active):
+        # Локальная копия связи следует за UPDATE: иначе следующее сообщение повторит запись и сдвинет счётчик ещё раз
+        if isinstance(link, dict):
+            link['is_active'] = active
+        else:
+            updated = dict(link, is_active=active)
+            self.chat_employees = [updated if l is link else l for l in self.chat_employees]
+        self.adjust_members(link['chat_id'], 1 if active else -1)
+
+    def release_tenant_data(self):
+        self.bots = []
+        self.chats = []
+        self.employees = []
+        self.chat_employees = []
+        self.member_counts = {}
 
     async def fetch_updates(self, bot_token, bot_id):
+        log = bot_logger(logger, bot_id)
         url = f"https://api.telegram.org/bot{bot_token}/getUpdates"
         params = {}
         current_offset = self.offsets.get(bot_id)
-        logger.info(f"Bot {bot_id}: Calling getUpdates with offset={current_offset}")
+        log.debug("Bot %s: Calling getUpdates with offset=%s", bot_id, current_offset)
         if current_offset is not None:
             params['offset'] = current_offset
-        async with aiohttp.ClientSession() as session:
+        async with self.http_session() as session:
             async with session.get(url, params=params) as response:
                 if response.status == 200:
                     data = await response.json()
                     if data.get("ok"):
                         updates = data.get("result", [])
-                        logger.info(f"Bot {bot_id}: Updates: {updates}")
+                        UPDATES_BATCH.set(len(updates), bot_id)
+                        log.debug("Bot %s: Updates: %s", bot_id, updates)
                         if current_offset is None:
                             # Первый запуск: просто установить offset, не обрабатывать updates
                             max_update_id = None
@@ -70,7 +237,8 @@ class BotService:
                                         max_update_id = update_id
                             if max_update_id is not None:
                                 self.offsets[bot_id] = max_update_id + 1
-                                logger.info(f"Bot {bot_id}: Initial offset set to {max_update_id + 1}")
+                                UPDATE_OFFSET.set(max_update_id + 1, bot_id)
+                                log.info("Bot %s: Initial offset set to %s", bot_id, max_update_id + 1)
                             return []
                         # Обычная обработка
                         max_update_id = current_offset
@@ -81,7 +249,8 @@ class BotService:
                                     max_update_id = update_id + 1
                         if max_update_id is not None:
                             self.offsets[bot_id] = max_update_id
-                            logger.info(f"Bot {bot_id}: Updated offset to {max_update_id}")
+                            UPDATE_OFFSET.set(max_update_id, bot_id)
+                            log.debug("Bot %s: Updated offset to %s", bot_id, max_update_id)
                         return updates
         return []
 
@@ -89,11 +258,12 @@ class BotService:
         url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
         text = f"привет я бот-консьерж ({bot_name}). Я не сохраняю сообщение. Напиши мне пару слов, что бы я тебя узнал"
         params = {"chat_id": chat_id, "text": text}
-        async with aiohttp.ClientSession() as session:
+        async with self.http_session() as session:
             await session.get(url, params=params)
 
     async def process_update(self, msg, user_id, bot_id, conn):
-        logger.info(f"Processing message for user_id={user_id}, bot_id={bot_id}, msg={msg}")
+        log = bot_logger(logger, bot_id)
+        log.debug("Processing message for user_id=%s, bot_id=%s, msg=%s", user_id, bot_id, msg)
         chat = msg.get('chat')
         if not chat:
             return
@@ -102,7 +272,7 @@ class BotService:
         db_chat = next((c for c in self.chats if c['telegram_chat_id'] == telegram_chat_id and c['bot_id'] == bot_id and c['user_id'] == user_id), None)
         chat_was_created = False
         if not db_chat:
-            logger.info(f"Creating new chat telegram_chat_id={telegram_chat_id} bot_id={bot_id} user_id={user_id}")
+            log.info("Creating new chat telegram_chat_id=%s bot_id=%s user_id=%s", telegram_chat_id, bot_id, user_id)
             await conn.execute("""
                 INSERT INTO chats (bot_id, telegram_chat_id, type_id, status_id, user_num, unknown_user, created_at, updated_at, title, user_id)
                 VALUES ($1, $2, 4, 1, 0, 0, NOW(), NOW(), $3, $4)
@@ -122,7 +292,7 @@ class BotService:
             chat_was_created = True
         else:
             if title and (not db_chat['title'] or db_chat['title'][0] != title):
-                logger.info(f"Updating chat title for chat_id={db_chat['chat_id']} to {title}")
+                log.info("Updating chat title for chat_id=%s to %s", db_chat['chat_id'], title)
                 await conn.execute("""
                     UPDATE chats SET title = $1, updated_at = NOW() WHERE chat_id = $2
                 """, [title], db_chat['chat_id'])
@@ -136,7 +306,7 @@ class BotService:
             if bot_telegram_user_id:
                 db_bot_employee = next((e for e in self.employees if e['telegram_user_id'] == bot_telegram_user_id and e['user_id'] == user_id and e.get('is_bot')), None)
                 if not db_bot_employee:
-                    logger.info(f"Creating bot employee for bot_telegram_user_id={bot_telegram_user_id} user_id={user_id}")
+                    log.info("Creating bot employee for bot_telegram_user_id=%s user_id=%s", bot_telegram_user_id, user_id)
                     await conn.execute("""
                         INSERT INTO employees (full_name, telegram_username, telegram_user_id, is_external, is_active, is_bot, created_at, updated_at, user_id)
                         VALUES ($1, $2, $3, false, true, true, NOW(), NOW(), $4)
@@ -156,7 +326,7 @@ class BotService:
                     })
                 db_bot_link = next((l for l in self.chat_employees if l['chat_id'] == chat_id and l['employee_id'] == db_bot_employee['employee_id'] and l['user_id'] == user_id), None)
                 if not db_bot_link:
-                    logger.info(f"Creating bot chat_employees link for chat_id={chat_id} employee_id={db_bot_employee['employee_id']} user_id={user_id}")
+                    log.info("Creating bot chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, db_bot_employee['employee_id'], user_id)
                     await conn.execute("""
                         INSERT INTO chat_employees (chat_id, employee_id, is_active, is_admin, created_at, updated_at, user_id)
                         VALUES ($1, $2, true, false, NOW(), NOW(), $3)
@@ -168,13 +338,13 @@ class BotService:
                         'is_active': True,
                         'is_admin': False
                     })
+                    self.adjust_members(chat_id, 1)
                 elif not db_bot_link['is_active']:
-                    logger.info(f"Activating bot chat_employees link for chat_id={chat_id} employee_id={db_bot_employee['employee_id']} user_id={user_id}")
+                    log.info("Activating bot chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, db_bot_employee['employee_id'], user_id)
                     await conn.execute("""
                         UPDATE chat_employees SET is_active = true, updated_at = NOW() WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3
                     """, chat_id, db_bot_employee['employee_id'], user_id)
-                    if isinstance(db_bot_link, dict):
-                        db_bot_link['is_active'] = True
+                    self.set_link_active(db_bot_link, True)
         # 2. ПОЛЬЗОВАТЕЛЬ
         user = None
         if 'from' in msg:
@@ -191,7 +361,7 @@ class BotService:
             if not db_employee and username:
                 db_employee = next((e for e in self.employees if e['telegram_username'] == username and e['user_id'] == user_id), None)
                 if db_employee and not db_employee['telegram_user_id']:
-                    logger.info(f"Updating employee {db_employee['employee_id']} set telegram_user_id={telegram_user_id}")
+                    log.info("Updating employee %s set telegram_user_id=%s", db_employee['employee_id'], telegram_user_id)
                     await conn.execute(
                         """UPDATE employees SET telegram_user_id = $1, updated_at = NOW() WHERE employee_id = $2""",
                         telegram_user_id, db_employee['employee_id']
@@ -200,7 +370,7 @@ class BotService:
                         """SELECT * FROM employees WHERE employee_id = $1""", db_employee['employee_id']
                     )
             if not db_employee:
-                logger.info(f"Creating employee for telegram_user_id={telegram_user_id} user_id={user_id} full_name={full_name} username={username}")
+                log.info("Creating employee for telegram_user_id=%s user_id=%s full_name=%s username=%s", telegram_user_id, user_id, full_name, username)
                 await conn.execute(
                     """INSERT INTO employees (full_name, telegram_username, telegram_user_id, is_external, is_active, is_bot, created_at, updated_at, user_id)
                     VALUES ($1, $2, $3, true, true, false, NOW(), NOW(), $4)""",
@@ -211,14 +381,14 @@ class BotService:
                 )
             else:
                 if db_employee['full_name'] != full_name or db_employee['telegram_username'] != username:
-                    logger.info(f"Updating employee employee_id={db_employee['employee_id']} full_name={full_name} username={username}")
+                    log.info("Updating employee employee_id=%s full_name=%s username=%s", db_employee['employee_id'], full_name, username)
                     await conn.execute("""
                         UPDATE employees SET full_name = $1, telegram_username = $2, updated_at = NOW() WHERE employee_id = $3
                     """, full_name, username, db_employee['employee_id'])
             employee_id = db_employee['employee_id']
             db_link = next((l for l in self.chat_employees if l['chat_id'] == chat_id and l['employee_id'] == employee_id and l['user_id'] == user_id), None)
             if not db_link:
-                logger.info(f"Creating chat_employees link for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                log.info("Creating chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
                 await conn.execute("""
                     INSERT INTO chat_employees (chat_id, employee_id, is_active, is_admin, created_at, updated_at, user_id)
                     VALUES ($1, $2, true, false, NOW(), NOW(), $3)
@@ -230,15 +400,15 @@ class BotService:
                     'is_active': True,
                     'is_admin': False
                 })
+                self.adjust_members(chat_id, 1)
             elif not db_link['is_active']:
-                logger.info(f"Activating chat_employees link for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                log.info("Activating chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
                 await conn.execute("""
                     UPDATE chat_employees SET is_active = true, updated_at = NOW() WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3
                 """, chat_id, employee_id, user_id)
-                if isinstance(db_link, dict):
-                    db_link['is_active'] = True
+                self.set_link_active(db_link, True)
             else:
-                logger.info(f"chat_employees link already active for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                log.debug("chat_employees link already active for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
         if 'new_chat_members' in msg:
             for member in msg['new_chat_members']:
                 telegram_user_id = member.get('id')
@@ -248,7 +418,7 @@ class BotService:
                 if not db_employee and username:
                     db_employee = next((e for e in self.employees if e['telegram_username'] == username and e['user_id'] == user_id), None)
                     if db_employee and not db_employee['telegram_user_id']:
-                        logger.info(f"Updating employee {db_employee['employee_id']} set telegram_user_id={telegram_user_id}")
+                        log.info("Updating employee %s set telegram_user_id=%s", db_employee['employee_id'], telegram_user_id)
                         await conn.execute(
                             """UPDATE employees SET telegram_user_id = $1, updated_at = NOW() WHERE employee_id = $2""",
                             telegram_user_id, db_employee['employee_id']
@@ -257,7 +427,7 @@ class BotService:
                             """SELECT * FROM employees WHERE employee_id = $1""", db_employee['employee_id']
                         )
                 if not db_employee:
-                    logger.info(f"Creating employee for telegram_user_id={telegram_user_id} user_id={user_id} full_name={full_name} username={username}")
+                    log.info("Creating employee for telegram_user_id=%s user_id=%s full_name=%s username=%s", telegram_user_id, user_id, full_name, username)
                     await conn.execute(
                         """INSERT INTO employees (full_name, telegram_username, telegram_user_id, is_external, is_active, is_bot, created_at, updated_at, user_id)
                         VALUES ($1, $2, $3, true, true, false, NOW(), NOW(), $4)""",
@@ -268,14 +438,14 @@ class BotService:
                     )
                 else:
                     if db_employee['full_name'] != full_name or db_employee['telegram_username'] != username:
-                        logger.info(f"Updating employee employee_id={db_employee['employee_id']} full_name={full_name} username={username}")
+                        log.info("Updating employee employee_id=%s full_name=%s username=%s", db_employee['employee_id'], full_name, username)
                         await conn.execute("""
                             UPDATE employees SET full_name = $1, telegram_username = $2, updated_at = NOW() WHERE employee_id = $3
                         """, full_name, username, db_employee['employee_id'])
                 employee_id = db_employee['employee_id']
                 db_link = next((l for l in self.chat_employees if l['chat_id'] == chat_id and l['employee_id'] == employee_id and l['user_id'] == user_id), None)
                 if not db_link:
-                    logger.info(f"Creating chat_employees link for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                    log.info("Creating chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
                     await conn.execute("""
                         INSERT INTO chat_employees (chat_id, employee_id, is_active, is_admin, created_at, updated_at, user_id)
                         VALUES ($1, $2, true, false, NOW(), NOW(), $3)
@@ -287,17 +457,18 @@ class BotService:
                         'is_active': True,
                         'is_admin': False
                     })
+                    self.adjust_members(chat_id, 1)
                 elif not db_link['is_active']:
-                    logger.info(f"Activating chat_employees link for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                    log.info("Activating chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
                     await conn.execute("""
                         UPDATE chat_employees SET is_active = true, updated_at = NOW() WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3
                     """, chat_id, employee_id, user_id)
-                    if isinstance(db_link, dict):
-                        db_link['is_active'] = True
+                    self.set_link_active(db_link, True)
                 else:
-                    logger.info(f"chat_employees link already active for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                    log.debug("chat_employees link already active for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
 
     async def process_left_event(self, msg, user_id, bot_id, conn):
+        log = bot_logger(logger, bot_id)
         chat = msg.get('chat')
         if not chat:
             return
@@ -324,13 +495,11 @@ class BotService:
         # Деактивируем все связи пользователя с этим чатом
         for link in self.chat_employees:
             if link['chat_id'] == chat_id and link['employee_id'] == employee_id and link['user_id'] == user_id and link['is_active']:
-                logger.info(f"Deactivating chat_employees link for chat_id={chat_id} employee_id={employee_id} user_id={user_id}")
+                log.info("Deactivating chat_employees link for chat_id=%s employee_id=%s user_id=%s", chat_id, employee_id, user_id)
                 await conn.execute("""
                     UPDATE chat_employees SET is_active = false, updated_at = NOW() WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3
                 """, chat_id, employee_id, user_id)
-                # Обновляем локально только если link — dict
-                if isinstance(link, dict):
-                    link['is_active'] = False
+                self.set_link_active(link, False)
 
     async def handle_update(self, update, user_id, bot_id, conn):
         msg = update.get('message')
@@ -355,281 +524,349 @@ class BotService:
                 await self.process_update({'chat': my_chat_member['chat'], 'new_chat_member': my_chat_member['new_chat_member']['user']}, user_id, bot_id, conn)
 
     async def run_cycle(self):
+        if self.load_mode == 'stream':
+            await self.run_cycle_streaming()
+            return
         await self.load_all_data()
-        for bot in self.bots:
-            bot_token = bot['bot_token']
-            bot_id = bot['bot_id']
-            user_id = bot['user_id']
-            # Проверка чатов бота
-            for chat in self.chats:
-                if chat['bot_id'] != bot_id or chat['user_id'] != user_id:
+        await self.schedule_bots(self.bots)
+        await self.chat_writes.flush()
+
+    async def run_cycle_streaming(self):
+        # В памяти только данные текущей пачки арендаторов: пик памяти — stream_tenant_batch крупнейших.
+        # Арендаторы пачки планируются вместе, чтобы веса и параллельность планировщика работали и здесь
+        try:
+            tenant_ids = await self.load_tenant_ids()
+        except Exception as e:
+            logger.error("Failed to load tenants: %s", e)
+            return
+        for start in range(0, len(tenant_ids), self.stream_tenant_batch):
+            batch = tenant_ids[start:start + self.stream_tenant_batch]
+            try:
+                await self.load_tenant_data(batch)
+                await self.schedule_bots(self.bots)
+                await self.chat_writes.flush()
+            except Exception as e:
+                logger.error("Tenants %s: failed to process: %s", batch, e)
+            finally:
+                self.release_tenant_data()
+
+    async def schedule_bots(self, bots):
+        scheduler = TenantScheduler(self.tenant_weights, concurrency=self.scheduler_concurrency)
+        for bot in bots:
+            self.bot_labels[bot['bot_token']] = bot['bot_id']
+            scheduler.submit(bot['user_id'], functools.partial(self.run_bot, bot))
+        self.scheduler = scheduler
+        logger.info("Scheduled jobs per tenant: %s", scheduler.queue_depths())
+        await scheduler.run()
+
+    async def run_bot(self, bot):
+        # Одна задача на бота: аудит его чатов и разбор updates пишут одни и те же связи и расходуют
+        # общий лимит Telegram на токен, поэтому для одного бота они идут по очереди, а параллельно — разные боты
+        for chat in self.bot_chats(bot):
+            try:
+                await self.audit_chat(bot, chat)
+            except Exception as e:
+                bot_logger(logger, bot['bot_id']).error("Bot %s: audit of chat %s failed: %s", bot['bot_id'], chat['chat_id'], e)
+        await self.process_bot_updates(bot)
+
+    def bot_chats(self, bot):
+        # Чаты со статусом 3 исключаем из проверки
+        return [c for c in self.chats if c['bot_id'] == bot['bot_id'] and c['user_id'] == bot['user_id'] and c.get('status_id') != 3]
+
+    async def audit_chat(self, bot, chat):
+        bot_token = bot['bot_token']
+        bot_id = bot['bot_id']
+        log = bot_logger(logger, bot_id)
+        # Проверка чатов бота
+        telegram_chat_id = chat['telegram_chat_id']
+        chat_id = chat['chat_id']
+        url = f"https://api.telegram.org/bot{bot_token}/getChatAdministrators"
+        params = {"chat_id": telegram_chat_id}
+        try:
+            async with self.http_session() as session:
+                async with session.get(url, params=params) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        if data.get("ok"):
+                            admins = data.get("result", [])
+                            bot_is_admin = any(a.get("user", {}).get("id") == bot['telegram_user_id'] for a in admins)
+                            if not bot_is_admin:
+                                log.info("Bot %s is not admin in chat %s, setting status=2", bot_id, telegram_chat_id)
+                                self.chat_writes.update(chat, status_id=2)
+                            else:
+                                log.sampled("Bot %s is admin in chat %s", bot_id, telegram_chat_id)
+                                # Если статус не 1, то обновить на 1
+                                if chat.get('status_id') != 1:
+                                    log.info("Bot %s is admin in chat %s, updating status to 1", bot_id, telegram_chat_id)
+                                    self.chat_writes.update(chat, status_id=1)
+                        else:
+                            log.warning("Bot %s getChatAdministrators failed for chat %s: %s", bot_id, telegram_chat_id, data)
+                    elif response.status in (400, 403):
+                        log.warning("Bot %s lost access to chat %s (status %s), setting type=5, status=3", bot_id, telegram_chat_id, response.status)
+                        self.chat_writes.update(chat, type_id=5, status_id=3)
+                    else:
+                        log.warning("Bot %s unexpected response %s for chat %s", bot_id, response.status, telegram_chat_id)
+        except Exception as e:
+            log.error("Bot %s error checking chat %s: %s", bot_id, telegram_chat_id, e)
+        # Обработка по типу чата
+        chat_type = chat.get('type_id')
+        if chat_type == 1:
+            log.sampled("[TYPE 1] Внешний чат обработка chat_id=%s", chat_id)
+            chat_links = [l for l in self.chat_employees if l['chat_id'] == chat_id]
+            to_remove = []
+            for link in chat_links:
+                employee = next((e for e in self.employees if e['employee_id'] == link['employee_id']), None)
+                if not employee:
                     continue
-                if chat.get('status_id') == 3:
-                    continue  # Исключаем чаты со статусом 3
-                telegram_chat_id = chat['telegram_chat_id']
-                chat_id = chat['chat_id']
-                url = f"https://api.telegram.org/bot{bot_token}/getChatAdministrators"
-                params = {"chat_id": telegram_chat_id}
+                # Пропускаем самого бота
+                if employee.get('telegram_user_id') == bot['telegram_user_id']:
+                    continue
+                if (
+                    not link.get('is_active') or
+                    not employee.get('is_active')
+                ):
+                    to_remove.append((employee, link))
+            for employee, link in to_remove:
+                log.info("[TYPE 1] Кикаем пользователя: chat_id=%s, employee_id=%s, telegram_user_id=%s", chat_id, employee['employee_id'], employee['telegram_user_id'])
+                kick_url = f"https://api.telegram.org/bot{bot_token}/kickChatMember"
+                kick_params = {"chat_id": telegram_chat_id, "user_id": employee['telegram_user_id']}
+                kicked = False
                 try:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url, params=params) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                if data.get("ok"):
-                                    admins = data.get("result", [])
-                                    bot_is_admin = any(a.get("user", {}).get("id") == bot['telegram_user_id'] for a in admins)
-                                    if not bot_is_admin:
-                                        logger.info(f"Bot {bot_id} is not admin in chat {telegram_chat_id}, setting status=2")
-                                        async with self.pool.acquire() as conn:
-                                            await conn.execute("""
-                                                UPDATE chats SET status_id = 2, updated_at = NOW() WHERE chat_id = $1
-                                            """, chat_id)
-                                    else:
-                                        logger.info(f"Bot {bot_id} is admin in chat {telegram_chat_id}")
-                                        # Если статус не 1, то обновить на 1
-                                        if chat.get('status_id') != 1:
-                                            logger.info(f"Bot {bot_id} is admin in chat {telegram_chat_id}, updating status to 1")
-                                            async with self.pool.acquire() as conn:
-                                                await conn.execute("""
-                                                    UPDATE chats SET status_id = 1, updated_at = NOW() WHERE chat_id = $1
-                                                """, chat_id)
-                                else:
-                                    logger.warning(f"Bot {bot_id} getChatAdministrators failed for chat {telegram_chat_id}: {data}")
-                            elif response.status in (400, 403):
-                                logger.warning(f"Bot {bot_id} lost access to chat {telegram_chat_id} (status {response.status}), setting type=5, status=3")
-                                async with self.pool.acquire() as conn:
-                                    await conn.execute("""
-                                        UPDATE chats SET type_id = 5, status_id = 3, updated_at = NOW() WHERE chat_id = $1
-                                    """, chat_id)
+                    async with self.http_session() as session:
+                        async with session.post(kick_url, params=kick_params) as kick_response:
+                            kick_data = await kick_response.json()
+                            if kick_response.status == 200 and kick_data.get("ok"):
+                                log.info("Пользователь %s успешно удалён из чата %s", employee['telegram_user_id'], telegram_chat_id)
+                                kicked = True
+                            elif (
+                                kick_response.status == 400 and (
+                                    "not found" in (kick_data.get("description", "")).lower() or
+                                    "user_not_participant" in (kick_data.get("description", "")).lower()
+                                )
+                            ):
+                                log.info("Пользователь %s не найден в чате %s, считаем удалённым", employee['telegram_user_id'], telegram_chat_id)
+                                kicked = True
                             else:
-                                logger.warning(f"Bot {bot_id} unexpected response {response.status} for chat {telegram_chat_id}")
+                                log.error("Не удалось удалить пользователя %s из чата %s: %s", employee['telegram_user_id'], telegram_chat_id, kick_data)
                 except Exception as e:
-                    logger.error(f"Bot {bot_id} error checking chat {telegram_chat_id}: {e}")
-                # Обработка по типу чата
-                chat_type = chat.get('type_id')
-                if chat_type == 1:
-                    logger.info(f"[TYPE 1] Внешний чат обработка chat_id={chat_id}")
-                    chat_links = [l for l in self.chat_employees if l['chat_id'] == chat_id]
-                    to_remove = []
-                    for link in chat_links:
-                        employee = next((e for e in self.employees if e['employee_id'] == link['employee_id']), None)
-                        if not employee:
-                            continue
-                        # Пропускаем самого бота
-                        if employee.get('telegram_user_id') == bot['telegram_user_id']:
-                            continue
-                        if (
-                            not link.get('is_active') or
-                            not employee.get('is_active')
-                        ):
-                            to_remove.append((employee, link))
-                    for employee, link in to_remove:
-                        logger.info(f"[TYPE 1] Кикаем пользователя: chat_id={chat_id}, employee_id={employee['employee_id']}, telegram_user_id={employee['telegram_user_id']}")
-                        kick_url = f"https://api.telegram.org/bot{bot_token}/kickChatMember"
-                        kick_params = {"chat_id": telegram_chat_id, "user_id": employee['telegram_user_id']}
-                        kicked = False
-                        try:
-                            async with aiohttp.ClientSession() as session:
-                                async with session.post(kick_url, params=kick_params) as kick_response:
-                                    kick_data = await kick_response.json()
-                                    if kick_response.status == 200 and kick_data.get("ok"):
-                                        logger.info(f"Пользователь {employee['telegram_user_id']} успешно удалён из чата {telegram_chat_id}")
-                                        kicked = True
-                                    elif (
-                                        kick_response.status == 400 and (
-                                            "not found" in (kick_data.get("description", "")).lower() or
-                                            "user_not_participant" in (kick_data.get("description", "")).lower()
-                                        )
-                                    ):
-                                        logger.info(f"Пользователь {employee['telegram_user_id']} не найден в чате {telegram_chat_id}, считаем удалённым")
-                                        kicked = True
-                                    else:
-                                        logger.error(f"Не удалось удалить пользователя {employee['telegram_user_id']} из чата {telegram_chat_id}: {kick_data}")
-                        except Exception as e:
-                            logger.error(f"Ошибка при удалении пользователя {employee['telegram_user_id']} из чата {telegram_chat_id}: {e}")
-                        if kicked:
-                            logger.info(f"[TYPE 1] Удаляем связь: chat_id={chat_id}, employee_id={employee['employee_id']}, telegram_user_id={employee['telegram_user_id']}")
-                            async with self.pool.acquire() as conn:
-                                await conn.execute(
-                                    """DELETE FROM chat_employees WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3""",
-                                    chat_id, employee['employee_id'], link['user_id']
-                                )
-                            self.chat_employees = [l for l in self.chat_employees if not (l['chat_id'] == chat_id and l['employee_id'] == employee['employee_id'] and l['user_id'] == link['user_id'])]
-                            send_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                            user_name = employee.get('full_name') or employee.get('telegram_username') or str(employee['employee_id'])
-                            text = f"Пользователь {user_name} был удален из чата (ботом)"
-                            send_params = {"chat_id": telegram_chat_id, "text": text}
-                            try:
-                                async with aiohttp.ClientSession() as session:
-                                    await session.post(send_url, params=send_params)
-                            except Exception as e:
-                                logger.error(f"Ошибка при отправке сообщения в чат {telegram_chat_id}: {e}")
-                    # После обработки всех удалений — получить из API число участников чата и сравнить с числом активных связей
-                    url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
-                    params_count = {"chat_id": telegram_chat_id}
+                    log.error("Ошибка при удалении пользователя %s из чата %s: %s", employee['telegram_user_id'], telegram_chat_id, e)
+                if kicked:
+                    log.info("[TYPE 1] Удаляем связь: chat_id=%s, employee_id=%s, telegram_user_id=%s", chat_id, employee['employee_id'], employee['telegram_user_id'])
+                    async with self.pool.acquire() as conn:
+                        await conn.execute(
+                            """DELETE FROM chat_employees WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3""",
+                            chat_id, employee['employee_id'], link['user_id']
+                        )
+                    self.chat_employees = [l for l in self.chat_employees if not (l['chat_id'] == chat_id and l['employee_id'] == employee['employee_id'] and l['user_id'] == link['user_id'])]
+                    if link.get('is_active'):
+                        self.adjust_members(chat_id, -1)
+                    send_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+                    user_name = employee.get('full_name') or employee.get('telegram_username') or str(employee['employee_id'])
+                    text = f"Пользователь {user_name} был удален из чата (ботом)"
+                    send_params = {"chat_id": telegram_chat_id, "text": text}
                     try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(url_count, params=params_count) as response_count:
-                                if response_count.status == 200:
-                                    data_count = await response_count.json()
-                                    if data_count.get("ok"):
-                                        chat_members_count = data_count.get("result", 0)
-                                        active_links = [l for l in self.chat_employees if l['chat_id'] == chat_id and l.get('is_active')]
-                                        db_count = len(active_links)
-                                        unknown_count = chat_members_count - db_count
-                                        logger.info(f"[TYPE 1] chat_id={chat_id}: members_count={chat_members_count}, db_count={db_count}, unknown_count={unknown_count}")
-                                        if chat.get('user_num') != chat_members_count or chat.get('unknown_user') != unknown_count:
-                                            logger.info(f"[TYPE 1] chat_id={chat_id}: updating user_num={chat_members_count}, unknown_user={unknown_count}")
-                                            async with self.pool.acquire() as conn:
-                                                await conn.execute(
-                                                    """UPDATE chats SET user_num = $1, unknown_user = $2, updated_at = NOW() WHERE chat_id = $3""",
-                                                    chat_members_count, unknown_count, chat_id
-                                                )
-                                    else:
-                                        logger.warning(f"[TYPE 1] chat_id={chat_id}: getChatMembersCount failed: {data_count}")
-                                else:
-                                    logger.warning(f"[TYPE 1] chat_id={chat_id}: getChatMembersCount HTTP {response_count.status}")
+                        async with self.http_session() as session:
+                            await session.post(send_url, params=send_params)
                     except Exception as e:
-                        logger.error(f"[TYPE 1] chat_id={chat_id}: error in getChatMembersCount: {e}")
-                elif chat_type == 2:
-                    logger.info(f"[TYPE 2] Внутренний чат обработка chat_id={chat_id}")
-                    chat_links = [l for l in self.chat_employees if l['chat_id'] == chat_id]
-                    # Сначала определяем пользователей для удаления
-                    to_remove = []
-                    for link in chat_links:
-                        employee = next((e for e in self.employees if e['employee_id'] == link['employee_id']), None)
-                        if not employee:
-                            continue
-                        # Пропускаем самого бота
-                        if employee.get('telegram_user_id') == bot['telegram_user_id']:
-                            continue
-                        if (
-                            employee.get('is_external') or
-                            not link.get('is_active') or
-                            (employee.get('is_active') and not link.get('is_active'))
-                        ):
-                            to_remove.append((employee, link))
-                    # Сначала кикаем всех таких пользователей
-                    for employee, link in to_remove:
-                        logger.info(f"[TYPE 2] Кикаем пользователя: chat_id={chat_id}, employee_id={employee['employee_id']}, telegram_user_id={employee['telegram_user_id']}")
-                        kick_url = f"https://api.telegram.org/bot{bot_token}/kickChatMember"
-                        kick_params = {"chat_id": telegram_chat_id, "user_id": employee['telegram_user_id']}
-                        kicked = False
-                        try:
-                            async with aiohttp.ClientSession() as session:
-                                async with session.post(kick_url, params=kick_params) as kick_response:
-                                    kick_data = await kick_response.json()
-                                    if kick_response.status == 200 and kick_data.get("ok"):
-                                        logger.info(f"Пользователь {employee['telegram_user_id']} успешно удалён из чата {telegram_chat_id}")
-                                        kicked = True
-                                    elif (
-                                        kick_response.status == 400 and (
-                                            "not found" in (kick_data.get("description", "")).lower() or
-                                            "user_not_participant" in (kick_data.get("description", "")).lower()
-                                        )
-                                    ):
-                                        logger.info(f"Пользователь {employee['telegram_user_id']} не найден в чате {telegram_chat_id}, считаем удалённым")
-                                        kicked = True
-                                    else:
-                                        logger.error(f"Не удалось удалить пользователя {employee['telegram_user_id']} из чата {telegram_chat_id}: {kick_data}")
-                        except Exception as e:
-                            logger.error(f"Ошибка при удалении пользователя {employee['telegram_user_id']} из чата {telegram_chat_id}: {e}")
-                        # Деактивируем связь только если кик был успешен или пользователь не найден
-                        if kicked:
-                            logger.info(f"[TYPE 2] Удаляем связь: chat_id={chat_id}, employee_id={employee['employee_id']}, telegram_user_id={employee['telegram_user_id']}")
-                            async with self.pool.acquire() as conn:
-                                await conn.execute(
-                                    """DELETE FROM chat_employees WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3""",
-                                    chat_id, employee['employee_id'], link['user_id']
+                        log.error("Ошибка при отправке сообщения в чат %s: %s", telegram_chat_id, e)
+            # После обработки всех удалений — получить из API число участников чата и сравнить с числом активных связей
+            url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
+            params_count = {"chat_id": telegram_chat_id}
+            try:
+                async with self.http_session() as session:
+                    async with session.get(url_count, params=params_count) as response_count:
+                        if response_count.status == 200:
+                            data_count = await response_count.json()
+                            if data_count.get("ok"):
+                                chat_members_count = data_count.get("result", 0)
+                                db_count = self.active_members(chat_id)
+                                unknown_count = chat_members_count - db_count
+                                log.sampled("[TYPE 1] chat_id=%s: members_count=%s, db_count=%s, unknown_count=%s", chat_id, chat_members_count, db_count, unknown_count)
+                                if chat.get('user_num') != chat_members_count or chat.get('unknown_user') != unknown_count:
+                                    log.info("[TYPE 1] chat_id=%s: updating user_num=%s, unknown_user=%s", chat_id, chat_members_count, unknown_count)
+                                    self.chat_writes.update(chat, user_num=chat_members_count, unknown_user=unknown_count)
+                            else:
+                                log.warning("[TYPE 1] chat_id=%s: getChatMembersCount failed: %s", chat_id, data_count)
+                        else:
+                            log.warning("[TYPE 1] chat_id=%s: getChatMembersCount HTTP %s", chat_id, response_count.status)
+            except Exception as e:
+                log.error("[TYPE 1] chat_id=%s: error in getChatMembersCount: %s", chat_id, e)
+        elif chat_type == 2:
+            log.sampled("[TYPE 2] Внутренний чат обработка chat_id=%s", chat_id)
+            chat_links = [l for l in self.chat_employees if l['chat_id'] == chat_id]
+            # Сначала определяем пользователей для удаления
+            to_remove = []
+            for link in chat_links:
+                employee = next((e for e in self.employees if e['employee_id'] == link['employee_id']), None)
+                if not employee:
+                    continue
+                # Пропускаем самого бота
+                if employee.get('telegram_user_id') == bot['telegram_user_id']:
+                    continue
+                if (
+                    employee.get('is_external') or
+                    not link.get('is_active') or
+                    (employee.get('is_active') and not link.get('is_active'))
+                ):
+                    to_remove.append((employee, link))
+            # Сначала кикаем всех таких пользователей
+            for employee, link in to_remove:
+                log.info("[TYPE 2] Кикаем пользователя: chat_id=%s, employee_id=%s, telegram_user_id=%s", chat_id, employee['employee_id'], employee['telegram_user_id'])
+                kick_url = f"https://api.telegram.org/bot{bot_token}/kickChatMember"
+                kick_params = {"chat_id": telegram_chat_id, "user_id": employee['telegram_user_id']}
+                kicked = False
+                try:
+                    async with self.http_session() as session:
+                        async with session.post(kick_url, params=kick_params) as kick_response:
+                            kick_data = await kick_response.json()
+                            if kick_response.status == 200 and kick_data.get("ok"):
+                                log.info("Пользователь %s успешно удалён из чата %s", employee['telegram_user_id'], telegram_chat_id)
+                                kicked = True
+                            elif (
+                                kick_response.status == 400 and (
+                                    "not found" in (kick_data.get("description", "")).lower() or
+                                    "user_not_participant" in (kick_data.get("description", "")).lower()
                                 )
-                            # Удаляем из локального списка
-                            self.chat_employees = [l for l in self.chat_employees if not (l['chat_id'] == chat_id and l['employee_id'] == employee['employee_id'] and l['user_id'] == link['user_id'])]
-                            # Отправляем сообщение в чат
-                            send_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                            user_name = employee.get('full_name') or employee.get('telegram_username') or str(employee['employee_id'])
-                            text = f"Пользователь {user_name} был удален из чата (ботом)"
-                            send_params = {"chat_id": telegram_chat_id, "text": text}
-                            try:
-                                async with aiohttp.ClientSession() as session:
-                                    await session.post(send_url, params=send_params)
-                            except Exception as e:
-                                logger.error(f"Ошибка при отправке сообщения в чат {telegram_chat_id}: {e}")
-                    # После обработки всех удалений — получить из API число участников чата и сравнить с числом активных связей
-                    url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
-                    params_count = {"chat_id": telegram_chat_id}
+                            ):
+                                log.info("Пользователь %s не найден в чате %s, считаем удалённым", employee['telegram_user_id'], telegram_chat_id)
+                                kicked = True
+                            else:
+                                log.error("Не удалось удалить пользователя %s из чата %s: %s", employee['telegram_user_id'], telegram_chat_id, kick_data)
+                except Exception as e:
+                    log.error("Ошибка при удалении пользователя %s из чата %s: %s", employee['telegram_user_id'], telegram_chat_id, e)
+                # Деактивируем связь только если кик был успешен или пользователь не найден
+                if kicked:
+                    log.info("[TYPE 2] Удаляем связь: chat_id=%s, employee_id=%s, telegram_user_id=%s", chat_id, employee['employee_id'], employee['telegram_user_id'])
+                    async with self.pool.acquire() as conn:
+                        await conn.execute(
+                            """DELETE FROM chat_employees WHERE chat_id = $1 AND employee_id = $2 AND user_id = $3""",
+                            chat_id, employee['employee_id'], link['user_id']
+                        )
+                    # Удаляем из локального списка
+                    self.chat_employees = [l for l in self.chat_employees if not (l['chat_id'] == chat_id and l['employee_id'] == employee['employee_id'] and l['user_id'] == link['user_id'])]
+                    if link.get('is_active'):
+                        self.adjust_members(chat_id, -1)
+                    # Отправляем сообщение в чат
+                    send_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+                    user_name = employee.get('full_name') or employee.get('telegram_username') or str(employee['employee_id'])
+                    text = f"Пользователь {user_name} был удален из чата (ботом)"
+                    send_params = {"chat_id": telegram_chat_id, "text": text}
                     try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(url_count, params=params_count) as response_count:
-                                if response_count.status == 200:
-                                    data_count = await response_count.json()
-                                    if data_count.get("ok"):
-                                        chat_members_count = data_count.get("result", 0)
-                                        active_links = [l for l in self.chat_employees if l['chat_id'] == chat_id and l.get('is_active')]
-                                        db_count = len(active_links)
-                                        unknown_count = chat_members_count - db_count
-                                        logger.info(f"[TYPE 2] chat_id={chat_id}: members_count={chat_members_count}, db_count={db_count}, unknown_count={unknown_count}")
-                                        if chat.get('user_num') != chat_members_count or chat.get('unknown_user') != unknown_count:
-                                            logger.info(f"[TYPE 2] chat_id={chat_id}: updating user_num={chat_members_count}, unknown_user={unknown_count}")
-                                            async with self.pool.acquire() as conn:
-                                                await conn.execute(
-                                                    """UPDATE chats SET user_num = $1, unknown_user = $2, updated_at = NOW() WHERE chat_id = $3""",
-                                                    chat_members_count, unknown_count, chat_id
-                                                )
-                                    else:
-                                        logger.warning(f"[TYPE 2] chat_id={chat_id}: getChatMembersCount failed: {data_count}")
-                                else:
-                                    logger.warning(f"[TYPE 2] chat_id={chat_id}: getChatMembersCount HTTP {response_count.status}")
+                        async with self.http_session() as session:
+                            await session.post(send_url, params=send_params)
                     except Exception as e:
-                        logger.error(f"[TYPE 2] chat_id={chat_id}: error in getChatMembersCount: {e}")
-                elif chat_type in (3, 4):
-                    logger.info(f"[TYPE 3/4] Чтение/новый чат обработка chat_id={chat_id}")
-                    # Получаем число участников через Telegram API
-                    url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
-                    params_count = {"chat_id": telegram_chat_id}
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(url_count, params=params_count) as response_count:
-                                if response_count.status == 200:
-                                    data_count = await response_count.json()
-                                    if data_count.get("ok"):
-                                        chat_members_count = data_count.get("result", 0)
-                                        # Считаем число связей в БД
-                                        db_links = [l for l in self.chat_employees if l['chat_id'] == chat_id and l['is_active']]
-                                        db_count = len(db_links)
-                                        unknown_count = chat_members_count - db_count
-                                        logger.info(f"chat_id={chat_id}: members_count={chat_members_count}, db_count={db_count}, unknown_count={unknown_count}")
-                                        if chat.get('user_num') == chat_members_count and chat.get('unknown_user') == unknown_count:
-                                            logger.info(f"chat_id={chat_id}: counts match, nothing to update")
-                                        else:
-                                            logger.info(f"chat_id={chat_id}: updating user_num={chat_members_count}, unknown_user={unknown_count}")
-                                            async with self.pool.acquire() as conn:
-                                                await conn.execute("""
-                                                    UPDATE chats SET user_num = $1, unknown_user = $2, updated_at = NOW() WHERE chat_id = $3
-                                                """, chat_members_count, unknown_count, chat_id)
-                                    else:
-                                        logger.warning(f"chat_id={chat_id}: getChatMembersCount failed: {data_count}")
+                        log.error("Ошибка при отправке сообщения в чат %s: %s", telegram_chat_id, e)
+            # После обработки всех удалений — получить из API число участников чата и сравнить с числом активных связей
+            url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
+            params_count = {"chat_id": telegram_chat_id}
+            try:
+                async with self.http_session() as session:
+                    async with session.get(url_count, params=params_count) as response_count:
+                        if response_count.status == 200:
+                            data_count = await response_count.json()
+                            if data_count.get("ok"):
+                                chat_members_count = data_count.get("result", 0)
+                                db_count = self.active_members(chat_id)
+                                unknown_count = chat_members_count - db_count
+                                log.sampled("[TYPE 2] chat_id=%s: members_count=%s, db_count=%s, unknown_count=%s", chat_id, chat_members_count, db_count, unknown_count)
+                                if chat.get('user_num') != chat_members_count or chat.get('unknown_user') != unknown_count:
+                                    log.info("[TYPE 2] chat_id=%s: updating user_num=%s, unknown_user=%s", chat_id, chat_members_count, unknown_count)
+                                    self.chat_writes.update(chat, user_num=chat_members_count, unknown_user=unknown_count)
+                            else:
+                                log.warning("[TYPE 2] chat_id=%s: getChatMembersCount failed: %s", chat_id, data_count)
+                        else:
+                            log.warning("[TYPE 2] chat_id=%s: getChatMembersCount HTTP %s", chat_id, response_count.status)
+            except Exception as e:
+                log.error("[TYPE 2] chat_id=%s: error in getChatMembersCount: %s", chat_id, e)
+        elif chat_type in (3, 4):
+            log.sampled("[TYPE 3/4] Чтение/новый чат обработка chat_id=%s", chat_id)
+            # Получаем число участников через Telegram API
+            url_count = f"https://api.telegram.org/bot{bot_token}/getChatMembersCount"
+            params_count = {"chat_id": telegram_chat_id}
+            try:
+                async with self.http_session() as session:
+                    async with session.get(url_count, params=params_count) as response_count:
+                        if response_count.status == 200:
+                            data_count = await response_count.json()
+                            if data_count.get("ok"):
+                                chat_members_count = data_count.get("result", 0)
+                                # Число активных связей в БД
+                                db_count = self.active_members(chat_id)
+                                unknown_count = chat_members_count - db_count
+                                log.sampled("chat_id=%s: members_count=%s, db_count=%s, unknown_count=%s", chat_id, chat_members_count, db_count, unknown_count)
+                                if chat.get('user_num') == chat_members_count and chat.get('unknown_user') == unknown_count:
+                                    log.debug("chat_id=%s: counts match, nothing to update", chat_id)
                                 else:
-                                    logger.warning(f"chat_id={chat_id}: getChatMembersCount HTTP {response_count.status}")
-                    except Exception as e:
-                        logger.error(f"chat_id={chat_id}: error in getChatMembersCount: {e}")
-                elif chat_type == 6:
-                    logger.info(f"[TYPE 6] Заблокированный чат обработка chat_id={chat_id}")
-                    # TODO: обработка заблокированного чата
-            # Старый цикл по updates
-            updates = await self.fetch_updates(bot_token, bot_id)
-            async with self.pool.acquire() as conn:
-                for update in updates:
-                    await self.handle_update(update, user_id, bot_id, conn)
+                                    log.info("chat_id=%s: updating user_num=%s, unknown_user=%s", chat_id, chat_members_count, unknown_count)
+                                    self.chat_writes.update(chat, user_num=chat_members_count, unknown_user=unknown_count)
+                            else:
+                                log.warning("chat_id=%s: getChatMembersCount failed: %s", chat_id, data_count)
+                        else:
+                            log.warning("chat_id=%s: getChatMembersCount HTTP %s", chat_id, response_count.status)
+            except Exception as e:
+                log.error("chat_id=%s: error in getChatMembersCount: %s", chat_id, e)
+        elif chat_type == 6:
+            log.sampled("[TYPE 6] Заблокированный чат обработка chat_id=%s", chat_id)
+            # TODO: обработка заблокированного чата
+
+    async def process_bot_updates(self, bot):
+        bot_token = bot['bot_token']
+        bot_id = bot['bot_id']
+        user_id = bot['user_id']
+        # Старый цикл по updates
+        updates = await self.fetch_updates(bot_token, bot_id)
+        async with self.pool.acquire() as conn:
+            for update in updates:
+                await self.handle_update(update, user_id, bot_id, conn)
 
     async def run(self):
         await self.init_db()
-        while True:
-            await self.run_cycle()
-            await asyncio.sleep(self.interval)
+        self.chat_writes.start()
+        self.register_metrics()
+        metrics_runner = None
+        if self.metrics_port:
+            metrics_runner = await start_http_server(self.metrics_host, self.metrics_port)
+        diag_runner = None
+        if self.diag_port:
+            diag_runner = await self.diagnostics.start_http_server(self.diag_host, self.diag_port)
+        self.diagnostics.install_signal_handlers(self.diag_profile_seconds)
+        watchdog = None
+        if self.loop_block_threshold > 0:
+            watchdog = LoopWatchdog(self.loop_block_threshold)
+            watchdog.start()
+        try:
+            while True:
+                started = time.perf_counter()
+                await self.run_cycle()
+                elapsed = time.perf_counter() - started
+                CYCLE_SECONDS.observe(elapsed)
+                if elapsed > self.interval:
+                    CYCLE_OVERRUNS.inc()
+                    logger.warning("Cycle took %.1fs, longer than SERVICE_INTERVAL=%ss", elapsed, self.interval)
+                await asyncio.sleep(self.interval)
+        finally:
+            # Дописываем накопленные изменения перед остановкой
+            await self.chat_writes.close()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            if diag_runner is not None:
+                await diag_runner.cleanup()
+            if watchdog is not None:
+                watchdog.stop()
 
 async def main():
+    # Логи уходят через очередь в отдельный поток, event loop не ждёт записи в stdout
+    log_listener = configure_logging()
     service = BotService()
-    await service.run()
+    # SIGTERM (docker stop) отменяет задачу, чтобы run() успел сбросить буфер записи
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await service.run()
+    except asyncio.CancelledError:
+        logger.info("Bot service stopped")
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_SECONDS = REGISTRY.histogram(
+    'db_pool_acquire_seconds', 'Time spent waiting for a pooled connection',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+ACQUIRE_TIMEOUTS = REGISTRY.counter(
+    'db_pool_acquire_timeouts_total', 'Acquires that gave up after DB_POOL_ACQUIRE_TIMEOUT')
+HOLD_SECONDS = REGISTRY.histogram('db_pool_hold_seconds', 'Time a connection was held before release')
+
+
+class InstrumentedPool:
+    """asyncpg pool proxy that times acquire() and counts acquire timeouts.
+
+    Only acquire() is wrapped; everything else (get_size, close, ...) goes
+    to the underlying pool.
+    """
+
+    def __init__(self, pool, acquire_timeout=None):
+        self._pool = pool
+        self.acquire_timeout = acquire_timeout
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        try:
+            conn = await self._pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            ACQUIRE_TIMEOUTS.inc()
+            logger.warning("No free DB connection after %ss (pool max %s)", self.acquire_timeout, self._pool.get_max_size())
+            raise
+        acquired = time.perf_counter()
+        ACQUIRE_SECONDS.observe(acquired - started)
+        try:
+            yield conn
+        finally:
+            HOLD_SECONDS.observe(time.perf_counter() - acquired)
+            await self._pool.release(conn)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
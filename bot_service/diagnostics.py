@@ -0,0 +1,212 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from datetime import datetime
+
+from aiohttp import web
+
+from log_setup import BOT_LEVELS, set_bot_level
+
+logger = logging.getLogger(__name__)
+
+
+class Diagnostics:
+    """On-demand profiling, task dumps and tracemalloc snapshots.
+
+    Results are written to files under output_dir; the admin endpoint and the
+    signal handlers only trigger them.
+    """
+
+    def __init__(self, output_dir, top=50):
+        self.output_dir = output_dir
+        self.top = top
+        self._profiling = False
+        self._last_snapshot = None
+
+    def _path(self, prefix, ext):
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        return os.path.join(self.output_dir, f"{prefix}-{stamp}.{ext}")
+
+    async def profile(self, seconds):
+        # cProfile ставится на поток event loop, поэтому видит все корутины сервиса
+        if self._profiling:
+            raise RuntimeError("Profile already running")
+        self._profiling = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self._profiling = False
+        path = self._path('profile', 'prof')
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(self.top)
+        with open(path[:-len('prof')] + 'txt', 'w') as f:
+            f.write(summary.getvalue())
+        logger.info("Profile for %ss written to %s", seconds, path)
+        return path
+
+    def dump_tasks(self):
+        path = self._path('tasks', 'txt')
+        tasks = asyncio.all_tasks()
+        with open(path, 'w') as f:
+            f.write(f"{len(tasks)} tasks\n\n")
+            for task in tasks:
+                f.write(f"{task!r}\n")
+                task.print_stack(file=f)
+                f.write('\n')
+        logger.info("Stacks of %s tasks written to %s", len(tasks), path)
+        return path
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            logger.info("tracemalloc started")
+        snapshot = tracemalloc.take_snapshot()
+        path = self._path('tracemalloc', 'snapshot')
+        snapshot.dump(path)
+        with open(path[:-len('snapshot')] + 'txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write(f"{stat}\n")
+        self._last_snapshot = snapshot
+        logger.info("tracemalloc snapshot written to %s", path)
+        return path
+
+    def diff(self):
+        # Разница с предыдущим снимком; первый вызов только делает снимок
+        previous = self._last_snapshot
+        path = self.snapshot()
+        if previous is None:
+            return path
+        diff_path = self._path('tracemalloc-diff', 'txt')
+        with open(diff_path, 'w') as f:
+            for stat in self._last_snapshot.compare_to(previous, 'lineno')[:self.top]:
+                f.write(f"{stat}\n")
+        logger.info("tracemalloc diff written to %s", diff_path)
+        return diff_path
+
+    def stop_tracemalloc(self):
+        self._last_snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("tracemalloc stopped")
+
+    def install_signal_handlers(self, profile_seconds):
+        # SIGUSR1 — стеки задач, SIGUSR2 — профиль на profile_seconds секунд
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.dump_tasks)
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(self._profile_quietly(profile_seconds)))
+
+    async def _profile_quietly(self, seconds):
+        try:
+            await self.profile(seconds)
+        except RuntimeError as e:
+            logger.warning(str(e))
+
+    def routes(self):
+        async def profile(request):
+            seconds = float(request.query.get('seconds', '10'))
+            try:
+                path = await self.profile(seconds)
+            except RuntimeError as e:
+                return web.json_response({'error': str(e)}, status=409)
+            return web.json_response({'file': path})
+
+        async def tasks(request):
+            return web.json_response({'file': self.dump_tasks()})
+
+        async def snapshot(request):
+            return web.json_response({'file': self.snapshot()})
+
+        async def diff(request):
+            return web.json_response({'file': self.diff()})
+
+        async def stop(request):
+            self.stop_tracemalloc()
+            return web.json_response({'ok': True})
+
+        async def loglevel(request):
+            # ?bot_id=5&level=DEBUG — поднять детализацию одного бота; без level — сбросить
+            if 'bot_id' in request.query:
+                try:
+                    set_bot_level(int(request.query['bot_id']), request.query.get('level') or None)
+                except ValueError as e:
+                    return web.json_response({'error': str(e)}, status=400)
+            return web.json_response({str(k): logging.getLevelName(v) for k, v in BOT_LEVELS.items()})
+
+        return [
+            web.post('/debug/profile', profile),
+            web.get('/debug/tasks', tasks),
+            web.post('/debug/tracemalloc/snapshot', snapshot),
+            web.post('/debug/tracemalloc/diff', diff),
+            web.post('/debug/tracemalloc/stop', stop),
+            web.post('/debug/loglevel', loglevel),
+        ]
+
+    async def start_http_server(self, host, port):
+        app = web.Application()
+        app.router.add_routes(self.routes())
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Diagnostics endpoint listening on http://%s:%s/debug/", host, port)
+        return runner
+
+
+class LoopWatchdog:
+    """Reports what the event loop thread is executing when it stops responding.
+
+    A heartbeat task stamps the time every interval; a daemon thread checks the
+    stamp and, once the loop has been blocked longer than threshold, logs the
+    loop thread's current stack, which names the blocking coroutine.
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        blocked_since = None
+        while not self._stop.wait(self.interval):
+            beat = self._last_beat
+            lag = time.monotonic() - beat
+            if lag > self.threshold:
+                if blocked_since != beat:
+                    blocked_since = beat
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    stack = ''.join(traceback.format_stack(frame)) if frame else '<no frame>'
+                    logger.warning("Event loop blocked for %.2fs, loop thread stack:\n%s", lag, stack)
+            elif blocked_since is not None:
+                logger.warning("Event loop unblocked after %.2fs", beat - blocked_since)
+                blocked_since = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
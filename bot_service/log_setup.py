@@ -0,0 +1,122 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# Уровни логирования для отдельных ботов, меняются на лету: bot_id -> level
+BOT_LEVELS = {}
+_bot_loggers = {}
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('bot_id', 'user_id', 'chat_id')
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler renders the message in the caller's thread; here msg and
+    args travel as-is, so arguments must not be mutated after the log call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_levels(value):
+    # "5:DEBUG,7:WARNING" -> {5: 10, 7: 30}
+    levels = {}
+    for part in value.split(','):
+        bot_id, _, level = part.strip().partition(':')
+        parsed = logging.getLevelName(level.strip().upper())
+        if bot_id and isinstance(parsed, int):
+            levels[int(bot_id)] = parsed
+    return levels
+
+
+def set_bot_level(bot_id, level):
+    if level is None:
+        BOT_LEVELS.pop(bot_id, None)
+        return
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level: {level}")
+    BOT_LEVELS[bot_id] = value
+
+
+def configure_logging():
+    """Route all records through a queue to a single stream-writing thread."""
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers[:] = [LazyQueueHandler(records)]
+    root.setLevel(level)
+    BOT_LEVELS.update(parse_levels(os.getenv('BOT_LOG_LEVELS', '')))
+    listener.start()
+    return listener
+
+
+class BotLogger(logging.LoggerAdapter):
+    """Logger for one bot: per-bot level override, bot_id on every record and
+    sampling for per-chat chatter.
+    """
+
+    def __init__(self, logger, bot_id, sample_every):
+        super().__init__(logger, {'bot_id': bot_id})
+        self.bot_id = bot_id
+        self.sample_every = sample_every
+        self._sample_counts = {}
+
+    def isEnabledFor(self, level):
+        override = BOT_LEVELS.get(self.bot_id)
+        if override is not None:
+            return level >= override
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            kwargs.setdefault('extra', self.extra)
+            # Уровень уже проверен с учётом переопределения для бота
+            self.logger._log(level, msg, args, **kwargs)
+
+    def sampled(self, msg, *args, **kwargs):
+        """INFO for every sample_every-th call with this template; every call
+        when the bot is at DEBUG."""
+        if not self.isEnabledFor(logging.INFO):
+            return
+        count = self._sample_counts.get(msg, 0)
+        self._sample_counts[msg] = count + 1
+        if count % self.sample_every == 0 or self.isEnabledFor(logging.DEBUG):
+            self.log(logging.INFO, msg, *args, **kwargs)
+
+
+def bot_logger(logger, bot_id):
+    key = (logger.name, bot_id)
+    adapter = _bot_loggers.get(key)
+    if adapter is None:
+        sample_every = max(1, int(os.getenv('LOG_SAMPLE_EVERY', '100')))
+        adapter = _bot_loggers[key] = BotLogger(logger, bot_id, sample_every)
+    return adapter
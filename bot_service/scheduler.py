@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def parse_weights(value):
+    # "12:3,45:2" -> {12: 3, 45: 2}; арендаторы без веса получают вес по умолчанию
+    weights = {}
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        user_id, _, weight = part.partition(':')
+        try:
+            weights[int(user_id)] = max(1, int(weight))
+        except ValueError:
+            logger.warning("Ignoring invalid tenant weight: %s", part)
+    return weights
+
+
+class TenantScheduler:
+    """Weighted round-robin over per-tenant (user_id) job queues.
+
+    Each turn a tenant may start up to its weight in jobs before the next
+    tenant gets a turn, so a tenant with many bots cannot starve small ones.
+    Jobs are zero-argument coroutine functions.
+    """
+
+    def __init__(self, weights=None, default_weight=1, concurrency=4):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.concurrency = max(1, concurrency)
+        self.queues = {}
+        self._order = deque()  # арендаторы с незавершённой работой, в порядке очереди
+        self._credit = {}  # сколько задач арендатор ещё может запустить в текущий ход
+
+    def weight(self, user_id):
+        return self.weights.get(user_id, self.default_weight)
+
+    def submit(self, user_id, job):
+        queue = self.queues.setdefault(user_id, deque())
+        if not queue:
+            self._order.append(user_id)
+        queue.append(job)
+
+    def queue_depths(self):
+        return {user_id: len(queue) for user_id, queue in self.queues.items()}
+
+    def _next_job(self):
+        if not self._order:
+            return None
+        user_id = self._order[0]
+        queue = self.queues[user_id]
+        job = queue.popleft()
+        credit = self._credit.get(user_id, self.weight(user_id)) - 1
+        if not queue:
+            self._order.popleft()
+            self._credit.pop(user_id, None)
+        elif credit <= 0:
+            self._order.rotate(-1)
+            self._credit.pop(user_id, None)
+        else:
+            self._credit[user_id] = credit
+        return user_id, job
+
+    async def _worker(self):
+        while True:
+            item = self._next_job()
+            if item is None:
+                return
+            user_id, job = item
+            try:
+                await job()
+            except Exception as e:
+                logger.error("Tenant %s: job failed: %s", user_id, e)
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
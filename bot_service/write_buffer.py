@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Одно set-based обновление на всю пачку; NULL в массиве значит «колонку не менять»
+FLUSH_CHATS_SQL = """
+    UPDATE chats AS c SET
+        status_id = COALESCE(v.status_id, c.status_id),
+        type_id = COALESCE(v.type_id, c.type_id),
+        user_num = COALESCE(v.user_num, c.user_num),
+        unknown_user = COALESCE(v.unknown_user, c.unknown_user),
+        updated_at = NOW()
+    FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::int[])
+        AS v(chat_id, status_id, type_id, user_num, unknown_user)
+    WHERE c.chat_id = v.chat_id
+      AND (c.status_id, c.type_id, c.user_num, c.unknown_user) IS DISTINCT FROM (
+          COALESCE(v.status_id, c.status_id),
+          COALESCE(v.type_id, c.type_id),
+          COALESCE(v.user_num, c.user_num),
+          COALESCE(v.unknown_user, c.unknown_user)
+      )
+"""
+
+
+class ChatWriteBuffer:
+    """Write-behind buffer for chat-level audit results.
+
+    Changes are merged per chat_id and written with a single UPDATE ... FROM
+    unnest(...) statement every flush_interval seconds, when max_pending chats
+    are queued, or on close().
+    """
+
+    COLUMNS = ('status_id', 'type_id', 'user_num', 'unknown_user')
+
+    def __init__(self, pool, flush_interval=1.0, max_pending=500):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}  # chat_id -> {column: value}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._flush_soon = None
+
+    def update(self, chat, **values):
+        # chat — строка, загруженная в этом цикле; значения, совпадающие с ней, не пишем
+        changes = {k: v for k, v in values.items() if chat.get(k) != v}
+        if not changes:
+            return False
+        self.pending.setdefault(chat['chat_id'], {}).update(changes)
+        if len(self.pending) >= self.max_pending and (self._flush_soon is None or self._flush_soon.done()):
+            self._flush_soon = asyncio.create_task(self.flush())
+        return True
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            chat_ids = list(batch)
+            columns = [[batch[chat_id].get(column) for chat_id in chat_ids] for column in self.COLUMNS]
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute(FLUSH_CHATS_SQL, chat_ids, *columns)
+            except Exception as e:
+                # Возвращаем пачку в буфер, не затирая более свежие значения
+                for chat_id, changes in batch.items():
+                    changes.update(self.pending.get(chat_id, {}))
+                    self.pending[chat_id] = changes
+                logger.error("Failed to flush %s chat updates: %s", len(batch), e)
+                return 0
+            logger.info("Flushed %s chat updates", len(batch))
+            return len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
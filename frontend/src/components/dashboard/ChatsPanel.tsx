@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useTranslation } from 'react-i18next';
 import {
   Box,
@@ -24,6 +24,7 @@ import { api } from '../../contexts/AuthContext';
 import { Delete } from '@mui/icons-material';
 import './ChatsPanel.css';
 import { useNavigate } from 'react-router-dom';
+import { useChangeEvents } from '../../hooks/useChangeEvents';
 
 interface Chat {
   chat_id: number;
@@ -75,6 +76,14 @@ export default function ChatsPanel() {
     fetchBots();
   }, []);
 
+  // Изменения приходят пачками (импорт, обход bot_service) — перечитываем список не чаще раза в 300 мс
+  const refetchTimer = useRef<ReturnType<typeof setTimeout>>();
+  useChangeEvents(() => {
+    clearTimeout(refetchTimer.current);
+    refetchTimer.current = setTimeout(fetchChats, 300);
+  });
+  useEffect(() => () => clearTimeout(refetchTimer.current), []);
+
   const fetchChats = async () => {
     try {
       const response = await api.get('/api/chats');
@@ -28,6 +28,8 @@ export const api = axios.create({
   },
 });
 
+const READ_PRIMARY_UNTIL = 'read_primary_until';
+
 // Add a request interceptor
 api.interceptors.request.use(
   (config) => {
@@ -35,6 +37,11 @@ api.interceptors.request.use(
     if (token) {
       config.headers.Authorization = `Bearer ${token}`;
     }
+    // После записи backend просит читать с мастера (read-your-writes); cookie на другой origin не уходит
+    const readPrimaryUntil = localStorage.getItem(READ_PRIMARY_UNTIL);
+    if (readPrimaryUntil && Number(readPrimaryUntil) > Date.now() / 1000) {
+      config.headers['X-Read-Primary-Until'] = readPrimaryUntil;
+    }
     return config;
   },
   (error) => {
@@ -42,12 +49,78 @@ api.interceptors.request.use(
   }
 );
 
+export const storeTokens = (data: { access_token: string; refresh_token?: string }) => {
+  localStorage.setItem('token', data.access_token);
+  if (data.refresh_token) {
+    localStorage.setItem('refresh_token', data.refresh_token);
+  }
+};
+
+const clearTokens = () => {
+  localStorage.removeItem('token');
+  localStorage.removeItem('refresh_token');
+};
+
+// Один запрос обновления на все одновременно получившие 401
+let refreshing: Promise<string> | null = null;
+
+const postRefresh = (refresh_token: string): Promise<string> =>
+  axios.post(`${api.defaults.baseURL}/api/auth/refresh`, { refresh_token }).then((response) => {
+    storeTokens(response.data);
+    return response.data.access_token as string;
+  });
+
+// Вкладки делят токены через localStorage: обновляет одна (Web Locks), остальные берут её результат.
+// Иначе все вкладки разом предъявят один refresh-токен, и сервер после окна отсрочки сочтёт это кражей
+const refreshOnce = (seen: string): Promise<string> => {
+  const run = () => {
+    const current = localStorage.getItem('refresh_token');
+    if (current && current !== seen) {
+      // Пока ждали блокировку, другая вкладка уже обновила токены
+      return Promise.resolve(localStorage.getItem('token') as string);
+    }
+    return postRefresh(seen);
+  };
+  const locks = (navigator as any).locks;
+  return locks ? locks.request('koin-token-refresh', run) : run();
+};
+
+export const refreshAccessToken = (): Promise<string> => {
+  if (!refreshing) {
+    const refresh_token = localStorage.getItem('refresh_token');
+    refreshing = (refresh_token
+      ? refreshOnce(refresh_token)
+      : Promise.reject(new Error('No refresh token'))
+    ).finally(() => {
+      refreshing = null;
+    });
+  }
+  return refreshing;
+};
+
 // Add a response interceptor
 api.interceptors.response.use(
-  (response) => response,
-  (error) => {
+  (response) => {
+    const readPrimaryUntil = response.headers['x-read-primary-until'];
+    if (readPrimaryUntil) {
+      localStorage.setItem(READ_PRIMARY_UNTIL, readPrimaryUntil);
+    }
+    return response;
+  },
+  async (error) => {
+    const original = error.config;
+    if (error.response?.status === 401 && original && !original._retry && !/\/api\/auth\/(token|refresh|logout)/.test(original.url || '')) {
+      original._retry = true;
+      try {
+        const access_token = await refreshAccessToken();
+        original.headers.Authorization = `Bearer ${access_token}`;
+        return api(original);
+      } catch (refreshError) {
+        // обновить не удалось — ниже отправляем на страницу входа
+      }
+    }
     if (error.response?.status === 401) {
-      localStorage.removeItem('token');
+      clearTokens();
       window.location.href = '/login';
     }
     return Promise.reject(error);
@@ -82,7 +155,7 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
       console.error('Auth check failed:', error);
       setIsAuthenticated(false);
       setUser(null);
-      localStorage.removeItem('token');
+      clearTokens();
     }
   };
 
@@ -99,7 +172,7 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
       });
 
       const { access_token } = response.data;
-      localStorage.setItem('token', access_token);
+      storeTokens(response.data);
       
       // Обновляем заголовок Authorization для всех последующих запросов
       api.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
@@ -113,7 +186,11 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
   };
 
   const logout = () => {
-    localStorage.removeItem('token');
+    const refresh_token = localStorage.getItem('refresh_token');
+    if (refresh_token) {
+      api.post('/api/auth/logout', { refresh_token }).catch(() => undefined);
+    }
+    clearTokens();
     delete api.defaults.headers.common['Authorization'];
     setIsAuthenticated(false);
     setUser(null);
@@ -131,7 +208,7 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
     try {
       const response = await api.post('/api/auth/register', data);
       const { access_token } = response.data;
-      localStorage.setItem('token', access_token);
+      storeTokens(response.data);
       api.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
       await checkAuth();
       navigate('/dashboard');
@@ -0,0 +1,89 @@
+import { useEffect, useRef } from 'react';
+import { api, refreshAccessToken } from '../contexts/AuthContext';
+
+export type ChangeEvent =
+  | { type: 'change'; table: 'chats' | 'chat_employees'; op: string; chat_ids: number[] | null }
+  | { type: 'resync' };
+
+// Затрагивает ли событие чат; chat_ids = null — неизвестно какие, считаем что да
+export const affectsChat = (event: ChangeEvent, chatId: number) =>
+  event.type === 'resync' || event.chat_ids === null || event.chat_ids.includes(chatId);
+
+const MAX_RETRY_MS = 30000;
+
+// Подписка на /api/events/stream (server-sent events). fetch вместо EventSource,
+// чтобы передать токен в заголовке Authorization, а не в адресе.
+export function useChangeEvents(onEvent: (event: ChangeEvent) => void) {
+  const handler = useRef(onEvent);
+  handler.current = onEvent;
+
+  useEffect(() => {
+    const controller = new AbortController();
+    const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+    const run = async () => {
+      let retryMs = 2000;
+      let connected = false;
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`${api.defaults.baseURL}/api/events/stream`, {
+            headers: { Authorization: `Bearer ${localStorage.getItem('token')}`, Accept: 'text/event-stream' },
+            signal: controller.signal,
+          });
+          if (response.status === 401) {
+            // refresh-токен тоже не подошёл — страницу входа покажет interceptor при следующем запросе
+            await refreshAccessToken();
+            continue;
+          }
+          if (!response.ok || !response.body) {
+            throw new Error(`Event stream: HTTP ${response.status}`);
+          }
+          if (connected) {
+            // Пока соединения не было, изменения могли пройти мимо
+            handler.current({ type: 'resync' });
+          }
+          connected = true;
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = '';
+          let expired = false;
+          while (!expired) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let end;
+            while ((end = buffer.indexOf('\n\n')) >= 0) {
+              const block = buffer.slice(0, end);
+              buffer = buffer.slice(end + 2);
+              let name = 'message';
+              let data = '';
+              for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) name = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+                else if (line.startsWith('retry: ')) retryMs = Number(line.slice(7)) || retryMs;
+              }
+              if (name === 'change' || name === 'resync') {
+                handler.current({ type: name, ...JSON.parse(data || '{}') } as ChangeEvent);
+              } else if (name === 'expired') {
+                expired = true;
+              }
+            }
+          }
+          if (expired) {
+            await refreshAccessToken();
+            continue;
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          console.error('Event stream error:', error);
+          await sleep(retryMs);
+          retryMs = Math.min(retryMs * 2, MAX_RETRY_MS);
+          continue;
+        }
+        await sleep(retryMs);
+      }
+    };
+    run();
+    return () => controller.abort();
+  }, []);
+}
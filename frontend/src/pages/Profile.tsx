@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import { useTranslation } from 'react-i18next';
 import { Box, Paper, Typography, TextField, Button, MenuItem } from '@mui/material';
-import { api } from '../contexts/AuthContext';
+import { api, storeTokens } from '../contexts/AuthContext';
 
 interface UserProfile {
   user_id: number;
@@ -57,7 +57,7 @@ export default function Profile() {
       }
     }
     try {
-      await api.put(`/api/admin/me`, {
+      const response = await api.put(`/api/admin/me`, {
         first_name: editProfile.first_name,
         last_name: editProfile.last_name,
         email: editProfile.email,
@@ -65,6 +65,10 @@ export default function Profile() {
         language_code: editProfile.language_code,
         ...(password ? { password } : {}),
       });
+      // После смены пароля старый токен отзывается, сервер возвращает новый
+      if (response.data?.access_token) {
+        storeTokens(response.data);
+      }
       setProfile(editProfile);
       setPassword('');
       setPassword2('');
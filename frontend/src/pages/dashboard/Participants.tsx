@@ -3,6 +3,7 @@ import { useParams, useNavigate } from 'react-router-dom';
 import { Box, Typography, Paper, Button } from '@mui/material';
 import { DataGrid, GridColDef } from '@mui/x-data-grid';
 import { api } from '../../contexts/AuthContext';
+import { affectsChat, useChangeEvents } from '../../hooks/useChangeEvents';
 import { Delete } from '@mui/icons-material';
 import { IconButton, Switch } from '@mui/material';
 
@@ -26,13 +27,19 @@ export default function Participants() {
   const [chatTitle, setChatTitle] = useState('');
   const [loading, setLoading] = useState(true);
 
-  useEffect(() => {
+  const fetchParticipants = () => {
     if (!chatId) return;
     api.get(`/api/chats/${chatId}/participants`).then(res => {
       setParticipants(res.data.participants);
       setChatTitle(res.data.chat_title || '');
     }).finally(() => setLoading(false));
-  }, [chatId]);
+  };
+
+  useEffect(fetchParticipants, [chatId]);
+
+  useChangeEvents(event => {
+    if (chatId && affectsChat(event, Number(chatId))) fetchParticipants();
+  });
 
   const handleDelete = async (employee_id: number) => {
     if (!chatId) return;